@@ -43,7 +43,40 @@ def create_app(config=None):
     app = flask.Flask(__name__, static_folder=os.path.join(ROOT_DIR, "..", "static"))
 
     app.config["COMBADGE_CONTACT_TIMEOUT"] = 60 * 60
-    app.config["SHA512SUM"] = "/usr/bin/sha512sum"
+    # Filtered file listings stop counting matches at this number
+    app.config["FILES_MAX_FILTERED_COUNT"] = 1000
+    app.config["COMBADGE_CACHE"] = False
+    # Start v2 combadges in the background and return without waiting for them. Beams whose
+    # combadge never contacts the transporter are failed by mark_timeout.
+    app.config["COMBADGE_DETACH"] = False
+    # Number of transporter connections a v1 combadge uploads files over in parallel
+    app.config["COMBADGE_STREAMS"] = 1
+    # gzip level used by v1 combadges (0 disables compression). None keeps the combadge's default
+    app.config["COMBADGE_COMPRESSION_LEVEL"] = None
+    # Seconds an idle SSH connection is kept for reuse by the next beam. None disables pooling
+    app.config["SSH_POOL_IDLE_TIMEOUT"] = None
+    # Seconds a beam may wait for its combadge to be launched, in the Celery queue or behind the
+    # orchestrator's limits, before mark_timeout fails it
+    app.config["BEAM_UP_QUEUE_TIMEOUT"] = 6 * 60 * 60
+    # Hand running combadges over to a per-worker event loop instead of blocking the task. Beams
+    # which are queued or running in the orchestrator are dropped when their worker process exits,
+    # and are failed by mark_timeout unless their combadge already contacted the transporter.
+    app.config["BEAM_UP_ASYNC"] = False
+    app.config["BEAM_UP_MAX_BEAMS"] = 200
+    app.config["BEAM_UP_MAX_BEAMS_PER_HOST"] = 4
+    app.config["BEAM_UP_LAUNCH_WORKERS"] = 8
+    app.config["BEAM_UP_POLL_INTERVAL"] = 5
+    app.config["CHECKSUM_VALIDATION_BYTES_PER_NIGHT"] = 100 * 1024**3
+    app.config["CHECKSUM_VALIDATION_WORKERS"] = 4
+    app.config["VACUUM_WORKERS"] = 8
+    app.config["VACUUM_BATCH_SIZE"] = 100
+    app.config["VACUUM_PRESSURE_THRESHOLD_SHIFT"] = 0
+    app.config["SCRUB_WORKERS"] = 8
+    app.config["SCRUB_FULL_INTERVAL_DAYS"] = 30
+    app.config["TRACKER_REFRESH_WORKERS"] = 4
+    app.config["TRACKER_REFRESH_TIMEOUT"] = 30 * 60
+    app.config["ISSUE_REFRESH_BACKOFF"] = 0.5
+    app.config["ISSUE_REFRESH_MAX_INTERVAL"] = 7
     app.config["STORAGE_PATH"] = os.environ.get("STORAGE_PATH")
     _CONF_D_PATH = os.environ.get("CONFIG_DIRECTORY", os.path.join(ROOT_DIR, "..", "conf.d"))
 
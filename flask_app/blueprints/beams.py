@@ -1,18 +1,22 @@
 import http
+import json
+from typing import Any, Dict, Iterator
 
-from flask import Blueprint, Response, abort, current_app, jsonify, request
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context
 from flux import current_timeline
 from paramiko.ssh_exception import SSHException
-from sqlalchemy import distinct
+from sqlalchemy import Integer, String, cast, func
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import noload
 from sqlalchemy.sql import false
 
 from flask_app.utils.remote_host import create_key
 
-from ..models import Beam, BeamType, Issue, Key, Pin, Tag, User, db
+from ..models import Beam, BeamSummary, BeamType, File, Issue, Key, Tag, User, db
 from ..tasks import beam_up, delete_beam
 from .auth import InvalidEmail, get_or_create_user, require_user
+from .files import dictify_file
 from .types import ServerResponse
 from .utils import is_valid_hostname, validate_schema
 
@@ -20,7 +24,20 @@ beams = Blueprint("beams", __name__, template_folder="templates")
 
 
 _BEAMS_PER_PAGE = 50
-_ALLOWED_PARAMS = ["tag", "pinned", "uid", "email", "page", "per_page", "issue"]
+_ALLOWED_PARAMS = [
+    "tag",
+    "pinned",
+    "uid",
+    "email",
+    "page",
+    "per_page",
+    "issue",
+    "before_id",
+    "purge_before",
+    "sort",
+]
+_SORT_ORDERS = ["id", "purge_time"]
+_MANIFEST_BATCH_SIZE = 1000
 
 
 @beams.route("", methods=["GET"], strict_slashes=False)
@@ -28,17 +45,29 @@ def get_all() -> Response:
     if any({param not in _ALLOWED_PARAMS for param in request.values}):
         abort(http.client.BAD_REQUEST)
 
-    beam_query = db.session.query(Beam).options(
-        joinedload(Beam.pins), joinedload(Beam.type), joinedload(Beam.issues)
+    sort = request.args.get("sort", "id")
+    if sort not in _SORT_ORDERS or (sort != "id" and "before_id" in request.values):
+        abort(http.client.BAD_REQUEST)
+
+    # Beams without a summary row are still listed, as neither pinned nor having open issues.
+    # Filters on tags and issues only match beams which have one.
+    pinned = func.coalesce(func.cardinality(BeamSummary.pinners), 0) > 0
+    purge_time = Beam.purge_time_clause(
+        current_app.config["VACUUM_THRESHOLD"],
+        pinned=pinned,
+        has_open_issues=func.coalesce(BeamSummary.has_open_issues, false()),
+    ).label("purge_time")
+    beam_query = db.session.query(Beam, purge_time).outerjoin(
+        BeamSummary, BeamSummary.beam_id == Beam.id
     )
 
     for param in request.values:
         param_values = request.values[param]
         if param == "tag":
-            beam_query = beam_query.filter(Beam.tags.any(Tag.tag.in_(param_values.split(";"))))
+            tags = cast(param_values.split(";"), ARRAY(String))
+            beam_query = beam_query.filter(BeamSummary.tags.overlap(tags))
         elif param == "pinned":
-            pinned = db.session.query(distinct(Pin.beam_id))
-            beam_query = beam_query.filter(Beam.id.in_(pinned))
+            beam_query = beam_query.filter(pinned)
         elif param == "uid":
             try:
                 uid = int(param_values)
@@ -51,23 +80,59 @@ def get_all() -> Response:
                 beam_query.filter_by(initiator=user.id) if user else beam_query.filter(false())
             )
         elif param == "issue":
-            issue_ids = param_values.split(";")
-            if len(issue_ids) > 1:
-                filter_ = Issue.id_in_tracker.in_(issue_ids)
-            else:
-                filter_ = Issue.id_in_tracker == issue_ids[0]
-            beam_query = beam_query.filter(Beam.issues.any(filter_))
+            issue_ids = [
+                issue_id
+                for (issue_id,) in db.session.query(Issue.id).filter(
+                    Issue.id_in_tracker.in_(param_values.split(";"))
+                )
+            ]
+            beam_query = beam_query.filter(
+                BeamSummary.issues.overlap(cast(issue_ids, ARRAY(Integer)))
+            )
+        elif param == "before_id":
+            try:
+                before_id = int(param_values)
+            except ValueError:
+                abort(http.client.BAD_REQUEST)
+            # Keyset pagination - seek on the primary key instead of skipping rows with OFFSET,
+            # so that deep pages cost the same as the first one
+            beam_query = beam_query.filter(Beam.id < before_id)
+        elif param == "purge_before":
+            try:
+                purge_before = int(param_values)
+            except ValueError:
+                abort(http.client.BAD_REQUEST)
+            beam_query = beam_query.filter(purge_time < purge_before)
     page = request.args.get("page", 1, type=int)
     per_page = request.args.get("per_page", _BEAMS_PER_PAGE, type=int)
+    if per_page < 1:
+        abort(http.client.BAD_REQUEST)
 
-    beams_obj = [
-        b.to_dict(current_app.config["VACUUM_THRESHOLD"])
-        for b in beam_query.order_by(Beam.id.desc()).limit(per_page).offset((page - 1) * per_page)
-    ]
+    if sort == "purge_time":
+        beam_query = beam_query.order_by(purge_time.asc().nullslast(), Beam.id.desc())
+    else:
+        beam_query = beam_query.order_by(Beam.id.desc())
+    if "before_id" not in request.values:
+        beam_query = beam_query.offset((page - 1) * per_page)
+
+    # Fetch one extra beam to know whether there is another page after this one
+    rows = beam_query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    page_beams = [beam for beam, _ in rows[:per_page]]
+
+    beams_obj = Beam.to_dicts(
+        page_beams,
+        current_app.config["VACUUM_THRESHOLD"],
+        purge_times={beam.id: beam_purge_time for beam, beam_purge_time in rows},
+    )
 
-    total_pages = page + 1 if len(beams_obj) == per_page else page
+    # The next cursor should be treated as opaque by clients and passed back as before_id, which
+    # only the id order supports
+    meta: Dict[str, Any] = {"next": str(page_beams[-1].id) if has_more and sort == "id" else None}
+    if "before_id" not in request.values:
+        meta["total_pages"] = page + 1 if has_more else page
 
-    return jsonify({"beams": beams_obj, "meta": {"total_pages": total_pages}})
+    return jsonify({"beams": beams_obj, "meta": meta})
 
 
 @beams.route("", methods=["POST"])
@@ -130,8 +195,10 @@ def create(user: User) -> ServerResponse:
     if directory == "/":
         return "Invalid beam directory", http.client.CONFLICT
 
+    start = current_timeline.datetime.utcnow()
+    independent = request.json["beam"]["auth_method"] == "independent"
     beam = Beam(
-        start=current_timeline.datetime.utcnow(),
+        start=start,
         size=0,
         host=request.json["beam"]["host"],
         comment=request.json["beam"].get("comment"),
@@ -142,6 +209,8 @@ def create(user: User) -> ServerResponse:
         pending_deletion=False,
         completed=False,
         deleted=False,
+        # The user runs the combadge of an independent beam, so no beam_up task launches it
+        launched_at=start if independent else None,
     )
 
     if request.json["beam"].get("type") is not None:
@@ -161,7 +230,7 @@ def create(user: User) -> ServerResponse:
             db.session.add(t)
         db.session.commit()
 
-    if request.json["beam"]["auth_method"] != "independent":
+    if not independent:
         beam_up.delay(
             beam_id=beam.id,
             host=beam.host,
@@ -181,11 +250,37 @@ def get(beam_id: int) -> ServerResponse:
     beam = db.session.query(Beam).filter_by(id=beam_id).first()
     if not beam:
         return "No such beam", http.client.NOT_FOUND
-    beam_json = beam.to_dict(current_app.config["VACUUM_THRESHOLD"])
-    beam_json["files"] = [f.id for f in beam.files]
+    [beam_json] = Beam.to_dicts([beam], current_app.config["VACUUM_THRESHOLD"])
+    beam_json["files"] = [
+        file_id
+        for (file_id,) in db.session.query(File.id).filter_by(beam_id=beam_id).order_by(File.id)
+    ]
     return jsonify({"beam": beam_json})
 
 
+@beams.route("/<int:beam_id>/manifest.ndjson", methods=["GET"])
+def get_manifest(beam_id: int) -> ServerResponse:
+    if db.session.query(Beam.id).filter_by(id=beam_id).first() is None:
+        return "No such beam", http.client.NOT_FOUND
+
+    # Rows are streamed from a server side cursor so that memory use doesn't grow with the number
+    # of files in the beam
+    files_query = (
+        db.session.query(File)
+        .options(noload(File.beam))
+        .filter_by(beam_id=beam_id)
+        .order_by(File.file_name)
+        .execution_options(stream_results=True)
+        .yield_per(_MANIFEST_BATCH_SIZE)
+    )
+
+    def _generate() -> Iterator[str]:
+        for f in files_query:
+            yield json.dumps(dictify_file(f)) + "\n"
+
+    return Response(stream_with_context(_generate()), mimetype="application/x-ndjson")
+
+
 @beams.route("/<int:beam_id>", methods=["PUT"])
 @validate_schema(
     {
@@ -221,6 +316,8 @@ def update(beam_id: int) -> str:
 
     if "tags" in json:
         db.session.query(Tag).filter_by(beam_id=beam_id).delete()
+        # The bulk delete bypasses the ORM, so the summary has to be refreshed explicitly
+        BeamSummary.refresh([beam_id])
         for tag in json["tags"]:
             db.session.add(Tag(beam_id=beam_id, tag=tag))
 
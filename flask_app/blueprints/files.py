@@ -1,13 +1,31 @@
 import http
 import os
 import urllib.parse
-from typing import Any, Mapping, Optional
+from collections import defaultdict
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
 
 import logbook
 from flask import Blueprint, Response, abort, current_app, jsonify, request
 from flux import current_timeline
+from sqlalchemy import (
+    BigInteger,
+    DateTime,
+    Integer,
+    String,
+    and_,
+    cast,
+    column,
+    exists,
+    func,
+    literal,
+    select,
+    union_all,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import insert
 
-from ..models import Beam, File, db
+from ..models import Beam, BeamSummary, File, db
 from .types import ServerResponse
 from .utils import validate_schema
 
@@ -30,6 +48,25 @@ _STRIPPED_EXTENSIONS = [
 ]
 
 
+_FILTER_MODES = ["substring", "prefix", "glob"]
+
+
+def _escape_like(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _glob_to_like(pattern: str) -> str:
+    return "".join("%" if c == "*" else "_" if c == "?" else _escape_like(c) for c in pattern)
+
+
+def _get_like_pattern(file_filter: str, mode: str) -> str:
+    if mode == "prefix":
+        return _escape_like(file_filter) + "%"
+    elif mode == "glob":
+        return _glob_to_like(file_filter)
+    return "%{}%".format(_escape_like(file_filter))
+
+
 def _assure_beam_dir(beam_id: int) -> str:
     dir_name = str(beam_id % 1000)
     full_path = os.path.join(current_app.config["STORAGE_PATH"], dir_name)
@@ -50,7 +87,93 @@ def _strip_gz(storage_name: str) -> str:
     return storage_name
 
 
-def _dictify_file(f: File) -> Mapping[str, Optional[Any]]:
+def _storage_name_clause(file_id: Any, beam_id: Any, file_name: Any) -> Any:
+    # SQL counterpart of the storage name format: <beam directory>/<file id>-<flattened file name>
+    return func.concat(
+        cast(beam_id % 1000, String),
+        "/",
+        cast(file_id, String),
+        "-",
+        func.replace(func.replace(file_name, "/", "__"), "\\", "__"),
+    )
+
+
+def _upsert_files(
+    beam_files: Sequence[Tuple[int, str]],
+) -> Mapping[Tuple[int, str], Tuple[int, str, str]]:
+    # Registers the given files in a single statement, returning the id, status and storage name
+    # of each. Existing files are returned as they are (their storage name is filled in if it is
+    # missing) and new files get their storage name computed from their newly allocated id
+    if not beam_files:
+        return {}
+    incoming = select(
+        values(
+            column("beam_id", Integer), column("file_name", String), name="incoming_values"
+        ).data(list(dict.fromkeys(beam_files)))
+    ).cte("incoming")
+    matches_incoming = and_(
+        File.beam_id == incoming.c.beam_id, File.file_name == incoming.c.file_name
+    )
+    returned_columns = [File.id, File.beam_id, File.file_name, File.status, File.storage_name]
+
+    existing = select(returned_columns).join_from(File, incoming, matches_incoming)
+    named = existing.where(File.storage_name.isnot(None))
+    unnamed = (
+        update(File)
+        .where(matches_incoming, File.storage_name.is_(None))
+        .values(storage_name=_storage_name_clause(File.id, File.beam_id, File.file_name))
+        .returning(*returned_columns)
+        .cte("unnamed")
+    )
+
+    # Ids are only drawn for files which don't exist yet. The conflict clause covers files
+    # registered concurrently by another request.
+    new_files = (
+        select(
+            [
+                func.nextval(func.pg_get_serial_sequence(File.__tablename__, "id")).label("id"),
+                incoming.c.beam_id,
+                incoming.c.file_name,
+            ]
+        )
+        .where(~exists().where(matches_incoming))
+        .cte("new_files")
+    )
+    inserted = (
+        insert(File)
+        .from_select(
+            ["id", "beam_id", "file_name", "status", "storage_name"],
+            select(
+                [
+                    new_files.c.id,
+                    new_files.c.beam_id,
+                    new_files.c.file_name,
+                    literal("pending"),
+                    _storage_name_clause(
+                        new_files.c.id, new_files.c.beam_id, new_files.c.file_name
+                    ),
+                ]
+            ),
+        )
+        .on_conflict_do_update(
+            constraint="uix_1",
+            set_={
+                "storage_name": func.coalesce(
+                    File.storage_name, _storage_name_clause(File.id, File.beam_id, File.file_name)
+                )
+            },
+        )
+        .returning(*returned_columns)
+        .cte("inserted")
+    )
+    stmt = union_all(named, select(unnamed), select(inserted))
+    return {
+        (beam_id, file_name): (file_id, status, storage_name)
+        for file_id, beam_id, file_name, status, storage_name in db.session.execute(stmt)
+    }
+
+
+def dictify_file(f: File) -> Mapping[str, Optional[Any]]:
     url = (
         f"{request.host_url}/file_contents/{urllib.parse.quote(_strip_gz(f.storage_name))}"
         if f.storage_name
@@ -74,7 +197,7 @@ def get(file_id: int) -> ServerResponse:
     file_rec = db.session.query(File).filter_by(id=file_id).first()
     if not file_rec:
         return "No such file", http.client.NOT_FOUND
-    return jsonify({"file": _dictify_file(file_rec)})
+    return jsonify({"file": dictify_file(file_rec)})
 
 
 @files.route("", methods=["GET"])
@@ -89,12 +212,25 @@ def get_all() -> Response:
 
     query = db.session.query(File).filter_by(beam_id=beam_id)
 
+    capped = False
     if "filter" in request.args and request.args["filter"]:
-        query = query.filter(File.file_name.like("%{}%".format(request.args["filter"])))
+        mode = request.args.get("filter_mode", "substring")
+        if mode not in _FILTER_MODES:
+            abort(http.client.BAD_REQUEST)
 
-    query = query.order_by(File.file_name)
+        # Served by the trigram index on file names (or by the pattern index for prefixes)
+        pattern = _get_like_pattern(request.args["filter"], mode)
+        query = query.filter(File.file_name.like(pattern, escape="\\"))
+
+        # Counting every match of a broad search over a huge beam is as slow as the search itself
+        max_count = current_app.config["FILES_MAX_FILTERED_COUNT"]
+        total = query.limit(max_count + 1).count()
+        capped = total > max_count
+        total = min(total, max_count)
+    else:
+        total = query.count()
 
-    total = query.count()
+    query = query.order_by(File.file_name)
 
     if "offset" in request.args or "limit" in request.args:
         if not "offset" in request.args and "limit" in request.args:
@@ -108,7 +244,12 @@ def get_all() -> Response:
 
         query = query.offset(offset).limit(limit)
 
-    return jsonify({"files": [_dictify_file(f) for f in query], "meta": {"total": total}})
+    return jsonify(
+        {
+            "files": [dictify_file(f) for f in query],
+            "meta": {"total": total, "total_capped": capped},
+        }
+    )
 
 
 @files.route("", methods=["POST"])
@@ -133,72 +274,190 @@ def register_file() -> Response:
         abort(http.client.FORBIDDEN)
 
     file_name = request.json["file_name"]
-    f = db.session.query(File).filter_by(beam_id=beam_id, file_name=file_name).first()
-    if not f:
-        logbook.info("Got upload request for a new file: {} @ {}", file_name, beam_id)
-        f = File(beam_id=beam_id, file_name=file_name, size=None, status="pending")
-        db.session.add(f)
-        db.session.commit()
-    else:
-        logbook.info(
-            "Got upload request for a existing file: {} @ {} ({})",
-            file_name,
-            beam_id,
-            f.status,
-        )
-
-    if not f.storage_name:
-        f.storage_name = "{}/{}-{}".format(
-            _assure_beam_dir(beam.id),
-            f.id,
-            f.file_name.replace("/", "__").replace("\\", "__"),
-        )
-        db.session.commit()
+    _assure_beam_dir(beam.id)
+    file_id, status, storage_name = _upsert_files([(beam.id, file_name)])[beam.id, file_name]
+    logbook.info("Got upload request for {} @ {} ({})", file_name, beam_id, status)
 
     if not beam.combadge_contacted:
         beam.combadge_contacted = True
-        db.session.commit()
+    db.session.commit()
 
     return jsonify(
         {
-            "file_id": str(f.id),
-            "should_beam": f.status != "uploaded",
-            "storage_name": f.storage_name,
+            "file_id": str(file_id),
+            "should_beam": status != "uploaded",
+            "storage_name": storage_name,
         }
     )
 
 
-@files.route("/<int:file_id>", methods=["PUT"])
+@files.route("/batch", methods=["POST"])
 @validate_schema(
     {
         "type": "object",
         "properties": {
-            "success": {"type": "boolean"},
-            "size": {"type": ["number", "null"]},
-            "checksum": {"type": ["string", "null"]},
-            "mtime": {"type": ["number", "null"]},
+            "files": {
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "beam_id": {"type": "number"},
+                        "file_name": {"type": "string"},
+                    },
+                    "required": ["beam_id", "file_name"],
+                },
+            }
         },
-        "required": ["success"],
+        "required": ["files"],
     }
 )
-def update_file(file_id: int) -> str:
-    success = request.json["success"]
-    size = request.json.get("size", None)
-    f = db.session.query(File).filter_by(id=file_id).first()
-    if not f:
-        logbook.error("Transporter attempted to update an unknown file id {}", file_id)
+def register_files() -> Response:
+    beam_files = [(int(f["beam_id"]), f["file_name"]) for f in request.json["files"]]
+    beam_ids = {beam_id for beam_id, _ in beam_files}
+    beams = db.session.query(Beam).filter(Beam.id.in_(beam_ids)).all()
+    unknown_beam_ids = beam_ids - {beam.id for beam in beams}
+    if unknown_beam_ids:
+        logbook.error("Transporter attempted to post to unknown beam ids {}", unknown_beam_ids)
         abort(http.client.BAD_REQUEST)
 
-    mtime = request.json.get("mtime")
-    if mtime is not None:
-        mtime = current_timeline.datetime.utcfromtimestamp(mtime)
+    if any(beam.pending_deletion or beam.deleted for beam in beams):
+        abort(http.client.FORBIDDEN)
+
+    logbook.info("Got upload request for {} files @ {}", len(beam_files), beam_ids)
+    for beam in beams:
+        _assure_beam_dir(beam.id)
+    registered = _upsert_files(beam_files)
 
-    f.size = size
-    f.mtime = mtime
-    f.checksum = request.json.get("checksum", None)
-    f.status = "uploaded" if success else "failed"
-    if size is not None:
-        f.beam.size += size
+    db.session.query(Beam).filter(Beam.id.in_(beam_ids), ~Beam.combadge_contacted).update(
+        {"combadge_contacted": True}, synchronize_session=False
+    )
     db.session.commit()
 
+    returned = []
+    for beam_file in beam_files:
+        file_id, status, storage_name = registered[beam_file]
+        returned.append(
+            {
+                "file_id": str(file_id),
+                "should_beam": status != "uploaded",
+                "storage_name": storage_name,
+            }
+        )
+    return jsonify({"files": returned})
+
+
+_FILE_COMPLETION_PROPERTIES: Dict[str, Any] = {
+    "success": {"type": "boolean"},
+    "size": {"type": ["number", "null"]},
+    "checksum": {"type": ["string", "null"]},
+    "mtime": {"type": ["number", "null"]},
+}
+_FILE_COMPLETION_SCHEMA = {
+    "type": "object",
+    "properties": _FILE_COMPLETION_PROPERTIES,
+    "required": ["success"],
+}
+
+
+def _complete_files(completions: Sequence[Mapping[str, Any]]) -> bool:
+    # Applies the completion records of many files with a single UPDATE, followed by a single
+    # aggregated update of the sizes of their beams. Returns False if any of the files is unknown
+    records = {}
+    for completion in completions:
+        mtime = completion.get("mtime")
+        if mtime is not None:
+            mtime = current_timeline.datetime.utcfromtimestamp(mtime)
+        records[int(completion["file_id"])] = (
+            "uploaded" if completion["success"] else "failed",
+            completion.get("size"),
+            completion.get("checksum"),
+            mtime,
+        )
+
+    incoming = values(
+        column("file_id", Integer),
+        column("status", String),
+        column("size", BigInteger),
+        column("checksum", String),
+        column("mtime", DateTime),
+        name="incoming",
+    ).data([(file_id,) + record for file_id, record in records.items()])
+    # The file table is joined to itself so that the status before the update can be returned
+    previous = File.__table__.alias("previous")
+    stmt = (
+        update(File)
+        .where(File.id == incoming.c.file_id)
+        .where(previous.c.id == File.id)
+        .values(
+            status=incoming.c.status,
+            size=cast(incoming.c.size, BigInteger),
+            checksum=cast(incoming.c.checksum, String),
+            mtime=cast(incoming.c.mtime, DateTime),
+        )
+        .returning(File.beam_id, File.size, File.status, previous.c.status)
+        .execution_options(synchronize_session=False)
+    )
+    rows = db.session.execute(stmt).fetchall()
+    if len(rows) != len(records):
+        return False
+
+    size_deltas: Dict[int, int] = defaultdict(int)
+    uploaded_deltas: Dict[int, int] = defaultdict(int)
+    for beam_id, size, status, previous_status in rows:
+        if size is not None:
+            size_deltas[beam_id] += size
+        uploaded_deltas[beam_id] += (status == "uploaded") - (previous_status == "uploaded")
+
+    if size_deltas:
+        deltas = values(
+            column("beam_id", Integer), column("delta", BigInteger), name="deltas"
+        ).data(list(size_deltas.items()))
+        db.session.execute(
+            update(Beam)
+            .where(Beam.id == deltas.c.beam_id)
+            .values(size=Beam.size + deltas.c.delta)
+            .execution_options(synchronize_session=False)
+        )
+    BeamSummary.add_uploaded_files(uploaded_deltas)
+    return True
+
+
+@files.route("/batch", methods=["PUT"])
+@validate_schema(
+    {
+        "type": "object",
+        "properties": {
+            "files": {
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                    "type": "object",
+                    "properties": dict(_FILE_COMPLETION_PROPERTIES, file_id={"type": "number"}),
+                    "required": ["file_id", "success"],
+                },
+            }
+        },
+        "required": ["files"],
+    }
+)
+def update_files() -> str:
+    if not _complete_files(request.json["files"]):
+        db.session.rollback()
+        logbook.error("Transporter attempted to update unknown file ids")
+        abort(http.client.BAD_REQUEST)
+
+    db.session.commit()
+    return "{}"
+
+
+@files.route("/<int:file_id>", methods=["PUT"])
+@validate_schema(_FILE_COMPLETION_SCHEMA)
+def update_file(file_id: int) -> str:
+    if not _complete_files([dict(request.json, file_id=file_id)]):
+        db.session.rollback()
+        logbook.error("Transporter attempted to update an unknown file id {}", file_id)
+        abort(http.client.BAD_REQUEST)
+
+    db.session.commit()
     return "{}"
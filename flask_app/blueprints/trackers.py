@@ -2,7 +2,8 @@ import http
 
 from flask import Blueprint, Response, jsonify, request
 
-from ..models import Tracker, db
+from ..models import BeamSummary, Issue, Tracker, db
+from ..tasks import refresh_issue_trackers
 from .types import DBOperationResponse, ServerResponse
 from .utils import validate_schema
 
@@ -51,7 +52,13 @@ def delete(tracker: int) -> DBOperationResponse:
     if not tracker:
         return "Tracker not found", http.client.NOT_FOUND
 
+    # The issues of the tracker are removed by the database's cascade, which the summaries of
+    # their beams don't see
+    issue_ids = [issue_id for (issue_id,) in db.session.query(Issue.id).filter_by(tracker=tracker)]
     db.session.delete(tracker)
+    db.session.flush()
+    if issue_ids:
+        BeamSummary.refresh_issues(issue_ids)
     db.session.commit()
     return ""
 
@@ -65,6 +72,17 @@ def get(tracker: int) -> ServerResponse:
     return jsonify({"tracker": tracker_obj.to_dict()})
 
 
+@trackers.route("/<int:tracker>/refresh", methods=["POST"])
+def refresh(tracker: int) -> DBOperationResponse:
+    tracker_obj = db.session.query(Tracker).filter_by(id=tracker).first()
+    if not tracker_obj:
+        return "Tracker not found", http.client.NOT_FOUND
+
+    # Refreshes all the issues of the tracker, including the ones which are not due yet
+    refresh_issue_trackers.delay(tracker_id=tracker_obj.id, force=True)
+    return "{}"
+
+
 @trackers.route("", methods=["GET"], strict_slashes=False)
 def get_all() -> Response:
     tracker_models = db.session.query(Tracker)
@@ -1,10 +1,11 @@
 import json
-from datetime import timedelta, timezone
-from typing import List
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 import flux
 import logbook
-from flask import current_app
 from jira import JIRA as JIRAAPI
 from jira.exceptions import JIRAError
 
@@ -14,20 +15,40 @@ from .models import db
 
 logger = logbook.Logger(__name__)
 
+_SEARCH_CHUNK_SIZE = 100
+
+
+# Trackers get issues as (issue id, id in tracker) pairs and return their states as plain data,
+# so that they can be queried outside of the database session
+IssueRef = Tuple[int, str]
+
+
+class IssueState(NamedTuple):
+    open: bool
+    resolved_at: Optional[datetime]
+
 
 class Tracker:
     @staticmethod
     def get(model):
-        if model.type == "file":
-            return File(model.url)
-        elif model.type == "jira":
-            return JIRA(url=model.url, config=model.config)
-        elif model.type == "faulty":
+        return Tracker.create(model.type, url=model.url, config=model.config)
+
+    @staticmethod
+    def create(type_: str, *, url: str, config: str):
+        if type_ == "file":
+            return File(url)
+        elif type_ == "jira":
+            return JIRA(url=url, config=config)
+        elif type_ == "faulty":
             return Faulty()
         else:
-            raise ValueError("Unknown model type {}".format(model.type))
+            raise ValueError("Unknown model type {}".format(type_))
 
-    def refresh(self, issues: List[Issue]) -> None:
+    def fetch_states(
+        self, issues: List[IssueRef], deadline: float = math.inf
+    ) -> Iterator[Dict[int, IssueState]]:
+        # Yields the states of the issues by their ids, in one or more parts. Trackers which
+        # fetch in parts stop once time.monotonic() passes the deadline.
         raise NotImplementedError()
 
     def is_valid_issue(self, id_in_tracker: str) -> bool:
@@ -43,29 +64,72 @@ class JIRA(Tracker):
             basic_auth=(config_json["username"], config_json["password"]),
             timeout=5,
         )
-        self._resolution_grace = timedelta(days=config_json.get("resolution_grace", 0))
+        self._resolution_grace = timedelta(days=get_resolution_grace(config))
 
-    def _refresh_issue(self, issue_obj: Issue) -> None:
-        issue = self._jira.issue(issue_obj.id_in_tracker)
-        if issue.fields.resolutiondate is None:
-            issue_obj.open = True
-        else:
-            resolution_date = flux.current_timeline.datetime.strptime(
-                issue.fields.resolutiondate, "%Y-%m-%dT%H:%M:%S.%f%z"
-            )
-            now = flux.current_timeline.datetime.now().replace(tzinfo=timezone.utc)
-            issue_obj.open = (now - resolution_date) < self._resolution_grace
-
-    def refresh(self, issues: List[Issue]) -> None:
-        for issue_obj in issues:
-            try:
-                self._refresh_issue(issue_obj)
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
-                current_app.raven.captureException()
+    def _get_state(self, resolution_date: Optional[str]) -> IssueState:
+        if resolution_date is None:
+            return IssueState(open=True, resolved_at=None)
+        resolved = flux.current_timeline.datetime.strptime(
+            resolution_date, "%Y-%m-%dT%H:%M:%S.%f%z"
+        )
+        now = flux.current_timeline.datetime.now().replace(tzinfo=timezone.utc)
+        return IssueState(
+            open=(now - resolved) < self._resolution_grace,
+            resolved_at=resolved.astimezone(timezone.utc).replace(tzinfo=None),
+        )
 
-        db.session.commit()
+    def _search_resolution_dates(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        # Keys which don't exist are ignored rather than failing the whole query
+        jql = "key in ({})".format(
+            ", ".join('"{}"'.format(key.replace("\\", "\\\\").replace('"', '\\"')) for key in keys)
+        )
+        found = self._jira.search_issues(
+            jql, fields="resolutiondate", maxResults=len(keys), validate_query=False
+        )
+        return {issue.key.upper(): issue.fields.resolutiondate for issue in found}
+
+    def fetch_states(
+        self, issues: List[IssueRef], deadline: float = math.inf
+    ) -> Iterator[Dict[int, IssueState]]:
+        failed_chunks = 0
+        for start in range(0, len(issues), _SEARCH_CHUNK_SIZE):
+            if time.monotonic() >= deadline:
+                logger.warning(
+                    "Deadline passed for {}, {} of {} issues were refreshed",
+                    self._url,
+                    start,
+                    len(issues),
+                )
+                break
+
+            chunk = issues[start : start + _SEARCH_CHUNK_SIZE]
+            try:
+                resolution_dates = self._search_resolution_dates(
+                    [id_in_tracker for _, id_in_tracker in chunk]
+                )
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed searching issues in {}", self._url)
+                failed_chunks += 1
+                continue
+
+            states = {}
+            for issue_id, id_in_tracker in chunk:
+                key = id_in_tracker.upper()
+                if key in resolution_dates:
+                    states[issue_id] = self._get_state(resolution_dates[key])
+                    continue
+                # Issues which were moved or renamed are found under their new key. Fetching one
+                # by its old key follows the move.
+                try:
+                    issue = self._jira.issue(id_in_tracker, fields="resolutiondate")
+                except JIRAError:
+                    logger.warning("Issue {} was not found in {}", key, self._url)
+                    continue
+                states[issue_id] = self._get_state(issue.fields.resolutiondate)
+            yield states
+
+        if failed_chunks:
+            raise Exception("{} searches in {} failed".format(failed_chunks, self._url))
 
     def is_valid_issue(self, id_in_tracker: str) -> bool:
         try:
@@ -81,20 +145,27 @@ class File(Tracker):
     def __init__(self, name: str) -> None:
         self._name: str = name
 
-    def refresh(self, issues: List[Issue]) -> None:
+    def fetch_states(
+        self, issues: List[IssueRef], deadline: float = math.inf
+    ) -> Iterator[Dict[int, IssueState]]:
         with open(self._name, "r") as f:
             data = json.load(f)
-            for issue in issues:
-                issue.open = data[issue.id_in_tracker]
+        yield {
+            issue_id: IssueState(open=data[id_in_tracker], resolved_at=None)
+            for issue_id, id_in_tracker in issues
+        }
 
 
 class Faulty(Tracker):
-    def refresh(self, issues: List[Issue]) -> None:
+    def fetch_states(
+        self, issues: List[IssueRef], deadline: float = math.inf
+    ) -> Iterator[Dict[int, IssueState]]:
         raise Exception("Tracker Error")
 
 
-def refresh(tracker: TrackerModel, issues: List[Issue]) -> None:
-    Tracker.get(tracker).refresh(issues)
+def get_resolution_grace(config: Optional[str]) -> int:
+    # Days for which a resolved issue is still considered open
+    return json.loads(config or "{}").get("resolution_grace", 0)
 
 
 def is_valid_issue(issue: Issue) -> bool:
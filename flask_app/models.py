@@ -1,12 +1,32 @@
 import json
-from datetime import datetime, time
+from collections import defaultdict
+from datetime import datetime, time, timedelta
 from typing import TYPE_CHECKING, Any
 
 import flux
 from flask_login import UserMixin
 from flask_security import RoleMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import backref
+from sqlalchemy import (
+    and_,
+    case,
+    cast,
+    column,
+    event,
+    exists,
+    extract,
+    func,
+    inspect,
+    literal,
+    null,
+    or_,
+    select,
+    text,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.orm import Session, backref
 from sqlalchemy.orm import relationship as sqlalchemy_relationship
 
 db = SQLAlchemy()
@@ -93,6 +113,51 @@ class Issue(BaseModel):
     id_in_tracker = db.Column(db.String, nullable=False, index=True)
     open = db.Column(db.Boolean, nullable=False)
 
+    # When the issue was last refreshed from its tracker, when its state last changed and
+    # when it was resolved
+    last_checked = db.Column(db.DateTime)
+    last_changed = db.Column(db.DateTime)
+    resolved_at = db.Column(db.DateTime)
+
+    @classmethod
+    def update_states(cls, states_by_id):
+        # Sets the (open, resolved_at) states of many issues with a single UPDATE and marks them
+        # as checked. Bulk updates bypass the flush hook, so the summaries of the beams of issues
+        # which were opened or closed are refreshed here.
+        if not states_by_id:
+            return
+        now = flux.current_timeline.datetime.utcnow()
+        states = values(
+            column("id", db.Integer),
+            column("open", db.Boolean),
+            column("resolved_at", db.DateTime),
+            name="states",
+        ).data([(issue_id,) + tuple(state) for issue_id, state in states_by_id.items()])
+        resolved_at = cast(states.c.resolved_at, db.DateTime)
+        # The issue table is joined to itself so that the state before the update can be compared
+        previous = cls.__table__.alias("previous")
+        changed = or_(
+            previous.c.last_checked.is_(None),
+            previous.c.open != states.c.open,
+            previous.c.resolved_at.is_distinct_from(resolved_at),
+        )
+        rows = db.session.execute(
+            update(cls)
+            .where(cls.id == states.c.id)
+            .where(previous.c.id == cls.id)
+            .values(
+                open=states.c.open,
+                resolved_at=resolved_at,
+                last_checked=now,
+                last_changed=case([(changed, now)], else_=cls.last_changed),
+            )
+            .returning(cls.id, cls.open != previous.c.open)
+            .execution_options(synchronize_session=False)
+        ).fetchall()
+        opened_or_closed = [issue_id for issue_id, open_changed in rows if open_changed]
+        if opened_or_closed:
+            BeamSummary.refresh_issues(opened_or_closed)
+
     def to_dict(self):
         url = self.tracker.issue_url(self.id_in_tracker)
         return {
@@ -117,6 +182,15 @@ beam_issues = db.Table(
 
 
 class Beam(BaseModel):
+    # Vacuum candidates are looked up by start among the beams which were not deleted yet
+    __table_args__ = (
+        db.Index(
+            "ix_beam_live_start",
+            "start",
+            postgresql_where=text("NOT deleted AND NOT pending_deletion"),
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     start = db.Column(db.DateTime, index=True)
     end = db.Column(db.DateTime, index=True, nullable=True)
@@ -133,6 +207,8 @@ class Beam(BaseModel):
     deleted = db.Column(db.Boolean, index=True)
     completed = db.Column(db.Boolean, index=True)
     combadge_contacted = db.Column(db.Boolean, nullable=False, server_default="true")
+    # When the combadge was launched, which may be long after the start of queued beams
+    launched_at = db.Column(db.DateTime, nullable=True)
     initiator = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     files = db.relationship("File", backref=backref("beam", lazy="joined"))
     pins = db.relationship("Pin", backref="beam")
@@ -140,19 +216,26 @@ class Beam(BaseModel):
     tags: sqlalchemy_relationship
 
     def get_purge_time(self, default_threshold):
+        threshold = self.type.vacuum_threshold if self.type is not None else default_threshold
+        return self._calc_purge_time(
+            pinned=bool(self.pins),
+            has_open_issues=any(i.open for i in self.issues),
+            threshold=threshold,
+        )
+
+    def _calc_purge_time(self, *, pinned, has_open_issues, threshold):
         if not self.completed:
             return None
 
         if self.size == 0:
             return 0
 
-        if self.pins:
+        if pinned:
             return None
 
-        if any(i.open for i in self.issues):
+        if has_open_issues:
             return None
 
-        threshold = self.type.vacuum_threshold if self.type is not None else default_threshold
         days = (
             threshold
             - (
@@ -161,6 +244,69 @@ class Beam(BaseModel):
         )
         return max(days, 0)
 
+    # SQL counterpart of the day arithmetic in _calc_purge_time, shared by the beam listing and
+    # by the vacuum candidates query so that both always agree on when a beam is purged
+    @classmethod
+    def days_until_purge_clause(cls, default_threshold):
+        now = flux.current_timeline.datetime.utcnow()
+        threshold = func.coalesce(
+            select([BeamType.vacuum_threshold]).where(BeamType.id == cls.type_id).scalar_subquery(),
+            default_threshold,
+        )
+        age_in_days = func.floor(
+            extract("epoch", literal(now, db.DateTime) - func.date_trunc("day", cls.start))
+            / (60 * 60 * 24)
+        )
+        return cast(threshold - age_in_days, db.Integer)
+
+    @classmethod
+    def expired_clause(cls, default_threshold, threshold_shift=0):
+        # Same as days_until_purge_clause(default_threshold) <= threshold_shift, but compares start
+        # with cutoffs computed once per threshold, so that the index on start can be used
+        now = flux.current_timeline.datetime.utcnow()
+        type_ids_by_threshold = defaultdict(list)
+        for type_id, threshold in db.session.query(BeamType.id, BeamType.vacuum_threshold):
+            type_ids_by_threshold[threshold].append(type_id)
+
+        def _cutoff(threshold):
+            # A beam expires at the midnight after its start, plus the threshold
+            day = (now - timedelta(days=threshold - threshold_shift)).date()
+            return datetime.combine(day, time()) + timedelta(days=1)
+
+        clauses = [
+            and_(
+                or_(
+                    cls.type_id.is_(None),
+                    cls.type_id.in_(type_ids_by_threshold.pop(default_threshold, [])),
+                ),
+                cls.start < _cutoff(default_threshold),
+            )
+        ]
+        for threshold, type_ids in type_ids_by_threshold.items():
+            clauses.append(and_(cls.type_id.in_(type_ids), cls.start < _cutoff(threshold)))
+        return or_(*clauses)
+
+    @classmethod
+    def purge_time_clause(cls, default_threshold, pinned=None, has_open_issues=None):
+        if pinned is None:
+            pinned = exists().where(Pin.beam_id == cls.id)
+        if has_open_issues is None:
+            has_open_issues = (
+                exists()
+                .where(beam_issues.c.beam_id == cls.id)
+                .where(Issue.id == beam_issues.c.issue_id)
+                .where(Issue.open)
+            )
+        return case(
+            [
+                (cls.completed.isnot(True), null()),
+                (cls.size == 0, 0),
+                (pinned, null()),
+                (has_open_issues, null()),
+            ],
+            else_=func.greatest(cls.days_until_purge_clause(default_threshold), 0),
+        )
+
     def set_completed(self, completed):
         if self.completed == completed:
             return
@@ -172,6 +318,93 @@ class Beam(BaseModel):
             self.end = None
 
     def to_dict(self, default_threshold):
+        return self._to_dict(
+            purge_time=self.get_purge_time(default_threshold),
+            type_name=None if not self.type else self.type.name,
+            pins=[u.user_id for u in self.pins],
+            tags=[t.tag for t in self.tags],  # pylint: disable=E1101
+            issues=[i.id for i in self.issues],
+        )
+
+    # Same output as to_dict, but the related rows of all beams are fetched with a fixed number of
+    # queries rather than with lazy loads per beam
+    @classmethod
+    def to_dicts(cls, beams, default_threshold, purge_times=None):
+        beam_ids = [beam.id for beam in beams]
+        if not beam_ids:
+            return []
+
+        tags = defaultdict(list)
+        pins = defaultdict(list)
+        issues = defaultdict(list)
+        open_issues = set()
+        for summary in db.session.query(BeamSummary).filter(BeamSummary.beam_id.in_(beam_ids)):
+            tags[summary.beam_id] = summary.tags
+            pins[summary.beam_id] = summary.pinners
+            issues[summary.beam_id] = summary.issues
+            if summary.has_open_issues:
+                open_issues.add(summary.beam_id)
+
+        # Beams without a summary row (i.e. ones which were never flushed through the ORM) are
+        # served straight from the related tables
+        missing_ids = [beam_id for beam_id in beam_ids if beam_id not in tags]
+        if missing_ids:
+            for beam_id, tag in (
+                db.session.query(Tag.beam_id, Tag.tag)
+                .filter(Tag.beam_id.in_(missing_ids))
+                .order_by(Tag.id)
+            ):
+                tags[beam_id].append(tag)
+
+            for beam_id, user_id in (
+                db.session.query(Pin.beam_id, Pin.user_id)
+                .filter(Pin.beam_id.in_(missing_ids))
+                .order_by(Pin.id)
+            ):
+                pins[beam_id].append(user_id)
+
+            for beam_id, issue_id, is_open in (
+                db.session.query(beam_issues.c.beam_id, Issue.id, Issue.open)
+                .join(Issue, Issue.id == beam_issues.c.issue_id)
+                .filter(beam_issues.c.beam_id.in_(missing_ids))
+            ):
+                issues[beam_id].append(issue_id)
+                if is_open:
+                    open_issues.add(beam_id)
+
+        type_ids = {beam.type_id for beam in beams if beam.type_id is not None}
+        types = {}
+        if type_ids:
+            types = {
+                type_id: (name, vacuum_threshold)
+                for type_id, name, vacuum_threshold in db.session.query(
+                    BeamType.id, BeamType.name, BeamType.vacuum_threshold
+                ).filter(BeamType.id.in_(type_ids))
+            }
+
+        returned = []
+        for beam in beams:
+            type_name, threshold = types.get(beam.type_id, (None, default_threshold))
+            if purge_times is not None:
+                purge_time = purge_times[beam.id]
+            else:
+                purge_time = beam._calc_purge_time(
+                    pinned=bool(pins[beam.id]),
+                    has_open_issues=beam.id in open_issues,
+                    threshold=threshold,
+                )
+            returned.append(
+                beam._to_dict(
+                    purge_time=purge_time,
+                    type_name=type_name,
+                    pins=pins[beam.id],
+                    tags=tags[beam.id],
+                    issues=issues[beam.id],
+                )
+            )
+        return returned
+
+    def _to_dict(self, *, purge_time, type_name, pins, tags, issues):
         return {
             "id": self.id,
             "host": self.host,
@@ -181,14 +414,14 @@ class Beam(BaseModel):
             "size": self.size,
             "comment": self.comment,
             "initiator": self.initiator,
-            "purge_time": self.get_purge_time(default_threshold),
-            "type": None if not self.type else self.type.name,
+            "purge_time": purge_time,
+            "type": type_name,
             "error": self.error,
             "directory": self.directory,
             "deleted": self.pending_deletion or self.deleted,
-            "pins": [u.user_id for u in self.pins],
-            "tags": [t.tag for t in self.tags],  # pylint: disable=E1101
-            "associated_issues": [i.id for i in self.issues],
+            "pins": pins,
+            "tags": tags,
+            "associated_issues": issues,
         }
 
     def __repr__(self):
@@ -214,8 +447,111 @@ class Tag(BaseModel):
     tag = db.Column(db.String, index=True)
 
 
+# Denormalized read model of the beam listing, kept up to date by the hooks below so that the
+# listing filters don't have to join pins, tags and issues
+class BeamSummary(BaseModel):
+    __table_args__ = (
+        db.Index("ix_beam_summary_tags", "tags", postgresql_using="gin"),
+        db.Index("ix_beam_summary_issues", "issues", postgresql_using="gin"),
+        db.Index(
+            "ix_beam_summary_pinned",
+            "beam_id",
+            postgresql_where=text("cardinality(pinners) > 0"),
+        ),
+    )
+
+    beam_id = db.Column(db.Integer, db.ForeignKey("beam.id", ondelete="CASCADE"), primary_key=True)
+    tags = db.Column(ARRAY(db.String), nullable=False, server_default="{}")
+    pinners = db.Column(ARRAY(db.Integer), nullable=False, server_default="{}")
+    issues = db.Column(ARRAY(db.Integer), nullable=False, server_default="{}")
+    has_open_issues = db.Column(db.Boolean, nullable=False, server_default="false")
+    type_name = db.Column(db.String)
+    file_count = db.Column(db.Integer, nullable=False, server_default="0")
+
+    @classmethod
+    def refresh(cls, beam_ids, connection=None):
+        # file_count is maintained incrementally and is only initialized here
+        columns = {
+            "beam_id": Beam.id,
+            "tags": func.array(
+                select([Tag.tag]).where(Tag.beam_id == Beam.id).order_by(Tag.id).scalar_subquery()
+            ),
+            "pinners": func.array(
+                select([Pin.user_id])
+                .where(Pin.beam_id == Beam.id)
+                .order_by(Pin.id)
+                .scalar_subquery()
+            ),
+            "issues": func.array(
+                select([beam_issues.c.issue_id])
+                .where(beam_issues.c.beam_id == Beam.id)
+                .scalar_subquery()
+            ),
+            "has_open_issues": exists()
+            .where(beam_issues.c.beam_id == Beam.id)
+            .where(Issue.id == beam_issues.c.issue_id)
+            .where(Issue.open),
+            "type_name": select([BeamType.name])
+            .where(BeamType.id == Beam.type_id)
+            .scalar_subquery(),
+            "file_count": literal(0),
+        }
+        stmt = insert(cls).from_select(
+            list(columns), select(list(columns.values())).where(Beam.id.in_(beam_ids))
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.beam_id],
+            set_={
+                name: stmt.excluded[name]
+                for name in columns
+                if name not in ("beam_id", "file_count")
+            },
+        )
+        if connection is None:
+            connection = db.session.connection()
+        connection.execute(stmt)
+
+    @classmethod
+    def refresh_issues(cls, issue_ids, connection=None):
+        cls.refresh(
+            select([cls.beam_id]).where(
+                cls.issues.overlap(cast(sorted(issue_ids), ARRAY(db.Integer)))
+            ),
+            connection=connection,
+        )
+
+    @classmethod
+    def add_uploaded_files(cls, deltas, connection=None):
+        if connection is None:
+            connection = db.session.connection()
+        for beam_id, delta in deltas.items():
+            if delta:
+                connection.execute(
+                    update(cls)
+                    .where(cls.beam_id == beam_id)
+                    .values(file_count=cls.file_count + delta)
+                )
+
+
 class File(BaseModel):
-    __table_args__ = (db.UniqueConstraint("beam_id", "file_name", name="uix_1"),)
+    # File name searches are also served by a trigram index, which is created by the migrations
+    # when the pg_trgm extension is available
+    __table_args__ = (
+        db.UniqueConstraint("beam_id", "file_name", name="uix_1"),
+        db.Index(
+            "ix_file_beam_id_file_name_pattern",
+            "beam_id",
+            "file_name",
+            postgresql_ops={"file_name": "text_pattern_ops"},
+        ),
+        # Checksum validation rotates through uploaded files, never validated ones first
+        db.Index(
+            "ix_file_validation_order",
+            text("last_validated ASC NULLS FIRST"),
+            "id",
+            postgresql_where=text("status = 'uploaded' AND checksum IS NOT NULL"),
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     file_name = db.Column(db.String)
@@ -224,7 +560,7 @@ class File(BaseModel):
     size = db.Column(db.BigInteger)
     checksum = db.Column(db.String)
     mtime = db.Column(db.DateTime)
-    last_validated = db.Column(db.DateTime, index=True)
+    last_validated = db.Column(db.DateTime)
     storage_name = db.Column(db.String)
 
     def __repr__(self):
@@ -235,6 +571,77 @@ class File(BaseModel):
         )
 
 
+class ScrubBucketState(BaseModel):
+    # What a storage bucket looked like when it was last scrubbed, so that scrub can skip it
+    # while nothing changes
+    bucket = db.Column(db.String, primary_key=True)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    file_count = db.Column(db.Integer, nullable=False)
+    total_bytes = db.Column(db.BigInteger, nullable=False)
+    last_scrubbed = db.Column(db.DateTime, nullable=False)
+
+
+def _uploaded_files_delta(file_obj):
+    history = inspect(file_obj).attrs.status.history
+    return (1 if "uploaded" in history.added else 0) - (1 if "uploaded" in history.deleted else 0)
+
+
+@event.listens_for(Session, "after_flush")
+def _update_beam_summaries(session, _):
+    beam_ids = set()
+    changed_issue_ids = set()
+    changed_type_ids = set()
+    uploaded_files = defaultdict(int)
+
+    for obj in session.new:
+        if isinstance(obj, Beam):
+            beam_ids.add(obj.id)
+        elif isinstance(obj, (Tag, Pin)):
+            beam_ids.add(obj.beam_id)
+        elif isinstance(obj, File) and obj.status == "uploaded":
+            uploaded_files[obj.beam_id] += 1
+
+    for obj in session.dirty:
+        state = inspect(obj)
+        if isinstance(obj, Beam):
+            if any(
+                state.attrs[attr].history.has_changes() for attr in ("type_id", "type", "issues")
+            ):
+                beam_ids.add(obj.id)
+        elif isinstance(obj, (Tag, Pin)):
+            beam_ids.add(obj.beam_id)
+            beam_ids.update(state.attrs.beam_id.history.deleted)
+        elif isinstance(obj, Issue):
+            if state.attrs.open.history.has_changes():
+                changed_issue_ids.add(obj.id)
+        elif isinstance(obj, BeamType):
+            if state.attrs.name.history.has_changes():
+                changed_type_ids.add(obj.id)
+        elif isinstance(obj, File):
+            uploaded_files[obj.beam_id] += _uploaded_files_delta(obj)
+
+    for obj in session.deleted:
+        if isinstance(obj, (Tag, Pin)):
+            beam_ids.add(obj.beam_id)
+        elif isinstance(obj, Issue):
+            changed_issue_ids.add(obj.id)
+        elif isinstance(obj, File) and obj.status == "uploaded":
+            uploaded_files[obj.beam_id] -= 1
+
+    beam_ids.discard(None)
+    uploaded_files.pop(None, None)
+    connection = session.connection()
+    if beam_ids:
+        BeamSummary.refresh(beam_ids, connection=connection)
+    if changed_issue_ids:
+        BeamSummary.refresh_issues(changed_issue_ids, connection=connection)
+    if changed_type_ids:
+        BeamSummary.refresh(
+            select([Beam.id]).where(Beam.type_id.in_(changed_type_ids)), connection=connection
+        )
+    BeamSummary.add_uploaded_files(uploaded_files, connection=connection)
+
+
 class Key(BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String, nullable=False, unique=True)
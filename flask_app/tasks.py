@@ -1,14 +1,19 @@
 from __future__ import absolute_import
 
 import functools
+import hashlib
+import math
 import os
 import smtplib
-import subprocess
 import sys
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import timedelta
 from email.mime.text import MIMEText
-from typing import Any, Optional
+from queue import Empty, SimpleQueue
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
 
 import flux
 import logbook
@@ -17,18 +22,20 @@ import psutil
 from celery import Celery
 from celery.schedules import crontab
 from celery.signals import after_setup_logger, after_setup_task_logger, worker_init
-from flask import current_app
+from flask import Flask, current_app
 from jinja2 import Template
 from raven.contrib.celery import register_signal
-from sqlalchemy import case, extract, func, or_
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, case, exists, func, or_
+from sqlalchemy.orm import Query, joinedload
 
+from flask_app.utils.beam_orchestrator import LaunchCancelled, get_orchestrator
 from flask_app.utils.remote_combadge import RemoteCombadge
 from flask_app.utils.remote_host import RemoteHost
+from flask_app.utils.ssh_pool import get_pool
 
 from . import issue_trackers
-from .app import create_app, needs_app_context
-from .models import Beam, BeamType, File, Issue, Pin, Tracker, beam_issues, db
+from .app import create_app, get_or_create_app, needs_app_context
+from .models import Beam, File, Issue, Pin, ScrubBucketState, Tracker, beam_issues, db
 
 logger = logbook.Logger(__name__)
 
@@ -50,6 +57,10 @@ queue.conf.update(
             "task": "flask_app.tasks.check_free_space",
             "schedule": crontab(hour=10, minute=0),
         },
+        "vacuum-pressure": {
+            "task": "flask_app.tasks.check_vacuum_pressure",
+            "schedule": crontab(minute=30),
+        },
         "remind": {
             "task": "flask_app.tasks.remind_pinned",
             "schedule": crontab(hour=13, minute=0, day_of_week="sunday"),
@@ -92,15 +103,6 @@ Montgomery Scott
 """
 
 
-def _get_active_beams():
-    active_beams = (
-        db.session.query(Beam)
-        .filter(~Beam.pending_deletion, ~Beam.deleted)
-        .options(joinedload(Beam.files))
-    )
-    return active_beams
-
-
 @queue.task
 @needs_app_context
 def beam_up(
@@ -134,15 +136,52 @@ def beam_up(
             f"{beam_id}: Connected to {host}. Uploading combadge version: {combadge_version}"
         )
 
-        with RemoteHost(
+        idle_timeout = current_app.config["SSH_POOL_IDLE_TIMEOUT"]
+        remote_host = RemoteHost(
             host=host,
             username=username,
             auth_method=auth_method,
             pkey=pkey,
             password=password,
-        ) as remote_host, RemoteCombadge(
-            remote_host=remote_host, combadge_version=combadge_version
-        ) as remote_combadge:
+            pool=get_pool(idle_timeout) if idle_timeout is not None else None,
+        )
+        remote_combadge = RemoteCombadge(
+            remote_host=remote_host,
+            combadge_version=combadge_version,
+            cache=current_app.config["COMBADGE_CACHE"],
+            detach=current_app.config["COMBADGE_DETACH"],
+            streams=current_app.config["COMBADGE_STREAMS"],
+            compression_level=current_app.config["COMBADGE_COMPRESSION_LEVEL"],
+        )
+
+        if current_app.config["BEAM_UP_ASYNC"]:
+            # The orchestrator keeps watching the combadge after this task returns
+            get_orchestrator(current_app.config).submit(
+                host,
+                functools.partial(
+                    _launch_combadge,
+                    get_or_create_app(),
+                    remote_host,
+                    remote_combadge,
+                    beam_id=beam_id,
+                    directory=directory,
+                    transporter=transporter,
+                ),
+                functools.partial(
+                    _beam_up_failed,
+                    get_or_create_app(),
+                    beam_id,
+                    f"{beam_id} ({directory}) to {host} using combadge {combadge_version}",
+                ),
+            )
+            logger.info(f"{beam_id}: Handed over to the beam orchestrator")
+            return
+
+        if not _mark_launched(beam_id):
+            logger.info(f"{beam_id}: Completed before its combadge was launched")
+            return
+
+        with remote_host, remote_combadge:
             remote_combadge.run(beam_id=beam_id, directory=directory, transporter=transporter)
 
         logger.info(f"{beam_id}: Detached from combadge")
@@ -156,36 +195,135 @@ def beam_up(
             raise
 
 
-def vacuum_beam(beam: Beam, storage_path: str) -> None:
-    logger.info("Vacuuming {}".format(beam.id))
-    for f in beam.files:
-        if not f.storage_name:
-            continue
+def _mark_launched(beam_id: int) -> bool:
+    # mark_timeout waits for the combadge to contact the transporter from here on. A beam which
+    # was completed while it was waiting, e.g. failed by mark_timeout, is not launched anymore.
+    launched = (
+        db.session.query(Beam)
+        .filter_by(id=beam_id, completed=False)
+        .update(
+            {Beam.launched_at: flux.current_timeline.datetime.utcnow()},
+            synchronize_session=False,
+        )
+    )
+    db.session.commit()
+    return launched > 0
+
+
+def _launch_combadge(
+    app: Flask,
+    remote_host: RemoteHost,
+    remote_combadge: RemoteCombadge,
+    stack: ExitStack,
+    *,
+    beam_id: int,
+    **kwargs: Any,
+) -> paramiko.Channel:
+    # Called from the orchestrator's threads, possibly long after beam_up has returned
+    with app.app_context():
+        if not _mark_launched(beam_id):
+            raise LaunchCancelled(f"{beam_id}: Completed before its combadge was launched")
+    stack.enter_context(remote_host)
+    stack.enter_context(remote_combadge)
+    return remote_combadge.launch(beam_id=beam_id, **kwargs)
+
+
+def _beam_up_failed(app: Flask, beam_id: int, description: str, e: Exception) -> None:
+    # Called from the orchestrator's threads, after beam_up has returned
+    with app.app_context():
+        logger.error(f"Failed to beam up {description}: {e}")
+        beam = db.session.query(Beam).filter_by(id=beam_id).one()
+        beam.error = f"Failed to beam up {description}: {e}"
+        beam.set_completed(True)
+        db.session.commit()
+
+        if not isinstance(e, paramiko.ssh_exception.AuthenticationException):
+            current_app.raven.captureException(exc_info=(type(e), e, e.__traceback__))
 
-        path = os.path.join(storage_path, f.storage_name)
-        if os.path.exists(path):
-            logger.info("Deleting {}".format(path))
+
+def _unlink_files(storage_path: str, storage_names: List[str]) -> List[str]:
+    failed = []
+    for storage_name in storage_names:
+        path = os.path.join(storage_path, storage_name)
+        try:
             os.unlink(path)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.error("Failed deleting {}: {}", path, e)
+            failed.append(storage_name)
+        else:
+            logger.debug("Deleted {}", path)
+    return failed
+
+
+def vacuum_beam(beam: Beam, storage_path: str) -> None:
+    logger.info("Vacuuming {}".format(beam.id))
+    failed = _unlink_files(storage_path, [f.storage_name for f in beam.files if f.storage_name])
+    if failed:
+        raise Exception("Failed deleting files of beam {}: {}".format(beam.id, failed))
 
     logger.info("Vacuumed {} successfully".format(beam.id))
     beam.deleted = True
     db.session.commit()
 
 
+def _vacuum_batch(executor: ThreadPoolExecutor, storage_path: str, beam_ids: List[int]) -> int:
+    # Unlinks are grouped by storage directory, so each worker stays within a single directory
+    files_by_directory: defaultdict = defaultdict(list)
+    beams_by_storage_name = {}
+    files = db.session.query(File.beam_id, File.storage_name).filter(
+        File.beam_id.in_(beam_ids), File.storage_name.isnot(None)
+    )
+    for beam_id, storage_name in files:
+        files_by_directory[os.path.dirname(storage_name)].append(storage_name)
+        beams_by_storage_name[storage_name] = beam_id
+
+    failed_beams = set()
+    futures = [
+        executor.submit(_unlink_files, storage_path, storage_names)
+        for storage_names in files_by_directory.values()
+    ]
+    for future in futures:
+        for storage_name in future.result():
+            failed_beams.add(beams_by_storage_name[storage_name])
+
+    # Beams with files that failed to be deleted stay pending, and are retried by the next vacuum
+    vacuumed = [beam_id for beam_id in beam_ids if beam_id not in failed_beams]
+    if vacuumed:
+        db.session.query(Beam).filter(Beam.id.in_(vacuumed)).update(
+            dict(deleted=True), synchronize_session=False
+        )
+    db.session.commit()
+    return len(vacuumed)
+
+
 @queue.task
 @needs_app_context
 def mark_timeout() -> None:
+    now = flux.current_timeline.datetime.utcnow()
     timeout = timedelta(seconds=current_app.config["COMBADGE_CONTACT_TIMEOUT"])
-    timed_out = flux.current_timeline.datetime.utcnow() - timeout
+    queue_timeout = timedelta(seconds=current_app.config["BEAM_UP_QUEUE_TIMEOUT"])
+    # Beams whose combadge wasn't launched yet are still waiting for a worker or the orchestrator
     dead_beams = (
         db.session.query(Beam)
         .filter_by(completed=False)
-        .filter(~Beam.combadge_contacted, Beam.start < timed_out)
+        .filter(
+            ~Beam.combadge_contacted,
+            or_(
+                Beam.launched_at < now - timeout,
+                and_(Beam.launched_at.is_(None), Beam.start < now - queue_timeout),
+            ),
+        )
     )
     for beam in dead_beams:
-        logger.info("Combadge of {} did not contact for more than {}".format(beam.id, timeout))
+        if beam.launched_at is None:
+            logger.info("Combadge of {} was not launched for more than {}", beam.id, queue_timeout)
+            beam.error = "Combadge wasn't launched"
+        else:
+            logger.info("Combadge of {} did not contact for more than {}".format(beam.id, timeout))
+            beam.error = "Combadge didn't contact the transporter"
         beam.set_completed(True)
-        beam.error = "Combadge didn't contact the transporter"
 
     db.session.commit()
 
@@ -237,41 +375,53 @@ def remind_pinned() -> None:
 
 
 @needs_app_context
-def get_pending_query():
-    now = flux.current_timeline.datetime.utcnow()
-    days_factor = 60 * 60 * 24
-    beam_age_in_days = (
-        func.trunc(extract("epoch", now) - extract("epoch", Beam.start)) / days_factor
-    )
-    vacuum_threshold = case(
-        [
-            (Beam.type_id.is_(None), current_app.config["VACUUM_THRESHOLD"]),
-        ],
-        else_=BeamType.vacuum_threshold,
+def get_pending_query(threshold_shift: int = 0) -> Query:
+    # A positive threshold_shift makes beams eligible that many days before they expire
+    expired = Beam.expired_clause(current_app.config["VACUUM_THRESHOLD"], threshold_shift)
+    pinned = exists().where(Pin.beam_id == Beam.id)
+    has_open_issues = (
+        exists()
+        .where(beam_issues.c.beam_id == Beam.id)
+        .where(Issue.id == beam_issues.c.issue_id)
+        .where(Issue.open)
     )
+    has_files = exists().where(File.beam_id == Beam.id)
 
-    existing_open_issues = (
-        db.session.query(beam_issues.c.beam_id)
-        .join(Issue, Issue.id == beam_issues.c.issue_id)
-        .filter(beam_issues.c.beam_id == Beam.id, Issue.open)
-        .exists()
+    live_beams = db.session.query(Beam.id).filter(
+        ~Beam.pending_deletion, ~Beam.deleted, ~pinned, ~has_open_issues
     )
-
-    pending_query = (
-        db.session.query(Beam.id)
-        .outerjoin(Pin, Pin.beam_id == Beam.id)
-        .outerjoin(BeamType, BeamType.id == Beam.type_id)
-        .outerjoin(File, File.beam_id == Beam.id)
-        .filter(
-            ~Beam.pending_deletion,
-            ~Beam.deleted,
-            or_(Beam.completed, beam_age_in_days >= vacuum_threshold),
-            Pin.id.is_(None),
-            ~existing_open_issues,
-            or_(File.beam_id.is_(None), beam_age_in_days >= vacuum_threshold),
+    # Completed beams without files are vacuumed regardless of their age
+    return live_beams.filter(expired).union(live_beams.filter(Beam.completed, ~has_files))
+
+
+def _get_pressure_candidates() -> List[int]:
+    # Only the beams needed to get the storage back to VACUUM_TARGET_USED_PERCENT are chosen,
+    # the most overdue and then the largest ones first. If expired beams are not enough, beams
+    # which are up to VACUUM_PRESSURE_THRESHOLD_SHIFT days from expiring are considered as well.
+    usage = psutil.disk_usage(current_app.config["STORAGE_PATH"])
+    to_free = usage.used - usage.total * current_app.config["VACUUM_TARGET_USED_PERCENT"] / 100
+    logger.info("Storage is {}% used, {} bytes should be freed", usage.percent, max(to_free, 0))
+
+    candidates: List[int] = []
+    days_until_purge = Beam.days_until_purge_clause(current_app.config["VACUUM_THRESHOLD"])
+    for threshold_shift in sorted({0, current_app.config["VACUUM_PRESSURE_THRESHOLD_SHIFT"]}):
+        if to_free <= 0:
+            break
+
+        beams = (
+            db.session.query(Beam.id, Beam.size)
+            .filter(Beam.id.in_(get_pending_query(threshold_shift)), ~Beam.id.in_(candidates))
+            .order_by(days_until_purge, Beam.size.desc().nullslast(), Beam.id)
         )
-    )
-    return pending_query
+        for beam_id, size in beams:
+            if to_free <= 0:
+                break
+            candidates.append(beam_id)
+            to_free -= size or 0
+
+    if to_free > 0:
+        logger.warning("Not enough vacuum candidates, {} more bytes should be freed", to_free)
+    return candidates
 
 
 @queue.task
@@ -282,16 +432,37 @@ def vacuum() -> None:
     # Make sure that the storage folder is accessable. Whenever deploying scotty to somewhere, one
     # must create this empty file in the storage directory
     os.stat(os.path.join(current_app.config["STORAGE_PATH"], ".test"))
-    pending_query = get_pending_query()
-    db.session.query(Beam).filter(Beam.id.in_(pending_query)).update(
+    if current_app.config.get("VACUUM_TARGET_USED_PERCENT") is None:
+        candidates = Beam.id.in_(get_pending_query())
+    else:
+        candidates = Beam.id.in_(_get_pressure_candidates())
+    db.session.query(Beam).filter(candidates).update(
         dict(pending_deletion=True), synchronize_session="fetch"
     )
     db.session.commit()
     logger.info("Finished marking vacuum candidates")
 
-    to_delete = db.session.query(Beam).filter(Beam.pending_deletion, ~Beam.deleted)
-    for beam in to_delete:
-        vacuum_beam(beam, current_app.config["STORAGE_PATH"])
+    # pending_deletion is committed before any file is deleted, so beams left pending by an
+    # interrupted vacuum are picked up by the next one
+    storage_path = current_app.config["STORAGE_PATH"]
+    batch_size = current_app.config["VACUUM_BATCH_SIZE"]
+    vacuumed = 0
+    last_id = 0
+    with ThreadPoolExecutor(current_app.config["VACUUM_WORKERS"]) as executor:
+        while True:
+            beam_ids = [
+                beam_id
+                for (beam_id,) in db.session.query(Beam.id)
+                .filter(Beam.pending_deletion, ~Beam.deleted, Beam.id > last_id)
+                .order_by(Beam.id)
+                .limit(batch_size)
+            ]
+            if not beam_ids:
+                break
+
+            vacuumed += _vacuum_batch(executor, storage_path, beam_ids)
+            last_id = beam_ids[-1]
+            logger.info("Vacuumed {} beams so far (up to beam {})", vacuumed, last_id)
     logger.info("Vacuum done")
 
 
@@ -304,34 +475,138 @@ def delete_beam(beam_id: int) -> None:
     vacuum_beam(beam, current_app.config["STORAGE_PATH"])
 
 
+def _fetch_tracker_states(
+    tracker_id: int,
+    tracker_type: str,
+    url: str,
+    config: str,
+    issues: List[issue_trackers.IssueRef],
+    deadline: float,
+    results: SimpleQueue,
+) -> None:
+    tracker = issue_trackers.Tracker.create(tracker_type, url=url, config=config)
+    for states in tracker.fetch_states(issues, deadline):
+        results.put((tracker_id, states))
+
+
+# Issues are refreshed nightly, so one which is due minutes after the refresh shouldn't wait a day
+_ISSUE_REFRESH_SLACK = timedelta(hours=1)
+
+
+def _get_due_issues_clause(resolution_grace: timedelta) -> Any:
+    # Issues which were closed for longer than the resolution grace are not polled anymore, and
+    # issues which don't change are polled less and less often, up to ISSUE_REFRESH_MAX_INTERVAL
+    # days apart. Issues which are still open only because of the grace are polled once it ends.
+    now = flux.current_timeline.datetime.utcnow()
+    unchanged_for = Issue.last_checked - func.coalesce(Issue.last_changed, Issue.last_checked)
+    interval = func.least(
+        unchanged_for * current_app.config["ISSUE_REFRESH_BACKOFF"],
+        timedelta(days=current_app.config["ISSUE_REFRESH_MAX_INTERVAL"]),
+    )
+    return and_(
+        or_(Issue.open, Issue.resolved_at.is_(None), Issue.resolved_at >= now - resolution_grace),
+        or_(
+            Issue.last_checked.is_(None),
+            Issue.last_checked + interval < now + _ISSUE_REFRESH_SLACK,
+            and_(Issue.open, Issue.resolved_at + resolution_grace <= now),
+        ),
+    )
+
+
 @queue.task
 @needs_app_context
-def refresh_issue_trackers() -> None:
-    trackers = db.session.query(Tracker)
+def refresh_issue_trackers(tracker_id: Optional[int] = None, force: bool = False) -> None:
     active_beams_ids = db.session.query(Beam.id).filter(~Beam.pending_deletion, ~Beam.deleted)
     issues_of_active_beams = (
         db.session.query(beam_issues.c.issue_id)
         .filter(beam_issues.c.beam_id.in_(active_beams_ids))
         .distinct()
     )
+    trackers = db.session.query(Tracker)
+    if tracker_id is not None:
+        trackers = trackers.filter_by(id=tracker_id)
+    trackers = trackers.all()
+
+    issues_by_tracker = defaultdict(list)
     for tracker in trackers:
-        logger.info(
-            "Refreshing tracker {} - {} of type {}",
-            tracker.id,
-            tracker.url,
-            tracker.type,
+        issues = db.session.query(Issue.id, Issue.id_in_tracker).filter(
+            Issue.id.in_(issues_of_active_beams), Issue.tracker_id == tracker.id
         )
-        try:
-            issues = (
-                db.session.query(Issue)
-                .filter(Issue.id.in_(issues_of_active_beams))
-                .filter_by(tracker_id=tracker.id)
+        if not force:
+            resolution_grace = timedelta(days=issue_trackers.get_resolution_grace(tracker.config))
+            issues = issues.filter(_get_due_issues_clause(resolution_grace))
+        issues_by_tracker[tracker.id] = issues.all()
+
+    # Trackers are queried concurrently, each until the deadline, while their results are
+    # written to the database from this thread as they arrive
+    deadline = time.monotonic() + current_app.config["TRACKER_REFRESH_TIMEOUT"]
+    results: SimpleQueue = SimpleQueue()
+    refreshed: Dict[int, int] = defaultdict(int)
+
+    def write_states(
+        refreshed_tracker_id: int, states: Dict[int, issue_trackers.IssueState]
+    ) -> None:
+        Issue.update_states(states)
+        db.session.commit()
+        refreshed[refreshed_tracker_id] += len(states)
+
+    # The executor isn't used as a context manager, which would wait for trackers stuck in a
+    # request past the deadline
+    executor = ThreadPoolExecutor(current_app.config["TRACKER_REFRESH_WORKERS"])
+    futures = {}
+    try:
+        for tracker in trackers:
+            logger.info(
+                "Refreshing {} issues of tracker {} - {} of type {}",
+                len(issues_by_tracker[tracker.id]),
+                tracker.id,
+                tracker.url,
+                tracker.type,
+            )
+            futures[tracker.id] = executor.submit(
+                _fetch_tracker_states,
+                tracker.id,
+                tracker.type,
+                tracker.url,
+                tracker.config,
+                issues_by_tracker[tracker.id],
+                deadline,
+                results,
             )
-            issue_trackers.refresh(tracker, issues)
-        except Exception:
-            current_app.raven.captureException()
 
-        db.session.commit()
+        while not all(future.done() for future in futures.values()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                write_states(*results.get(timeout=min(remaining, 0.1)))
+            except Empty:
+                pass
+
+        # Every finished tracker has already put all of its results, so once the queue is empty
+        # nothing of theirs is left. Results of trackers still running past the deadline are lost.
+        while True:
+            try:
+                write_states(*results.get_nowait())
+            except Empty:
+                break
+    finally:
+        executor.shutdown(wait=False)
+
+    for tracker in trackers:
+        logger.info(
+            "Refreshed {} of {} issues of tracker {}",
+            refreshed[tracker.id],
+            len(issues_by_tracker[tracker.id]),
+            tracker.id,
+        )
+        future = futures[tracker.id]
+        if not future.done():
+            logger.warning("Tracker {} did not finish before the deadline", tracker.id)
+            continue
+        error = future.exception()
+        if error is not None:
+            current_app.raven.captureException(exc_info=(type(error), error, error.__traceback__))
 
 
 @queue.task
@@ -360,100 +635,332 @@ def vacuum_check() -> None:
             os.unlink(full_path)
 
 
+_CHECKSUM_CHUNK_SIZE = 4 * 1024 * 1024
+_VALIDATION_COMMIT_SIZE = 1000
+
+
 def _checksum(path: str) -> str:
-    return (
-        subprocess.check_output([current_app.config["SHA512SUM"], path])
-        .decode("utf-8")
-        .split(" ")[0]
-    )
+    # Checksums are computed by the transporter over the bytes it received, so files are hashed
+    # exactly as stored, whether or not the storage name ends with .gz. hashlib releases the GIL
+    # while hashing large chunks, which lets the validation threads run in parallel.
+    digest = hashlib.sha512()
+    with open(path, "rb", buffering=0) as f:
+        for chunk in iter(functools.partial(f.read, _CHECKSUM_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-@queue.task
-@needs_app_context
-def validate_checksum() -> None:
-    storage_path = current_app.config["STORAGE_PATH"]
+def _validate_file(path: str, expected: str) -> Optional[str]:
+    try:
+        checksum = _checksum(path)
+    except OSError as e:
+        return "Failed reading {}: {}".format(path, e)
+    if checksum != expected:
+        return "Expected checksum of {} is {}. Got {} instead".format(path, expected, checksum)
+    return None
 
+
+def _get_validation_candidates(budget: int) -> List[Tuple[int, str, str]]:
     files = (
-        File.query.join(Beam)
+        db.session.query(File.id, File.storage_name, File.checksum, File.size)
+        .join(Beam)
         .filter(
             ~Beam.pending_deletion,
             ~Beam.deleted,
             File.checksum.isnot(None),
             File.status == "uploaded",
         )
-        .order_by(File.last_validated)
-        .limit(100)
+        .order_by(File.last_validated.asc().nullsfirst(), File.id)
+        .execution_options(stream_results=True)
+        .yield_per(_VALIDATION_COMMIT_SIZE)
     )
 
-    for file_ in files:
-        assert not file_.beam.deleted
-        assert not file_.beam.pending_deletion
-        full_path = os.path.join(storage_path, file_.storage_name)
-        checksum = _checksum(full_path)
-        assert checksum == file_.checksum, "Expected checksum of {} is {}. Got {} instead".format(
-            full_path, file_.checksum, checksum
-        )
-        logger.info("{} validated (last validated: {})".format(full_path, file_.last_validated))
-        file_.last_validated = flux.current_timeline.datetime.utcnow()
-
+    candidates: List[Tuple[int, str, str]] = []
+    total_size = 0
+    for file_id, storage_name, checksum, size in files:
+        if candidates and total_size + (size or 0) > budget:
+            break
+        candidates.append((file_id, storage_name, checksum))
+        total_size += size or 0
+    logger.info("Validating {} files ({} bytes)", len(candidates), total_size)
+    return candidates
+
+
+def _mark_validated(file_ids: List[int]) -> None:
+    db.session.query(File).filter(File.id.in_(file_ids)).update(
+        {File.last_validated: flux.current_timeline.datetime.utcnow()},
+        synchronize_session=False,
+    )
     db.session.commit()
 
 
 @queue.task
 @needs_app_context
-def scrub() -> None:
-    logger.info("Scrubbing intiated")
+def validate_checksum() -> None:
+    storage_path = current_app.config["STORAGE_PATH"]
+    budget = current_app.config["CHECKSUM_VALIDATION_BYTES_PER_NIGHT"]
+    candidates = _get_validation_candidates(budget)
+    db.session.commit()
+
     errors = []
+    validated: List[int] = []
+    with ThreadPoolExecutor(current_app.config["CHECKSUM_VALIDATION_WORKERS"]) as executor:
+        results = executor.map(
+            lambda candidate: _validate_file(
+                os.path.join(storage_path, candidate[1]), candidate[2]
+            ),
+            candidates,
+        )
+        for (file_id, _, _), error in zip(candidates, results):
+            if error is not None:
+                logger.error(error)
+                errors.append(error)
+                continue
+
+            validated.append(file_id)
+            if len(validated) >= _VALIDATION_COMMIT_SIZE:
+                _mark_validated(validated)
+                validated = []
+
+    if validated:
+        _mark_validated(validated)
+    logger.info("Checksum validation done. {} failures", len(errors))
+
+    if errors:
+        raise Exception(errors)
+
+
+_SCRUB_BATCH_SIZE = 10000
+
+
+def _storage_order(entry: os.DirEntry) -> str:
+    # Directories are sorted as if their names ended with a slash, the way the paths in them compare
+    return entry.name + "/" if entry.is_dir(follow_symlinks=False) else entry.name
+
+
+def _scan_directory(path: str, relative_path: str) -> List[Tuple[str, int]]:
+    with os.scandir(path) as it:
+        entries = sorted(it, key=_storage_order)
+
+    files = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            files.extend(_scan_directory(entry.path, relative_path + entry.name + "/"))
+        else:
+            files.append((relative_path + entry.name, entry.stat(follow_symlinks=False).st_size))
+    return files
+
+
+def _iter_storage(
+    executor: ThreadPoolExecutor, storage_path: str, buckets: Set[str], window: int
+) -> Iterator[Tuple[str, int]]:
+    # Yields (storage name, size) of the stored files in sorted order. Only the given bucket
+    # directories are scanned, in parallel and up to window buckets ahead of the consumer.
+    with os.scandir(storage_path) as it:
+        entries = sorted(
+            (e for e in it if not e.is_dir(follow_symlinks=False) or e.name in buckets),
+            key=_storage_order,
+        )
+
+    pending: Deque[Future] = deque()
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            pending.append(executor.submit(_scan_directory, entry.path, entry.name + "/"))
+        else:
+            scanned: Future = Future()
+            scanned.set_result([(entry.name, entry.stat(follow_symlinks=False).st_size)])
+            pending.append(scanned)
+
+        while len(pending) > window:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def _get_bucket(storage_name: str) -> str:
+    return storage_name.split("/", 1)[0] if "/" in storage_name else ""
+
+
+def _count_bucket_files(
+    files: Iterator[Tuple[str, int]], disk_stats: Dict[str, List[int]]
+) -> Iterator[Tuple[str, int]]:
+    for storage_name, size in files:
+        bucket_stats = disk_stats[_get_bucket(storage_name)]
+        bucket_stats[0] += 1
+        bucket_stats[1] += size
+        yield storage_name, size
+
+
+def _get_changed_buckets(
+    storage_path: str, active_files: Any, bucket_clause: Any, full: bool
+) -> Tuple[Set[str], Dict[str, int]]:
+    # A bucket is scrubbed when its directory was modified, or its files in the database changed
+    # since it was last scrubbed. On top of that, the buckets which were not scrubbed for the
+    # longest time are scrubbed, so that all of them are verified every SCRUB_FULL_INTERVAL_DAYS.
+    with os.scandir(storage_path) as it:
+        mtimes = {
+            e.name: e.stat(follow_symlinks=False).st_mtime_ns
+            for e in it
+            if e.is_dir(follow_symlinks=False)
+        }
+    db_stats = {
+        bucket: (file_count, total_bytes)
+        for bucket, file_count, total_bytes in active_files.with_entities(
+            bucket_clause, func.count(), func.coalesce(func.sum(File.size), 0)
+        )
+        .filter(File.storage_name.isnot(None))
+        .group_by(bucket_clause)
+    }
+    states = {state.bucket: state for state in db.session.query(ScrubBucketState)}
+
+    all_buckets = (set(mtimes) | set(db_stats) | set(states)) - {""}
+    if full:
+        return all_buckets, mtimes
+
+    unchanged = [
+        states[bucket]
+        for bucket in all_buckets
+        if bucket in states
+        and states[bucket].mtime_ns == mtimes.get(bucket)
+        and (states[bucket].file_count, states[bucket].total_bytes) == db_stats.get(bucket, (0, 0))
+    ]
+    rotation = math.ceil(len(all_buckets) / current_app.config["SCRUB_FULL_INTERVAL_DAYS"])
+    unchanged.sort(key=lambda state: state.last_scrubbed)
+    buckets = all_buckets - {state.bucket for state in unchanged[rotation:]}
+    logger.info("Scrubbing {} of {} buckets", len(buckets), len(all_buckets))
+    return buckets, mtimes
+
+
+def _save_bucket_states(
+    buckets: Set[str], mtimes: Dict[str, int], disk_stats: Dict[str, List[int]]
+) -> None:
+    now = flux.current_timeline.datetime.utcnow()
+    db.session.query(ScrubBucketState).filter(ScrubBucketState.bucket.notin_(list(mtimes))).delete(
+        synchronize_session=False
+    )
+    for bucket in buckets & set(mtimes):
+        file_count, total_bytes = disk_stats.get(bucket, (0, 0))
+        db.session.merge(
+            ScrubBucketState(
+                bucket=bucket,
+                mtime_ns=mtimes[bucket],
+                file_count=file_count,
+                total_bytes=total_bytes,
+                last_scrubbed=now,
+            )
+        )
+
 
+@queue.task
+@needs_app_context
+def scrub(full: bool = False) -> None:
+    logger.info("Scrubbing intiated")
     storage_path = current_app.config["STORAGE_PATH"]
+    errors = 0
 
-    expected_files = set()
-    active_beams = _get_active_beams()
-    for beam in active_beams:
-        for beam_file in beam.files:
-            if not beam_file.storage_name and not beam_file.size:
-                errors.append(
-                    "{} has no storage name and a size greated than 0".format(beam_file.id)
-                )
-                beam_file.size = 0
-                continue
+    def _report(message: str) -> None:
+        nonlocal errors
+        errors += 1
+        logger.error(message)
 
-            if not beam_file.storage_name:
-                continue
+    active_files = (
+        db.session.query(File.id, File.storage_name, File.size)
+        .join(Beam)
+        .filter(~Beam.pending_deletion, ~Beam.deleted)
+    )
 
-            full_path = os.path.join(storage_path, beam_file.storage_name)
-            expected_files.add(full_path)
-            if not os.path.exists(full_path):
-                errors.append("{} ({}) does not exist".format(full_path, beam_file.id))
-                continue
+    without_storage = [
+        file_id for file_id, _, _ in active_files.filter(File.storage_name.is_(None), File.size > 0)
+    ]
+    for file_id in without_storage:
+        _report("{} has no storage name and a size greater than 0".format(file_id))
+    if without_storage:
+        db.session.query(File).filter(File.id.in_(without_storage)).update(
+            {File.size: 0}, synchronize_session=False
+        )
 
-            file_info = os.stat(full_path)
-            if file_info.st_size != beam_file.size:
-                errors.append(
-                    "Size of {} ({}) is {} bytes on the disk but {} bytes in the database".format(
-                        full_path, beam_file.id, file_info.st_size, beam_file.size
+    # Files outside of bucket directories are always scrubbed
+    bucket_clause = case(
+        [(func.strpos(File.storage_name, "/") > 0, func.split_part(File.storage_name, "/", 1))],
+        else_="",
+    )
+    buckets, mtimes = _get_changed_buckets(storage_path, active_files, bucket_clause, full)
+    disk_stats: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+
+    # Both the database and the storage are walked in sorted order and merged, so neither of them
+    # has to be held in memory. COLLATE "C" compares the same way Python compares strings.
+    stored_files = (
+        active_files.filter(File.storage_name.isnot(None))
+        .filter(or_(bucket_clause == "", bucket_clause.in_(buckets)))
+        .order_by(File.storage_name.collate("C"), File.id)
+        .execution_options(stream_results=True)
+        .yield_per(_SCRUB_BATCH_SIZE)
+    )
+    fixed_sizes = {}
+    workers = current_app.config["SCRUB_WORKERS"]
+    with ThreadPoolExecutor(workers) as executor:
+        db_files = iter(stored_files)
+        disk_files = _count_bucket_files(
+            _iter_storage(executor, storage_path, buckets, workers * 2), disk_stats
+        )
+        db_file = next(db_files, None)
+        disk_file = next(disk_files, None)
+        while db_file is not None or disk_file is not None:
+            if disk_file is None or (db_file is not None and db_file[1] < disk_file[0]):
+                full_path = os.path.join(storage_path, db_file[1])
+                _report("{} ({}) does not exist".format(full_path, db_file[0]))
+                db_file = next(db_files, None)
+            elif db_file is None or disk_file[0] < db_file[1]:
+                # The storage must contain this empty file, see vacuum
+                if disk_file[0] != ".test":
+                    full_path = os.path.join(storage_path, disk_file[0])
+                    _report("Unexpected files {}".format(full_path))
+                disk_file = next(disk_files, None)
+            else:
+                file_id, storage_name, size = db_file
+                if disk_file[1] != size:
+                    _report(
+                        "Size of {} ({}) is {} bytes on the disk but {} bytes in the database".format(
+                            os.path.join(storage_path, storage_name), file_id, disk_file[1], size
+                        )
                     )
-                )
-                beam_file.size = file_info.st_size
+                    fixed_sizes[file_id] = disk_file[1]
+                db_file = next(db_files, None)
+                disk_file = next(disk_files, None)
 
-        sum_size = sum(f.size for f in beam.files if f.size is not None)
-        if beam.size != sum_size:
-            errors.append(
-                "Size of beam {} is {}, but the sum of its file sizes is {}".format(
-                    beam.id, beam.size, sum_size
-                )
-            )
-            beam.size = sum_size
+    for file_id, size in fixed_sizes.items():
+        db.session.query(File).filter_by(id=file_id).update(
+            {File.size: size}, synchronize_session=False
+        )
 
-    for root, _, files in os.walk(storage_path):
-        for file_ in files:
-            full_path = os.path.join(root, file_)
-            if full_path not in expected_files:
-                errors.append("Unexpected files {}".format(full_path))
+    file_sizes = (
+        db.session.query(File.beam_id, func.coalesce(func.sum(File.size), 0).label("size"))
+        .join(Beam)
+        .filter(~Beam.pending_deletion, ~Beam.deleted)
+        .group_by(File.beam_id)
+        .subquery()
+    )
+    wrong_sizes = (
+        db.session.query(Beam.id, Beam.size, func.coalesce(file_sizes.c.size, 0))
+        .outerjoin(file_sizes, file_sizes.c.beam_id == Beam.id)
+        .filter(~Beam.pending_deletion, ~Beam.deleted)
+        .filter(Beam.size.is_distinct_from(func.coalesce(file_sizes.c.size, 0)))
+    )
+    for beam_id, beam_size, sum_size in wrong_sizes.all():
+        _report(
+            "Size of beam {} is {}, but the sum of its file sizes is {}".format(
+                beam_id, beam_size, sum_size
+            )
+        )
+        db.session.query(Beam).filter_by(id=beam_id).update(
+            {Beam.size: sum_size}, synchronize_session=False
+        )
 
+    _save_bucket_states(buckets, mtimes, disk_stats)
+    db.session.commit()
+    logger.info("Scrubbing done. {} errors", errors)
     if errors:
-        db.session.commit()
-        raise Exception(errors)
+        raise Exception("Scrub found {} errors, see the log for details".format(errors))
 
 
 @queue.task
@@ -468,6 +975,23 @@ def check_free_space() -> None:
         current_app.raven.captureMessage("Used space is {}%".format(percent))
 
 
+@queue.task
+@needs_app_context
+def check_vacuum_pressure() -> None:
+    # Runs every hour, so that with a target the used space stays within the FREE_SPACE_THRESHOLD /
+    # VACUUM_TARGET_USED_PERCENT band instead of waiting for the nightly vacuum
+    if (
+        current_app.config.get("VACUUM_TARGET_USED_PERCENT") is None
+        or "FREE_SPACE_THRESHOLD" not in current_app.config
+    ):
+        return
+
+    percent = psutil.disk_usage(current_app.config["STORAGE_PATH"]).percent
+    if percent >= current_app.config["FREE_SPACE_THRESHOLD"]:
+        logger.info("Used space is {}%, starting a vacuum", percent)
+        vacuum.delay()
+
+
 @queue.task
 @needs_app_context
 @testing_method
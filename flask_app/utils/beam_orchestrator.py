@@ -0,0 +1,127 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+import logbook
+from paramiko import Channel
+
+logger = logbook.Logger(__name__)
+
+# Opens everything a beam needs on the given stack and returns the channel of the running combadge
+Launcher = Callable[[ExitStack], Channel]
+ErrorHandler = Callable[[Exception], None]
+
+_OUTPUT_TAIL_BYTES = 64 * 1024
+
+
+class LaunchCancelled(Exception):
+    # Raised by launchers for beams which shouldn't be launched anymore. Not reported as an error.
+    pass
+
+
+class _HostSlots:
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0
+
+
+class BeamOrchestrator:
+    # Runs many beams from a single event loop thread. Connecting and uploading the combadge are
+    # blocking paramiko calls, which run in a small thread pool. Waiting for the combadge to exit,
+    # which is most of a beam's lifetime, polls its channel from the loop and holds no thread.
+
+    def __init__(
+        self,
+        *,
+        max_beams: int,
+        max_beams_per_host: int,
+        launch_workers: int,
+        poll_interval: float,
+    ):
+        self._max_beams = max_beams
+        self._max_beams_per_host = max_beams_per_host
+        self._poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(launch_workers, thread_name_prefix="beam-launch")
+        self._loop = asyncio.new_event_loop()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._host_slots: Dict[str, _HostSlots] = {}
+        threading.Thread(
+            target=self._loop.run_forever, name="beam-orchestrator", daemon=True
+        ).start()
+
+    def submit(self, host: str, launch: Launcher, on_error: ErrorHandler) -> Future:
+        return asyncio.run_coroutine_threadsafe(self._run_beam(host, launch, on_error), self._loop)
+
+    def _get_host_slots(self, host: str) -> _HostSlots:
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = _HostSlots(self._max_beams_per_host)
+        return slots
+
+    async def _run_beam(self, host: str, launch: Launcher, on_error: ErrorHandler) -> None:
+        # Semaphores are created here so they belong to the orchestrator's loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_beams)
+        host_slots = self._get_host_slots(host)
+        host_slots.users += 1
+        try:
+            # A beam waiting for its host doesn't take one of the global slots
+            async with host_slots.semaphore, self._semaphore:
+                await self._beam(launch)
+        except LaunchCancelled as e:
+            logger.info(str(e))
+        except Exception as e:  # pylint: disable=broad-except
+            await self._loop.run_in_executor(self._executor, on_error, e)
+        finally:
+            host_slots.users -= 1
+            if host_slots.users == 0:
+                del self._host_slots[host]
+
+    async def _beam(self, launch: Launcher) -> None:
+        stack = ExitStack()
+        try:
+            channel = await self._loop.run_in_executor(self._executor, launch, stack)
+            await self._wait(channel)
+        finally:
+            await self._loop.run_in_executor(self._executor, stack.close)
+
+    async def _wait(self, channel: Channel) -> None:
+        output: List[bytes] = []
+        while True:
+            # Output is drained so the remote side never blocks on a full channel window
+            while channel.recv_ready():
+                output.append(channel.recv(_OUTPUT_TAIL_BYTES))
+            while channel.recv_stderr_ready():
+                output.append(channel.recv_stderr(_OUTPUT_TAIL_BYTES))
+            del output[:-2]
+            if channel.exit_status_ready():
+                break
+            await asyncio.sleep(self._poll_interval)
+
+        status = channel.recv_exit_status()
+        if status != 0:
+            tail = b"".join(output)[-_OUTPUT_TAIL_BYTES:].decode(errors="replace").strip()
+            raise RuntimeError(f"Combadge exited with status {status}:\n{tail}")
+
+
+_orchestrator: Optional[BeamOrchestrator] = None
+_orchestrator_pid: Optional[int] = None
+_orchestrator_lock = threading.Lock()
+
+
+def get_orchestrator(config: Mapping[str, Any]) -> BeamOrchestrator:
+    # Event loops and threads don't survive a fork, so every worker process starts its own
+    global _orchestrator, _orchestrator_pid  # pylint: disable=global-statement
+    with _orchestrator_lock:
+        if _orchestrator is None or _orchestrator_pid != os.getpid():
+            _orchestrator = BeamOrchestrator(
+                max_beams=config["BEAM_UP_MAX_BEAMS"],
+                max_beams_per_host=config["BEAM_UP_MAX_BEAMS_PER_HOST"],
+                launch_workers=config["BEAM_UP_LAUNCH_WORKERS"],
+                poll_interval=config["BEAM_UP_POLL_INTERVAL"],
+            )
+            _orchestrator_pid = os.getpid()
+    return _orchestrator
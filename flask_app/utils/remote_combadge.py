@@ -1,15 +1,26 @@
+import functools
+import hashlib
 import os
+import re
+import shlex
 import stat
 from pathlib import PureWindowsPath
+from typing import Optional
 from uuid import uuid4
 
 import logbook
-from paramiko import SSHException
+from paramiko import Channel, SFTPAttributes, SSHException
 
 from flask_app.paths import get_combadge_path
 from flask_app.utils.remote_host import RemoteHost
 
 _COMBADGE_UUID_PART_LENGTH = 10
+_COMBADGE_DIGEST_PART_LENGTH = 16
+_CACHED_COMBADGE_PATTERN = re.compile(r"^combadge_[0-9a-f]{16}(\.exe)?$")
+_SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+# Outdated cached combadges which were used more recently than this are kept, as a beam may be
+# about to run them
+_STALE_COMBADGE_GRACE_SECONDS = 60 * 60
 DEFAULT_COMBADGE_VERSION = (
     "v1"  # the current version (v2) is not the default because it's not as stable as v1
 )
@@ -18,21 +29,50 @@ DEFAULT_COMBADGE_VERSION = (
 logger = logbook.Logger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _get_combadge_digest(path: str, mtime_ns: int, size: int) -> str:
+    # The modification time and size are part of the cache key, so a replaced combadge is hashed again
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class RemoteCombadge:
-    def __init__(self, *, remote_host: RemoteHost, combadge_version: str):
+    def __init__(
+        self,
+        *,
+        remote_host: RemoteHost,
+        combadge_version: str,
+        cache: bool = False,
+        detach: bool = False,
+        streams: int = 1,
+        compression_level: Optional[int] = None,
+    ):
         self._combadge_version = combadge_version
         self._remote_host = remote_host
-        self._remote_combadge_path = None
+        self._remote_combadge_path: Optional[str] = None
         self._sftp = None
+        # Cached combadges are named after their content and left on the host for the next beams.
+        # v1 removes itself when it's done, so it is never cached.
+        self._cache = cache and combadge_version != "v1"
+        # A detached v2 combadge outlives the SSH session and removes itself when it's done.
+        # v1 already daemonizes itself.
+        self._detach = detach and combadge_version == "v2"
+        # Parallel uploads and the compression level are only supported by v1
+        self._streams = streams
+        self._compression_level = compression_level
 
     def _generate_random_combadge_name(self, string_length: int) -> str:
         random_string = str(uuid4().hex)[:string_length]
         return f"combadge_{random_string}"
 
-    def _get_remote_combadge_path(self):
-        combadge_name = self._generate_random_combadge_name(
-            string_length=_COMBADGE_UUID_PART_LENGTH
-        )
+    def _get_remote_combadge_path(self, combadge_name=None):
+        if combadge_name is None:
+            combadge_name = self._generate_random_combadge_name(
+                string_length=_COMBADGE_UUID_PART_LENGTH
+            )
         remote_combadge_dir = self._remote_host.get_temp_dir()
         if self._remote_host.get_os_type() == "windows":
             combadge_name = f"{combadge_name}.exe"
@@ -44,6 +84,13 @@ class RemoteCombadge:
         logger.debug(f"combadge path: {remote_combadge_path}")
         return remote_combadge_path
 
+    def _put_combadge(self, local_combadge_path, remote_combadge_path):
+        self._sftp.put(local_combadge_path, remote_combadge_path)
+        if self._remote_host.get_os_type() != "windows":
+            combadge_st = os.stat(local_combadge_path)
+            mode = (combadge_st.st_mode | stat.S_IEXEC) & ~(stat.S_IWGRP | stat.S_IWOTH)
+            self._sftp.chmod(remote_combadge_path, mode)
+
     def _upload_combadge(self):
         os_type = self._remote_host.get_os_type()
 
@@ -51,19 +98,124 @@ class RemoteCombadge:
         assert os.path.exists(
             local_combadge_path
         ), f"Combadge at {local_combadge_path} does not exist"
-        remote_combadge_path = self._get_remote_combadge_path()
+        self._sftp = self._remote_host.get_sftp_client()
+        if self._cache and self._upload_cached_combadge(local_combadge_path):
+            return
 
+        remote_combadge_path = self._get_remote_combadge_path()
         logger.info(
             f"uploading combadge {self._combadge_version} for {os_type} to {remote_combadge_path}"
         )
-        self._sftp = self._remote_host.get_sftp_client()
-        self._sftp.put(local_combadge_path, remote_combadge_path)
-        if os_type != "windows":
-            combadge_st = os.stat(local_combadge_path)
-            self._sftp.chmod(remote_combadge_path, combadge_st.st_mode | stat.S_IEXEC)
+        self._put_combadge(local_combadge_path, remote_combadge_path)
+        self._remote_combadge_path = remote_combadge_path
+
+    def _is_own_file(self, attributes: SFTPAttributes) -> bool:
+        # Temp directories are shared on POSIX hosts, so only files which this user uploaded and
+        # which nobody else can write to are trusted. Windows temp directories are per user.
+        if self._remote_host.get_os_type() == "windows":
+            return True
+        return attributes.st_uid == self._remote_host.get_uid() and not (
+            attributes.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+        )
+
+    def _upload_cached_combadge(self, local_combadge_path):
+        # Returns False if the combadge can't be cached, and should be uploaded as usual
+        local_st = os.stat(local_combadge_path)
+        digest = _get_combadge_digest(local_combadge_path, local_st.st_mtime_ns, local_st.st_size)
+        remote_combadge_path = self._get_remote_combadge_path(
+            f"combadge_{digest[:_COMBADGE_DIGEST_PART_LENGTH]}"
+        )
+        try:
+            cached_st = self._sftp.stat(remote_combadge_path)
+        except FileNotFoundError:
+            pass
+        else:
+            if not self._is_own_file(cached_st):
+                # Someone else could have planted it, and it can't be replaced
+                logger.warn(f"{remote_combadge_path} is not ours, not caching the combadge")
+                self._cache = False
+                return False
+            if (
+                cached_st.st_size == local_st.st_size
+                and self._get_remote_digest(remote_combadge_path) == digest
+            ):
+                logger.info(f"using cached combadge {remote_combadge_path}")
+                self._touch_remote_file(remote_combadge_path)
+                self._remote_combadge_path = remote_combadge_path
+                return True
+
+        # The combadge is uploaded under a temporary name and renamed into place, so that beams
+        # running at the same time never see a partial upload
+        temp_path = self._get_remote_combadge_path()
+        logger.info(f"uploading combadge {self._combadge_version} to cache {remote_combadge_path}")
+        self._put_combadge(local_combadge_path, temp_path)
+        try:
+            self._sftp.posix_rename(temp_path, remote_combadge_path)
+        except (IOError, SSHException):
+            # Windows servers don't support the posix-rename extension
+            self._remove_remote_file(remote_combadge_path)
+            self._sftp.rename(temp_path, remote_combadge_path)
         self._remote_combadge_path = remote_combadge_path
+        self._remove_stale_combadges(remote_combadge_path)
+        return True
+
+    def _get_remote_digest(self, path: str) -> Optional[str]:
+        # Returns None if the host has no way to hash the file, which means it can't be trusted
+        if self._remote_host.get_os_type() == "windows":
+            command = f'certutil -hashfile "{path}" SHA256'
+        else:
+            quoted_path = shlex.quote(path)
+            command = f"sha256sum {quoted_path} 2>/dev/null || shasum -a 256 {quoted_path}"
+        output = self._remote_host.exec_ssh_command(command, raise_on_failure=False)
+        # sha256sum and shasum print the digest before the path, certutil on a line of its own,
+        # with spaces between the bytes on older versions
+        for line in (output or "").splitlines():
+            match = _SHA256_PATTERN.match(line.replace(" ", "").lower())
+            if match:
+                return match.group()
+        logger.warn(f"Failed to hash {path}: {output}")
+        return None
+
+    def _touch_remote_file(self, path):
+        # Marks a cached combadge as used, so that it isn't removed as stale under a running beam
+        try:
+            self._sftp.utime(path, None)
+        except (IOError, SSHException) as e:
+            logger.warn(f"Failed to touch {path}: {e}")
+
+    def _remove_stale_combadges(self, remote_combadge_path):
+        # Only done after uploading a new combadge, which means that the cached ones are outdated.
+        # Times are compared to the upload time of the new one, so only the host's clock matters.
+        current_name = re.split(r"[\\/]", remote_combadge_path)[-1]
+        remote_dir = remote_combadge_path[: -len(current_name)]
+        entries = self._sftp.listdir_attr(remote_dir)
+        uploaded_at = next(
+            (entry.st_mtime for entry in entries if entry.filename == current_name), None
+        )
+        if uploaded_at is None:
+            return
+        for entry in entries:
+            if (
+                entry.filename != current_name
+                and _CACHED_COMBADGE_PATTERN.match(entry.filename)
+                and self._is_own_file(entry)
+                and entry.st_mtime < uploaded_at - _STALE_COMBADGE_GRACE_SECONDS
+            ):
+                logger.info(f"removing outdated combadge {entry.filename}")
+                self._remove_remote_file(remote_dir + entry.filename)
+
+    def _remove_remote_file(self, path):
+        try:
+            self._sftp.remove(path)
+        except FileNotFoundError:
+            pass
+        except (IOError, SSHException) as e:
+            # A combadge which is still running can't be removed on Windows
+            logger.warn(f"Failed to remove {path}: {e}")
 
     def _remove_combadge(self):
+        if self._cache or self._detach:
+            return
         if self._remote_combadge_path is not None and self._sftp is not None:
             try:
                 self._sftp.remove(self._remote_combadge_path)
@@ -83,16 +235,55 @@ class RemoteCombadge:
         if self._sftp is not None:
             self._sftp.close()
 
-    def run(self, *, beam_id: int, directory: str, transporter: str) -> None:
-        combadge_commands = {
-            "v1": f'{self._remote_combadge_path} {beam_id} "{directory}" "{transporter}"',
-            "v2": f"{self._remote_combadge_path} -b {beam_id} -p {directory} -t {transporter}",
-        }
-        combadge_command = combadge_commands[self._combadge_version]
+    def _get_command(self, *, beam_id: int, directory: str, transporter: str) -> str:
+        combadge_path = self._remote_combadge_path
+        assert combadge_path is not None, "The combadge was not uploaded"
+        combadge_args = {
+            "v1": f'{beam_id} "{directory}" "{transporter}"',
+            "v2": f"-b {beam_id} -p {directory} -t {transporter}",
+        }[self._combadge_version]
+        if self._combadge_version == "v1":
+            if self._streams > 1:
+                combadge_args = f"{combadge_args} --streams {self._streams}"
+            if self._compression_level is not None:
+                combadge_args = f"{combadge_args} --compression-level {self._compression_level}"
         os_type = self._remote_host.get_os_type()
+        if self._detach:
+            return self._get_detached_command(combadge_path, combadge_args, os_type)
+        combadge_command = f"{combadge_path} {combadge_args}"
         if os_type != "windows" and self._combadge_version == "v2":
             combadge_command = f"RUST_LOG=trace {combadge_command}"
-        self._remote_host.exec_ssh_command(combadge_command)
+        return combadge_command
+
+    def _get_detached_command(self, combadge_path: str, combadge_args: str, os_type: str) -> str:
+        # Only v2 combadges are detached
+        if os_type == "windows":
+            combadge_command = f'"{combadge_path}" {combadge_args}'
+            if not self._cache:
+                combadge_command = f'{combadge_command} & del "{combadge_path}"'
+            # With /s, cmd only strips the outermost quotes, leaving the quoted paths intact
+            return f'cmd /c start "" /b cmd /s /c "{combadge_command}"'
+        quoted_path = shlex.quote(combadge_path)
+        combadge_command = f"RUST_LOG=trace {quoted_path} {combadge_args}"
+        if not self._cache:
+            combadge_command = f"{combadge_command}; rm -f {quoted_path}"
+        # setsid is part of util-linux and missing on other systems, where nohup has to do
+        setsid = "setsid " if os_type == "linux" else ""
+        return (
+            f"{setsid}nohup sh -c {shlex.quote(combadge_command)} " "> /dev/null 2>&1 < /dev/null &"
+        )
+
+    def run(self, *, beam_id: int, directory: str, transporter: str) -> None:
+        self._remote_host.exec_ssh_command(
+            self._get_command(beam_id=beam_id, directory=directory, transporter=transporter)
+        )
+
+    def launch(self, *, beam_id: int, directory: str, transporter: str) -> Channel:
+        # Starts the combadge without waiting for it to exit
+        _, stdout, _ = self._remote_host.raw_exec_ssh_command(
+            self._get_command(beam_id=beam_id, directory=directory, transporter=transporter)
+        )
+        return stdout.channel
 
     def ping(self):
         _, stdout, stderr = self._remote_host.raw_exec_ssh_command(self._remote_combadge_path)
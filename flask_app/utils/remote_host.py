@@ -1,9 +1,11 @@
-import functools
 from io import StringIO
+from typing import Dict, Optional
 
 import logbook
 from paramiko import AuthenticationException, AutoAddPolicy, PKey, RSAKey, SFTPClient, SSHClient
 
+from flask_app.utils.ssh_pool import PooledConnection, SSHPool, get_auth_fingerprint
+
 logger = logbook.Logger(__name__)
 
 
@@ -17,23 +19,62 @@ def create_key(s: str) -> PKey:
 class RemoteHost:
     _TEMPDIR_COMMAND = "python -c 'import tempfile; print(tempfile.gettempdir())'"
 
-    def __init__(self, *, host, username, auth_method, pkey=None, password=None):
+    _DISABLED_ALGORITHMS = {
+        "keys": ["rsa-sha2-256", "rsa-sha2-512"],
+        "pubkeys": ["rsa-sha2-256", "rsa-sha2-512"],
+    }
+
+    def __init__(
+        self,
+        *,
+        host: str,
+        username: str,
+        auth_method: str,
+        pkey: Optional[str] = None,
+        password: Optional[str] = None,
+        port: int = 22,
+        pool: Optional[SSHPool] = None,
+    ) -> None:
         self._host = host
+        self._port = port
         self._username = username
         self._auth_method = auth_method
         self._pkey = pkey
         self._password = password
         self._ssh_client = None
+        self._pool = pool
+        self._pool_key = (host, port, username, get_auth_fingerprint(auth_method, pkey, password))
+        self._connection: Optional[PooledConnection] = None
+
+    def _get_host_info(self) -> Dict[str, str]:
+        if self._connection is None:
+            raise RuntimeError(f"Not connected to {self._host}")
+        return self._connection.host_info
 
-    @functools.lru_cache(maxsize=None)
     def get_os_type(self) -> str:
-        return (self.exec_ssh_command("uname", raise_on_failure=False) or "windows").lower()
+        host_info = self._get_host_info()
+        if "os_type" not in host_info:
+            host_info["os_type"] = (
+                self.exec_ssh_command("uname", raise_on_failure=False) or "windows"
+            ).lower()
+        return host_info["os_type"]
 
     def get_temp_dir(self) -> str:
-        try:
-            return self.exec_ssh_command(self._TEMPDIR_COMMAND)
-        except RuntimeError:
-            return self.exec_ssh_command(self._TEMPDIR_COMMAND.replace("python", "python3"))
+        host_info = self._get_host_info()
+        if "temp_dir" not in host_info:
+            try:
+                host_info["temp_dir"] = self.exec_ssh_command(self._TEMPDIR_COMMAND)
+            except RuntimeError:
+                host_info["temp_dir"] = self.exec_ssh_command(
+                    self._TEMPDIR_COMMAND.replace("python", "python3")
+                )
+        return host_info["temp_dir"]
+
+    def get_uid(self) -> int:
+        host_info = self._get_host_info()
+        if "uid" not in host_info:
+            host_info["uid"] = self.exec_ssh_command("id -u")
+        return int(host_info["uid"])
 
     def exec_ssh_command(self, command, raise_on_failure=True):
         _, stdout, stderr = self.raw_exec_ssh_command(command)
@@ -62,33 +103,50 @@ class RemoteHost:
         return SFTPClient.from_transport(self._ssh_client.get_transport())
 
     def close(self):
-        if self._ssh_client is not None:
-            self._ssh_client.close()
+        if self._connection is None:
+            return
+        if self._pool is not None:
+            self._pool.release(self._connection)
+        else:
+            self._connection.close()
+        self._connection = self._ssh_client = None
 
-    def __enter__(self):
-        self._ssh_client = ssh_client = SSHClient()
+    def _connect(self) -> SSHClient:
+        ssh_client = SSHClient()
         ssh_client.set_missing_host_key_policy(AutoAddPolicy())
 
         kwargs = {"username": self._username, "look_for_keys": False}
         if self._auth_method in ("rsa", "stored_key"):
+            if self._pkey is None:
+                raise ValueError(f"No key given for auth method {self._auth_method}")
             kwargs["pkey"] = create_key(self._pkey)
         elif self._auth_method == "password":
             kwargs["password"] = self._password
         else:
             raise ValueError(f"Invalid auth method: {self._auth_method}")
+        if self._port != 22:
+            kwargs["port"] = self._port
+
+        # Hosts which needed the fallback before are connected to with it right away
+        if self._pool is not None and self._pool.needs_fallback(self._pool_key):
+            ssh_client.connect(self._host, disabled_algorithms=self._DISABLED_ALGORITHMS, **kwargs)
+            return ssh_client
 
         try:
-            self._ssh_client.connect(self._host, **kwargs)
+            ssh_client.connect(self._host, **kwargs)
         except AuthenticationException:
-            self._ssh_client.connect(
-                self._host,
-                disabled_algorithms={
-                    "keys": ["rsa-sha2-256", "rsa-sha2-512"],
-                    "pubkeys": ["rsa-sha2-256", "rsa-sha2-512"],
-                },
-                **kwargs,
-            )
+            ssh_client.connect(self._host, disabled_algorithms=self._DISABLED_ALGORITHMS, **kwargs)
+            if self._pool is not None:
+                self._pool.set_needs_fallback(self._pool_key)
 
+        return ssh_client
+
+    def __enter__(self):
+        if self._pool is not None:
+            self._connection = self._pool.acquire(self._pool_key)
+        if self._connection is None:
+            self._connection = PooledConnection(self._pool_key, self._connect())
+        self._ssh_client = self._connection.client
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
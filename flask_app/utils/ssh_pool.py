@@ -0,0 +1,122 @@
+import hashlib
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import logbook
+from paramiko import SSHClient
+
+logger = logbook.Logger(__name__)
+
+# (host, port, username, auth fingerprint)
+PoolKey = Tuple[str, int, str, str]
+
+
+def get_auth_fingerprint(auth_method: str, pkey: Optional[str], password: Optional[str]) -> str:
+    secret = pkey if auth_method in ("rsa", "stored_key") else password
+    return hashlib.sha256(f"{auth_method}:{secret}".encode()).hexdigest()
+
+
+class PooledConnection:
+    def __init__(self, key: PoolKey, client: SSHClient):
+        self.key = key
+        self.client = client
+        # Results of probing the host (OS type, temp dir), which are valid as long as the
+        # connection is
+        self.host_info: Dict[str, str] = {}
+        self.last_used = time.monotonic()
+
+    def is_active(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self) -> None:
+        self.client.close()
+
+
+class SSHPool:
+    def __init__(self, idle_timeout: float):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle: Dict[PoolKey, List[PooledConnection]] = defaultdict(list)
+        self._fallback_keys: Set[PoolKey] = set()
+        # Closes idle connections while no beams are sent, and exits once there are none left
+        self._reaper: Optional[threading.Thread] = None
+
+    def acquire(self, key: PoolKey) -> Optional[PooledConnection]:
+        self._close_idle()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection = idle.pop()
+                if connection.is_active():
+                    logger.debug(f"reusing connection to {key[2]}@{key[0]}:{key[1]}")
+                    return connection
+                connection.close()
+        return None
+
+    def release(self, connection: PooledConnection) -> None:
+        connection.last_used = time.monotonic()
+        if not connection.is_active():
+            connection.close()
+            return
+        with self._lock:
+            self._idle[connection.key].append(connection)
+            if self._reaper is None:
+                self._reaper = threading.Thread(
+                    target=self._reap, name="ssh-pool-reaper", daemon=True
+                )
+                self._reaper.start()
+
+    def needs_fallback(self, key: PoolKey) -> bool:
+        return key in self._fallback_keys
+
+    def set_needs_fallback(self, key: PoolKey) -> None:
+        self._fallback_keys.add(key)
+
+    def _reap(self) -> None:
+        # Connections are closed at most twice the idle timeout after they were last used
+        while True:
+            time.sleep(self.idle_timeout)
+            self._close_idle()
+            with self._lock:
+                if not any(self._idle.values()):
+                    self._reaper = None
+                    return
+
+    def _close_idle(self) -> None:
+        expired: List[PooledConnection] = []
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            for idle in self._idle.values():
+                expired.extend(c for c in idle if c.last_used < deadline)
+                idle[:] = [c for c in idle if c.last_used >= deadline]
+        for connection in expired:
+            host, port, username, _ = connection.key
+            logger.debug(f"closing idle connection to {username}@{host}:{port}")
+            connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for connection in connections:
+            connection.close()
+
+
+_pool: Optional[SSHPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(idle_timeout: float) -> SSHPool:
+    # One pool per worker process. Connections must not be shared with forked children.
+    global _pool, _pool_pid  # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = SSHPool(idle_timeout)
+            _pool_pid = os.getpid()
+        _pool.idle_timeout = idle_timeout
+    return _pool
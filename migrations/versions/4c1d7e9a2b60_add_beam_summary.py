@@ -0,0 +1,51 @@
+"""add beam summary
+
+Revision ID: 4c1d7e9a2b60
+Revises: 27bc2f86a2b3
+Create Date: 2026-10-18 10:12:41.830217
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c1d7e9a2b60'
+down_revision = '27bc2f86a2b3'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('beam_summary',
+    sa.Column('beam_id', sa.Integer(), nullable=False),
+    sa.Column('tags', postgresql.ARRAY(sa.String()), server_default='{}', nullable=False),
+    sa.Column('pinners', postgresql.ARRAY(sa.Integer()), server_default='{}', nullable=False),
+    sa.Column('issues', postgresql.ARRAY(sa.Integer()), server_default='{}', nullable=False),
+    sa.Column('has_open_issues', sa.Boolean(), server_default='false', nullable=False),
+    sa.Column('type_name', sa.String(), nullable=True),
+    sa.Column('file_count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['beam_id'], ['beam.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('beam_id')
+    )
+    op.execute("""
+        INSERT INTO beam_summary (beam_id, tags, pinners, issues, has_open_issues, type_name, file_count)
+        SELECT beam.id,
+               array(SELECT tag.tag FROM tag WHERE tag.beam_id = beam.id ORDER BY tag.id),
+               array(SELECT pin.user_id FROM pin WHERE pin.beam_id = beam.id ORDER BY pin.id),
+               array(SELECT beam_issues.issue_id FROM beam_issues WHERE beam_issues.beam_id = beam.id),
+               EXISTS (SELECT 1 FROM beam_issues JOIN issue ON issue.id = beam_issues.issue_id
+                       WHERE beam_issues.beam_id = beam.id AND issue.open),
+               (SELECT beam_type.name FROM beam_type WHERE beam_type.id = beam.type_id),
+               (SELECT count(*) FROM file WHERE file.beam_id = beam.id AND file.status = 'uploaded')
+        FROM beam
+    """)
+    op.create_index('ix_beam_summary_tags', 'beam_summary', ['tags'], unique=False, postgresql_using='gin')
+    op.create_index('ix_beam_summary_issues', 'beam_summary', ['issues'], unique=False, postgresql_using='gin')
+    op.create_index('ix_beam_summary_pinned', 'beam_summary', ['beam_id'], unique=False, postgresql_where=sa.text('cardinality(pinners) > 0'))
+
+
+def downgrade():
+    op.drop_index('ix_beam_summary_pinned', table_name='beam_summary')
+    op.drop_index('ix_beam_summary_issues', table_name='beam_summary')
+    op.drop_index('ix_beam_summary_tags', table_name='beam_summary')
+    op.drop_table('beam_summary')
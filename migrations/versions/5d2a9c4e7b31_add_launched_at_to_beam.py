@@ -0,0 +1,22 @@
+"""add launched_at to beam
+
+Revision ID: 5d2a9c4e7b31
+Revises: e19b5f3c8a40
+Create Date: 2026-10-18 23:52:04.118327
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2a9c4e7b31'
+down_revision = 'e19b5f3c8a40'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('beam', sa.Column('launched_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('beam', 'launched_at')
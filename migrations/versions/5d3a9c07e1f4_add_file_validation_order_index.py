@@ -0,0 +1,24 @@
+"""add file validation order index
+
+Revision ID: 5d3a9c07e1f4
+Revises: 8f2e5b31d7c4
+Create Date: 2026-10-18 19:12:40.118274
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d3a9c07e1f4'
+down_revision = '8f2e5b31d7c4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_file_validation_order', 'file', [sa.text('last_validated ASC NULLS FIRST'), 'id'], unique=False, postgresql_where=sa.text("status = 'uploaded' AND checksum IS NOT NULL"))
+    op.drop_index('ix_file_last_validated', table_name='file')
+
+
+def downgrade():
+    op.create_index('ix_file_last_validated', 'file', ['last_validated'], unique=False)
+    op.drop_index('ix_file_validation_order', table_name='file')
@@ -0,0 +1,31 @@
+"""add file name search indexes
+
+Revision ID: 8f2e5b31d7c4
+Revises: 4c1d7e9a2b60
+Create Date: 2026-10-18 11:02:17.403958
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f2e5b31d7c4'
+down_revision = '4c1d7e9a2b60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_file_beam_id_file_name_pattern', 'file', ['beam_id', 'file_name'], unique=False, postgresql_ops={'file_name': 'text_pattern_ops'})
+
+    # Substring searches need pg_trgm, which is not shipped with every PostgreSQL installation
+    has_trgm = op.get_bind().execute(
+        sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    ).scalar()
+    if has_trgm:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.create_index('ix_file_file_name_trgm', 'file', ['file_name'], unique=False, postgresql_using='gin', postgresql_ops={'file_name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS ix_file_file_name_trgm')
+    op.drop_index('ix_file_beam_id_file_name_pattern', table_name='file')
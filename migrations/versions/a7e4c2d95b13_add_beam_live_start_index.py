@@ -0,0 +1,22 @@
+"""add beam live start index
+
+Revision ID: a7e4c2d95b13
+Revises: 5d3a9c07e1f4
+Create Date: 2026-10-18 20:03:51.602187
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a7e4c2d95b13'
+down_revision = '5d3a9c07e1f4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_beam_live_start', 'beam', ['start'], unique=False, postgresql_where=sa.text('NOT deleted AND NOT pending_deletion'))
+
+
+def downgrade():
+    op.drop_index('ix_beam_live_start', table_name='beam')
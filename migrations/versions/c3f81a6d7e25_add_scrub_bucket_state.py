@@ -0,0 +1,29 @@
+"""add scrub bucket state
+
+Revision ID: c3f81a6d7e25
+Revises: a7e4c2d95b13
+Create Date: 2026-10-18 21:26:09.774310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3f81a6d7e25'
+down_revision = 'a7e4c2d95b13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('scrub_bucket_state',
+    sa.Column('bucket', sa.String(), nullable=False),
+    sa.Column('mtime_ns', sa.BigInteger(), nullable=False),
+    sa.Column('file_count', sa.Integer(), nullable=False),
+    sa.Column('total_bytes', sa.BigInteger(), nullable=False),
+    sa.Column('last_scrubbed', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('bucket')
+    )
+
+
+def downgrade():
+    op.drop_table('scrub_bucket_state')
@@ -0,0 +1,26 @@
+"""add issue refresh state
+
+Revision ID: e19b5f3c8a40
+Revises: c3f81a6d7e25
+Create Date: 2026-10-18 22:41:15.209583
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e19b5f3c8a40'
+down_revision = 'c3f81a6d7e25'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('issue', sa.Column('last_checked', sa.DateTime(), nullable=True))
+    op.add_column('issue', sa.Column('last_changed', sa.DateTime(), nullable=True))
+    op.add_column('issue', sa.Column('resolved_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('issue', 'resolved_at')
+    op.drop_column('issue', 'last_changed')
+    op.drop_column('issue', 'last_checked')
@@ -1,11 +1,19 @@
 # pylint: disable=redefined-outer-name
 import datetime
+import hashlib
 import io
+import json
 import os
 import pathlib
+import re
+import shlex
 import shutil
 import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import mock
+from urllib.parse import parse_qs, urlparse
 from uuid import UUID
 
 import flask_migrate
@@ -199,6 +207,12 @@ class MockSSHClient:
                     )
                 )
                 self.exit_status = 1
+        elif command == "id -u":
+            self.stdout.write(b"1000")
+        elif command.startswith("sha256sum "):
+            path = shlex.split(command)[1]
+            with open(MockSFTPClient.files[path]["local"], "rb") as f:
+                self.stdout.write(f"{hashlib.sha256(f.read()).hexdigest()}  {path}".encode())
         elif command == _TEMPDIR_COMMAND:
             if self.os_type == "linux":
                 self.stdout.write(b"/tmp")
@@ -251,7 +265,7 @@ class MockSFTPClient:
         return cls()
 
     def put(self, local, remote):
-        self.files[remote] = dict(local=local)
+        self.files[remote] = dict(local=local, uid=1000, mode=0o100644, mtime=time.time())
         self.calls.append(dict(action="put", args=dict(local=local, remote=remote)))
 
     def remove(self, remote):
@@ -263,6 +277,36 @@ class MockSFTPClient:
         self.files[remote]["mode"] = mode
         self.calls.append(dict(action="chmod", args=dict(remote=remote, mode=mode)))
 
+    def stat(self, remote):
+        if remote not in self.files:
+            raise FileNotFoundError(remote)
+        return self._attributes(remote)
+
+    def _attributes(self, remote):
+        file_ = self.files[remote]
+        return munch.Munch(
+            filename=remote.rsplit("/", 1)[-1],
+            st_size=os.path.getsize(file_["local"]),
+            st_uid=file_.get("uid", 1000),
+            st_mode=file_.get("mode", 0o100755),
+            st_mtime=file_.get("mtime", 0),
+        )
+
+    def utime(self, remote, times):
+        self.files[remote]["mtime"] = time.time()
+        self.calls.append(dict(action="utime", args=dict(remote=remote)))
+
+    def posix_rename(self, old, new):
+        self.files[new] = self.files.pop(old)
+        self.calls.append(dict(action="posix_rename", args=dict(old=old, new=new)))
+
+    def listdir_attr(self, path):
+        return [
+            self._attributes(remote)
+            for remote in self.files
+            if remote.startswith(path) and "/" not in remote[len(path) :]
+        ]
+
     def __enter__(self):
         return self
 
@@ -353,3 +397,77 @@ def beam_with_real_file(db_session):
     db_session.add(beam)
     db_session.commit()
     return beam
+
+
+class _StubJIRAHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        self.server.requests.append(url.path)
+        if url.path == "/rest/api/2/serverInfo":
+            self._reply({"version": "8.0.0", "versionNumbers": [8, 0, 0]})
+        elif url.path == "/rest/api/2/field":
+            self._reply([])
+        elif url.path == "/rest/api/2/search":
+            keys = re.findall(r'"([^"]+)"', parse_qs(url.query)["jql"][0])
+            self.server.searched.extend(keys)
+            found = [self._issue(key) for key in keys if self._issue(key) is not None]
+            self._reply(
+                {"startAt": 0, "maxResults": len(keys), "total": len(found), "issues": found}
+            )
+        elif url.path.startswith("/rest/api/2/issue/"):
+            issue = self._issue(url.path.rsplit("/", 1)[-1])
+            if issue is None:
+                self._reply({"errorMessages": ["Issue does not exist"]}, status=404)
+            else:
+                self._reply(issue)
+        else:
+            self._reply({"errorMessages": ["Not found"]}, status=404)
+
+    def _issue(self, key):
+        # Moved issues are found by their old key, but come back under their new one
+        key = self.server.moved.get(key.upper(), key.upper())
+        if key not in self.server.issues:
+            return None
+        return {"id": key, "key": key, "fields": {"resolutiondate": self.server.issues[key]}}
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def jira_server():
+    # A local stand-in for the JIRA REST API. Maps issue keys to their resolution date and old keys
+    # of moved issues to their new ones, and records the paths of the requests it got and the keys
+    # it was searched for
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubJIRAHandler)
+    server.issues = {}
+    server.moved = {}
+    server.requests = []
+    server.searched = []
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def jira_tracker(db_session, jira_server):
+    tracker = Tracker(
+        config=json.dumps({"username": "user", "password": "password"}),
+        name="stub-jira",
+        type="jira",
+        url=jira_server.url,
+    )
+    db_session.add(tracker)
+    db_session.commit()
+    return tracker
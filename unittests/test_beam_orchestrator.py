@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from flask_app.utils.beam_orchestrator import BeamOrchestrator, LaunchCancelled
+
+
+class FakeChannel:
+    def __init__(self, status=0, output=b""):
+        self.status = status
+        self.output = output
+        self.done = threading.Event()
+
+    def recv_ready(self):
+        return bool(self.output)
+
+    def recv(self, size):
+        data, self.output = self.output[:size], self.output[size:]
+        return data
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        return self.done.is_set()
+
+    def recv_exit_status(self):
+        return self.status
+
+
+class Tracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.closed = 0
+
+    def launcher(self, host, channel):
+        def launch(stack):
+            with self.lock:
+                self.running[host] = self.running.get(host, 0) + 1
+                self.running["*"] = self.running.get("*", 0) + 1
+                for key in (host, "*"):
+                    self.max_running[key] = max(self.max_running.get(key, 0), self.running[key])
+            stack.callback(self._close, host)
+            return channel
+
+        return launch
+
+    def _close(self, host):
+        with self.lock:
+            self.running[host] -= 1
+            self.running["*"] -= 1
+            self.closed += 1
+
+
+@pytest.fixture
+def orchestrator():
+    return BeamOrchestrator(max_beams=3, max_beams_per_host=2, launch_workers=2, poll_interval=0.01)
+
+
+def test_orchestrator_limits_concurrency(orchestrator):
+    tracker = Tracker()
+    channels = [FakeChannel() for _ in range(8)]
+    errors = []
+    futures = [
+        orchestrator.submit(
+            f"host{i % 2}", tracker.launcher(f"host{i % 2}", channel), errors.append
+        )
+        for i, channel in enumerate(channels)
+    ]
+
+    # Far more beams than launch workers are waiting on their combadges at the same time
+    time.sleep(0.2)
+    assert tracker.running["*"] == 3
+    for channel in channels:
+        channel.done.set()
+    for future in futures:
+        future.result(timeout=5)
+
+    assert errors == []
+    assert tracker.closed == 8
+    assert tracker.max_running["*"] == 3
+    assert tracker.max_running["host0"] == 2
+    assert tracker.max_running["host1"] == 2
+
+
+def test_orchestrator_reports_failures(orchestrator):
+    tracker = Tracker()
+    failed = FakeChannel(status=1, output=b"disk on fire")
+    failed.done.set()
+    errors = []
+
+    def broken_launch(stack):
+        raise RuntimeError("cannot connect")
+
+    def cancelled_launch(stack):
+        raise LaunchCancelled("beam was completed")
+
+    orchestrator.submit("host", tracker.launcher("host", failed), errors.append).result(timeout=5)
+    orchestrator.submit("host", broken_launch, errors.append).result(timeout=5)
+    # Cancelled launches are not errors
+    orchestrator.submit("host", cancelled_launch, errors.append).result(timeout=5)
+
+    assert tracker.closed == 1
+    assert [str(e) for e in errors] == [
+        "Combadge exited with status 1:\ndisk on fire",
+        "cannot connect",
+    ]
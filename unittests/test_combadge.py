@@ -0,0 +1,223 @@
+import gzip
+import importlib.util
+import os
+import socket
+import struct
+import threading
+
+import pytest
+
+_COMBADGE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "webapp", "public", "assets", "combadge.py"
+)
+
+
+@pytest.fixture
+def combadge(monkeypatch, transporter):
+    spec = importlib.util.spec_from_file_location("combadge", _COMBADGE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "_TRANSPORTER_PORT", transporter.port)
+    return module
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _recv(sock, fmt):
+    return struct.unpack(fmt, _recv_exactly(sock, struct.calcsize(fmt)))
+
+
+class FakeTransporter:
+    def __init__(self):
+        self.files = {}
+        self.connections = []
+        self.completed = 0
+        self._handlers = []
+        self._lock = threading.Lock()
+        self._socket = socket.socket()
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen()
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            handler = threading.Thread(target=self._handle, args=(client,), daemon=True)
+            handler.start()
+            self._handlers.append(handler)
+
+    def _handle(self, client):
+        with client:
+            try:
+                self._beam_loop(client)
+            except EOFError:
+                # The combadge disconnected without completing the beam
+                pass
+
+    def _beam_loop(self, client):
+        [beam_id] = _recv(client, "!Q")
+        with self._lock:
+            self.connections.append(beam_id)
+        while True:
+            [message] = _recv(client, "!B")
+            if message == 4:
+                _recv(client, "!H")
+            elif message == 1:
+                [length] = _recv(client, "!H")
+                name = _recv_exactly(client, length).decode()
+                client.sendall(struct.pack("!B", 1))
+                _recv(client, "!Q")
+                self.files[name] = self._receive_file(client)
+                client.sendall(struct.pack("!B", 2))
+            elif message == 0:
+                with self._lock:
+                    self.completed += 1
+                return
+            else:
+                raise AssertionError(f"Unexpected message {message}")
+
+    def _receive_file(self, client):
+        data = b""
+        while True:
+            [message] = _recv(client, "!B")
+            if message == 3:
+                return data
+            assert message == 2
+            [length] = _recv(client, "!L")
+            data += _recv_exactly(client, length)
+
+    def wait(self):
+        for handler in self._handlers:
+            handler.join(timeout=5)
+
+    def close(self):
+        self._socket.close()
+
+
+@pytest.fixture
+def transporter():
+    server = FakeTransporter()
+    yield server
+    server.close()
+
+
+def _make_beam_dir(tmpdir, count):
+    contents = {}
+    for i in range(count):
+        subdir = tmpdir.join(f"dir{i % 3}").ensure(dir=True)
+        content = f"line {i}\n".encode() * (i + 1) * 100
+        subdir.join(f"file{i}.log").write_binary(content)
+        contents[f"./dir{i % 3}/file{i}.log.gz"] = content
+    return contents
+
+
+@pytest.mark.parametrize("streams", [1, 4])
+def test_beam_up_streams(combadge, transporter, tmpdir, streams):
+    contents = _make_beam_dir(tmpdir, 20)
+    combadge.beam_up(42, str(tmpdir), "127.0.0.1", streams=streams)
+    transporter.wait()
+
+    assert transporter.connections == [42] * streams
+    assert transporter.completed == streams
+    assert {name: gzip.decompress(data) for name, data in transporter.files.items()} == contents
+
+
+def test_failed_stream_aborts_beam(combadge, transporter, tmpdir, monkeypatch):
+    _make_beam_dir(tmpdir, 20)
+    beam_file = combadge._beam_file
+    beamed = []
+
+    def flaky_beam_file(transporter_socket, base_path, path, **kwargs):
+        if len(beamed) == 3:
+            raise RuntimeError("disk error")
+        beamed.append(path)
+        beam_file(transporter_socket, base_path, path, **kwargs)
+
+    monkeypatch.setattr(combadge, "_beam_file", flaky_beam_file)
+    with pytest.raises(RuntimeError, match="disk error"):
+        combadge._beam_up(42, str(tmpdir), "127.0.0.1", streams=4)
+    transporter.wait()
+
+    assert len(beamed) < 20
+    assert transporter.completed == 0
+
+
+def _count_pipelines(combadge, monkeypatch):
+    pipelines = []
+    pipeline_class = combadge._Pipeline
+
+    def pipeline(source):
+        pipelines.append(source)
+        return pipeline_class(source)
+
+    monkeypatch.setattr(combadge, "_Pipeline", pipeline)
+    return pipelines
+
+
+def test_large_file_is_pipelined(combadge, transporter, tmpdir, monkeypatch):
+    monkeypatch.setattr(combadge, "_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(combadge, "_SAMPLE_SIZE", 1024)
+    pipelines = _count_pipelines(combadge, monkeypatch)
+    content = b"x" * 100 * 1024 + os.urandom(100 * 1024)
+    tmpdir.join("core").write_binary(content)
+    tmpdir.join("core.zip").write_binary(content)
+    combadge.beam_up(42, str(tmpdir), "127.0.0.1")
+    transporter.wait()
+
+    assert gzip.decompress(transporter.files["./core.gz"]) == content
+    assert transporter.files["./core.zip"] == content
+    assert len(pipelines) == 2
+
+
+def test_small_files_are_sent_directly(combadge, transporter, tmpdir, monkeypatch):
+    pipelines = _count_pipelines(combadge, monkeypatch)
+    contents = _make_beam_dir(tmpdir, 10)
+    tmpdir.join("empty").write_binary(b"")
+    combadge.beam_up(42, str(tmpdir), "127.0.0.1")
+    transporter.wait()
+
+    assert {name: gzip.decompress(data) for name, data in transporter.files.items()} == dict(
+        contents, **{"./empty.gz": b""}
+    )
+    assert pipelines == []
+
+
+def test_pipeline_stage_failure(combadge):
+    def failing_source():
+        yield b"a"
+        raise IOError("read error")
+
+    pipeline = combadge._Pipeline(failing_source())
+    pipeline.add_stage(combadge._gzip_chunks)
+    with pytest.raises(IOError, match="read error"):
+        list(pipeline)
+    pipeline.close()
+
+
+@pytest.mark.parametrize("compression_level", [0, 1, 9])
+def test_compression_policy(combadge, transporter, tmpdir, compression_level):
+    text = b"scotty " * 100000
+    binary = os.urandom(100000)
+    tmpdir.join("text").write_binary(text)
+    tmpdir.join("binary").write_binary(binary)
+    combadge.beam_up(42, str(tmpdir), "127.0.0.1", compression_level=compression_level)
+    transporter.wait()
+
+    # Incompressible data is sent as is, under a name without .gz
+    assert transporter.files["./binary"] == binary
+    if compression_level == 0:
+        assert transporter.files["./text"] == text
+    else:
+        assert gzip.decompress(transporter.files["./text.gz"]) == text
@@ -0,0 +1,168 @@
+import datetime
+import threading
+import time
+
+from flask import current_app
+
+from flask_app import issue_trackers
+from flask_app.models import BeamSummary, Issue, Tracker
+from flask_app.tasks import refresh_issue_trackers
+
+
+def test_jira_refresh_in_chunks(
+    eager_celery, db_session, create_beam, jira_server, jira_tracker, monkeypatch
+):
+    monkeypatch.setattr(issue_trackers, "_SEARCH_CHUNK_SIZE", 2)
+    jira_server.issues = {
+        "PROJ-1": None,
+        "PROJ-2": "2000-01-01T00:00:00.000+0000",
+        "PROJ-3": None,
+    }
+    beam = create_beam()
+    issues = []
+    for key, is_open in [("PROJ-1", False), ("proj-2", True), ("PROJ-3", True), ("PROJ-4", True)]:
+        issue = Issue(tracker_id=jira_tracker.id, id_in_tracker=key, open=is_open)
+        beam.issues.append(issue)
+        issues.append(issue)
+    resolved_beam = create_beam(add_file=False)
+    resolved_beam.issues.append(issues[1])
+    db_session.commit()
+    assert db_session.query(BeamSummary).filter_by(beam_id=resolved_beam.id).one().has_open_issues
+
+    refresh_issue_trackers.delay()
+    for issue in issues:
+        db_session.refresh(issue)
+    assert [issue.open for issue in issues] == [True, False, True, True]
+    assert jira_server.requests.count("/rest/api/2/search") == 2
+    assert "/rest/api/2/issue/PROJ-1" not in jira_server.requests
+    assert db_session.query(BeamSummary).filter_by(beam_id=beam.id).one().has_open_issues
+    summary = db_session.query(BeamSummary).filter_by(beam_id=resolved_beam.id).one()
+    db_session.refresh(summary)
+    assert not summary.has_open_issues
+
+
+def _create_issue(db_session, beam, tracker, key, is_open):
+    issue = Issue(tracker_id=tracker.id, id_in_tracker=key, open=is_open)
+    beam.issues.append(issue)
+    db_session.commit()
+    return issue
+
+
+def test_jira_refresh_moved_issue(eager_celery, db_session, create_beam, jira_server, jira_tracker):
+    jira_server.issues = {"NEW-7": "2000-01-01T00:00:00.000+0000"}
+    jira_server.moved = {"OLD-1": "NEW-7"}
+    beam = create_beam()
+    moved = _create_issue(db_session, beam, jira_tracker, "OLD-1", True)
+    missing = _create_issue(db_session, beam, jira_tracker, "OLD-2", True)
+
+    refresh_issue_trackers.delay()
+    db_session.refresh(moved)
+    db_session.refresh(missing)
+    assert not moved.open
+    assert moved.last_checked is not None
+    assert missing.last_checked is None
+    assert "/rest/api/2/issue/OLD-1" in jira_server.requests
+
+
+def test_refresh_trackers_concurrently(
+    eager_celery, db_session, create_beam, jira_server, jira_tracker, monkeypatch
+):
+    faulty_tracker = Tracker(name="faulty", type="faulty", url="faulty", config="{}")
+    db_session.add(faulty_tracker)
+    jira_server.issues = {"PROJ-1": None}
+    beam = create_beam()
+    jira_issue = _create_issue(db_session, beam, jira_tracker, "PROJ-1", False)
+    faulty_issue = _create_issue(db_session, beam, faulty_tracker, "1", True)
+    captured = []
+    monkeypatch.setattr(
+        current_app.raven, "captureException", lambda exc_info: captured.append(exc_info[1])
+    )
+
+    # A failing tracker does not prevent the results of the others from being written
+    refresh_issue_trackers.delay()
+    db_session.refresh(jira_issue)
+    db_session.refresh(faulty_issue)
+    assert jira_issue.open
+    assert faulty_issue.open
+    assert [str(error) for error in captured] == ["Tracker Error"]
+
+
+def test_refresh_trackers_deadline(
+    eager_celery, db_session, create_beam, jira_server, jira_tracker, monkeypatch
+):
+    monkeypatch.setitem(current_app.config, "TRACKER_REFRESH_TIMEOUT", 0)
+    jira_server.issues = {"PROJ-1": None}
+    issue = _create_issue(db_session, create_beam(), jira_tracker, "PROJ-1", False)
+
+    refresh_issue_trackers.delay()
+    db_session.refresh(issue)
+    assert not issue.open
+    assert "/rest/api/2/search" not in jira_server.requests
+
+
+def test_refresh_trackers_deadline_bounds_stuck_requests(
+    eager_celery, db_session, create_beam, jira_server, jira_tracker, monkeypatch
+):
+    stuck_tracker = Tracker(name="stuck", type="faulty", url="stuck", config="{}")
+    db_session.add(stuck_tracker)
+    jira_server.issues = {"PROJ-1": None}
+    beam = create_beam()
+    jira_issue = _create_issue(db_session, beam, jira_tracker, "PROJ-1", False)
+    _create_issue(db_session, beam, stuck_tracker, "1", True)
+    released = threading.Event()
+
+    def stuck_fetch_states(self, issues, deadline):
+        # A single request which doesn't return before the deadline
+        released.wait(10)
+        yield {}
+
+    monkeypatch.setattr(issue_trackers.Faulty, "fetch_states", stuck_fetch_states)
+    monkeypatch.setitem(current_app.config, "TRACKER_REFRESH_TIMEOUT", 1)
+    try:
+        start = time.monotonic()
+        refresh_issue_trackers.delay()
+        assert time.monotonic() - start < 5
+    finally:
+        released.set()
+    db_session.refresh(jira_issue)
+    assert jira_issue.open
+
+
+def test_refresh_skips_issues_which_are_not_due(
+    eager_celery, db_session, create_beam, jira_server, jira_tracker, client
+):
+    now = datetime.datetime.utcnow()
+    day = datetime.timedelta(days=1)
+    jira_server.issues = {
+        "NEW-1": None,
+        "CLOSED-1": "2000-01-01T00:00:00.000+0000",
+        "STABLE-1": None,
+        "CHANGED-1": None,
+    }
+    beam = create_beam()
+    issues = {
+        key: _create_issue(db_session, beam, jira_tracker, key, True) for key in jira_server.issues
+    }
+    issues["CLOSED-1"].open = False
+    issues["CLOSED-1"].resolved_at = datetime.datetime(2000, 1, 1)
+    issues["CLOSED-1"].last_checked = now - day
+    issues["STABLE-1"].last_checked = now - day
+    issues["STABLE-1"].last_changed = now - 30 * day
+    issues["CHANGED-1"].last_checked = now - day
+    issues["CHANGED-1"].last_changed = now - 2 * day
+    db_session.commit()
+
+    refresh_issue_trackers.delay()
+    assert sorted(jira_server.searched) == ["CHANGED-1", "NEW-1"]
+    db_session.refresh(issues["NEW-1"])
+    assert issues["NEW-1"].last_checked is not None
+    assert issues["NEW-1"].last_changed == issues["NEW-1"].last_checked
+
+    jira_server.searched.clear()
+    response = client.post(f"/trackers/{jira_tracker.id}/refresh")
+    assert response.status_code == 200
+    assert sorted(jira_server.searched) == sorted(jira_server.issues)
+    db_session.refresh(issues["CLOSED-1"])
+    assert issues["CLOSED-1"].resolved_at == datetime.datetime(2000, 1, 1)
+
+    assert client.post("/trackers/0/refresh").status_code == 404
@@ -1,6 +1,8 @@
 import datetime
 import json
 
+from flask_app.models import Beam, BeamSummary, BeamType, File, Pin, Tag
+
 
 def assert_is_jsonifiable(obj):
     try:
@@ -45,3 +47,74 @@ def test_set_completed_to_false_removes_end(create_beam, db_session):
     beam.set_completed(False)
     db_session.commit()
     assert beam.end is None
+
+
+def test_to_dicts_matches_to_dict(create_beam, db_session, user, issue):
+    beam_type = BeamType(name="beam_type_1", vacuum_threshold=10)
+    db_session.add(beam_type)
+    tagged_beam = create_beam()
+    tagged_beam.type = beam_type
+    tagged_beam.size = 100
+    tagged_beam.issues.append(issue)
+    db_session.add(Tag(beam_id=tagged_beam.id, tag="tag1"))
+    db_session.add(Tag(beam_id=tagged_beam.id, tag="tag2"))
+    pinned_beam = create_beam(add_file=False)
+    pinned_beam.size = 100
+    db_session.add(Pin(user_id=user.id, beam_id=pinned_beam.id))
+    plain_beam = create_beam(completed=False, add_file=False)
+    db_session.commit()
+
+    beams = [tagged_beam, pinned_beam, plain_beam]
+    assert Beam.to_dicts(beams, 60) == [beam.to_dict(60) for beam in beams]
+    assert Beam.to_dicts([], 60) == []
+
+
+def test_purge_time_clause_matches_get_purge_time(create_beam, db_session, user, issue, now):
+    beam_type = BeamType(name="beam_type_1", vacuum_threshold=10)
+    db_session.add(beam_type)
+    typed_beam = create_beam(start=now - datetime.timedelta(days=3))
+    typed_beam.type = beam_type
+    expired_beam = create_beam(start=now - datetime.timedelta(days=100), add_file=False)
+    pinned_beam = create_beam(add_file=False)
+    db_session.add(Pin(user_id=user.id, beam_id=pinned_beam.id))
+    beam_with_issue = create_beam(add_file=False)
+    beam_with_issue.issues.append(issue)
+    incomplete_beam = create_beam(completed=False, add_file=False)
+    beams = [typed_beam, expired_beam, pinned_beam, beam_with_issue, incomplete_beam]
+    for beam in beams:
+        beam.size = 100
+    empty_beam = create_beam(add_file=False)
+    beams.append(empty_beam)
+    db_session.commit()
+
+    purge_times = dict(
+        db_session.query(Beam.id, Beam.purge_time_clause(60)).filter(
+            Beam.id.in_([beam.id for beam in beams])
+        )
+    )
+    assert purge_times == {beam.id: beam.get_purge_time(60) for beam in beams}
+    assert purge_times[typed_beam.id] == 7
+    assert purge_times[empty_beam.id] == 0
+
+
+def test_beam_summary_is_kept_up_to_date(create_beam, db_session, user, issue):
+    beam = create_beam(add_file=False)
+    db_session.add(Tag(beam_id=beam.id, tag="Tag1"))
+    db_session.add(Pin(user_id=user.id, beam_id=beam.id))
+    beam.issues.append(issue)
+    db_session.add(File(beam_id=beam.id, file_name="a", status="pending"))
+    db_session.commit()
+
+    summary = db_session.query(BeamSummary).filter_by(beam_id=beam.id).one()
+    assert summary.tags == ["tag1"]
+    assert summary.pinners == [user.id]
+    assert summary.issues == [issue.id]
+    assert summary.has_open_issues
+    assert summary.file_count == 0
+
+    issue.open = False
+    db_session.query(File).filter_by(beam_id=beam.id).one().status = "uploaded"
+    db_session.commit()
+    db_session.refresh(summary)
+    assert not summary.has_open_issues
+    assert summary.file_count == 1
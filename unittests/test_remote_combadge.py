@@ -1,4 +1,6 @@
 import io
+import os
+import time
 from unittest import mock
 
 import logbook
@@ -36,3 +38,109 @@ def test_remove_combadge_fails_silently_on_ssh_exception(
     file_name = list(mock_remove.call_args_list[0])[0][0]
     caplog.seek(0)
     assert f"Failed to remove {file_name}: {reason}" in caplog.read()
+
+
+def test_cached_combadge_is_uploaded_once(mock_ssh_client, mock_sftp_client, combadge_assets_dir):
+    host = RemoteHost(
+        host="mock-host", username="mock-user", auth_method="password", password="blah"
+    )
+    mock_sftp_client.files["/tmp/combadge_0123456789abcdef"] = {"local": __file__}
+
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True) as combadge:
+        cached_path = combadge._remote_combadge_path
+    [first_sftp] = mock_sftp_client.instances
+    assert [call["action"] for call in first_sftp.calls] == [
+        "put",
+        "chmod",
+        "posix_rename",
+        "remove",
+    ]
+    assert list(mock_sftp_client.files) == [cached_path]
+    assert mock_sftp_client.trash == ["/tmp/combadge_0123456789abcdef"]
+
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True) as combadge:
+        assert combadge._remote_combadge_path == cached_path
+    # The cached combadge is only marked as used
+    assert [call["action"] for call in mock_sftp_client.instances[1].calls] == ["utime"]
+    assert list(mock_sftp_client.files) == [cached_path]
+
+
+def test_cached_combadge_is_verified(
+    mock_ssh_client, mock_sftp_client, combadge_assets_dir, tmpdir
+):
+    host = RemoteHost(
+        host="mock-host", username="mock-user", auth_method="password", password="blah"
+    )
+    with open(os.path.join(combadge_assets_dir, "v2", "combadge_linux", "combadge"), "wb") as f:
+        f.write(b"combadge")
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True) as combadge:
+        cached_path = combadge._remote_combadge_path
+    tampered = tmpdir.join("tampered")
+    tampered.write_binary(b"tampered")
+    mock_sftp_client.files[cached_path]["local"] = str(tampered)
+
+    # A cached combadge of the right size but with other contents is replaced
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True) as combadge:
+        assert combadge._remote_combadge_path == cached_path
+    assert [call["action"] for call in mock_sftp_client.instances[1].calls] == [
+        "put",
+        "chmod",
+        "posix_rename",
+    ]
+    assert mock_sftp_client.files[cached_path]["local"] != str(tampered)
+
+
+def test_recently_used_stale_combadges_are_kept(
+    mock_ssh_client, mock_sftp_client, combadge_assets_dir
+):
+    host = RemoteHost(
+        host="mock-host", username="mock-user", auth_method="password", password="blah"
+    )
+    # Another beam may be about to run the outdated combadge it just found in the cache
+    mock_sftp_client.files["/tmp/combadge_0123456789abcdef"] = {
+        "local": __file__,
+        "mtime": time.time(),
+    }
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True):
+        pass
+    assert mock_sftp_client.trash == []
+
+
+def test_v1_options(mock_ssh_client):
+    host = RemoteHost(
+        host="mock-host", username="mock-user", auth_method="password", password="blah"
+    )
+    combadge = RemoteCombadge(
+        remote_host=host, combadge_version="v1", streams=4, compression_level=1
+    )
+    combadge._remote_combadge_path = "/tmp/combadge"
+    with host:
+        combadge.run(beam_id=1, directory="/data", transporter="scotty")
+    assert mock_ssh_client.instances[0].commands[-1] == (
+        '/tmp/combadge 1 "/data" "scotty" --streams 4 --compression-level 1'
+    )
+
+
+def test_cached_combadge_of_other_users_is_not_trusted(
+    mock_ssh_client, mock_sftp_client, combadge_assets_dir
+):
+    host = RemoteHost(
+        host="mock-host", username="mock-user", auth_method="password", password="blah"
+    )
+    mock_sftp_client.files["/tmp/combadge_0123456789abcdef"] = {"local": __file__, "uid": 0}
+
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True) as combadge:
+        cached_path = combadge._remote_combadge_path
+    # Outdated combadges of other users are left alone
+    assert mock_sftp_client.trash == []
+
+    mock_sftp_client.files[cached_path]["uid"] = 0
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True) as combadge:
+        assert combadge._remote_combadge_path != cached_path
+    [_, sftp] = mock_sftp_client.instances
+    assert [call["action"] for call in sftp.calls] == ["put", "chmod", "remove"]
+
+    # A combadge which others can write to is not trusted either
+    mock_sftp_client.files[cached_path].update(uid=1000, mode=0o100777)
+    with host, RemoteCombadge(remote_host=host, combadge_version="v2", cache=True) as combadge:
+        assert combadge._remote_combadge_path != cached_path
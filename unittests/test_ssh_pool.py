@@ -0,0 +1,216 @@
+import socket
+import threading
+import time
+
+import paramiko
+import pytest
+
+from flask_app.utils import remote_host
+from flask_app.utils.remote_host import RemoteHost
+from flask_app.utils.ssh_pool import SSHPool, get_pool
+
+_REPLIES = {"uname": b"Linux", RemoteHost._TEMPDIR_COMMAND: b"/tmp"}
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, commands):
+        self._commands = commands
+
+    def check_auth_password(self, username, password):
+        if password == "secret":
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode()
+        self._commands.append(command)
+
+        def reply():
+            # Let the transport acknowledge the request before the channel is closed
+            time.sleep(0.05)
+            channel.sendall(_REPLIES.get(command, b""))
+            channel.send_exit_status(0)
+            channel.close()
+
+        threading.Thread(target=reply, daemon=True).start()
+        return True
+
+
+class SSHTestServer:
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.connections = 0
+        self.commands = []
+        self._transports = []
+        self._socket = socket.socket()
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen()
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_Server(self.commands))
+            self._transports.append(transport)
+
+    def close(self):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+
+@pytest.fixture
+def ssh_server():
+    server = SSHTestServer()
+    yield server
+    server.close()
+
+
+def _remote_host(ssh_server, pool, password="secret"):
+    return RemoteHost(
+        host="127.0.0.1",
+        port=ssh_server.port,
+        username="scotty",
+        auth_method="password",
+        password=password,
+        pool=pool,
+    )
+
+
+def _probe(remote_host):
+    with remote_host:
+        return remote_host.get_os_type(), remote_host.get_temp_dir()
+
+
+def test_pool_reuses_connections(ssh_server):
+    pool = SSHPool(idle_timeout=60)
+    try:
+        for _ in range(3):
+            assert _probe(_remote_host(ssh_server, pool)) == ("linux", "/tmp")
+    finally:
+        pool.close()
+
+    assert ssh_server.connections == 1
+    # Host details are probed only once per connection
+    assert ssh_server.commands == ["uname", RemoteHost._TEMPDIR_COMMAND]
+
+
+def test_pool_keys_by_credentials(ssh_server):
+    pool = SSHPool(idle_timeout=60)
+    try:
+        _probe(_remote_host(ssh_server, pool))
+        with pytest.raises(paramiko.AuthenticationException):
+            _probe(_remote_host(ssh_server, pool, password="wrong"))
+    finally:
+        pool.close()
+
+
+def test_pool_keys_by_port(ssh_server):
+    other_server = SSHTestServer()
+    pool = SSHPool(idle_timeout=60)
+    try:
+        _probe(_remote_host(ssh_server, pool))
+        _probe(_remote_host(other_server, pool))
+    finally:
+        pool.close()
+        other_server.close()
+
+    assert ssh_server.connections == 1
+    assert other_server.connections == 1
+
+
+def test_pool_closes_idle_connections(ssh_server):
+    pool = SSHPool(idle_timeout=0)
+    try:
+        _probe(_remote_host(ssh_server, pool))
+        _probe(_remote_host(ssh_server, pool))
+    finally:
+        pool.close()
+
+    assert ssh_server.connections == 2
+
+
+def test_pool_reaps_idle_connections(ssh_server):
+    pool = SSHPool(idle_timeout=0.1)
+    try:
+        with _remote_host(ssh_server, pool) as host:
+            connection = host._connection
+        # Idle connections are closed without waiting for the next use of the pool, after which
+        # the reaper exits
+        for _ in range(50):
+            if pool._reaper is None:
+                break
+            time.sleep(0.05)
+        assert pool._reaper is None
+        assert not connection.is_active()
+    finally:
+        pool.close()
+
+
+def test_no_pool_connects_every_time(ssh_server):
+    _probe(_remote_host(ssh_server, None))
+    _probe(_remote_host(ssh_server, None))
+    assert ssh_server.connections == 2
+
+
+def test_pool_remembers_algorithm_fallback(monkeypatch):
+    connects = []
+
+    class _Transport:
+        def is_active(self):
+            return True
+
+    class _SSHClient:
+        def set_missing_host_key_policy(self, policy):
+            pass
+
+        def connect(self, host, **kwargs):
+            connects.append(kwargs.get("disabled_algorithms"))
+            if "disabled_algorithms" not in kwargs:
+                raise paramiko.AuthenticationException()
+
+        def get_transport(self):
+            return _Transport()
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(remote_host, "SSHClient", _SSHClient)
+    pool = SSHPool(idle_timeout=60)
+    host = RemoteHost(
+        host="old-host", username="scotty", auth_method="password", password="x", pool=pool
+    )
+    with host:
+        pass
+    # Force a new connection
+    pool.close()
+    with host:
+        pass
+
+    assert connects == [
+        None,
+        RemoteHost._DISABLED_ALGORITHMS,
+        RemoteHost._DISABLED_ALGORITHMS,
+    ]
+
+
+def test_get_pool_is_per_process(monkeypatch):
+    pool = get_pool(60)
+    assert get_pool(60) is pool
+    assert get_pool(30) is pool
+    assert pool.idle_timeout == 30
+    monkeypatch.setattr("os.getpid", lambda: -1)
+    assert get_pool(60) is not pool
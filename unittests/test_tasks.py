@@ -1,12 +1,27 @@
 import datetime
+import hashlib
 import os
 import stat
+from collections import namedtuple
+from contextlib import ExitStack
 
 import pytest
 from flask import current_app
+from sqlalchemy.dialects import postgresql
 
-from flask_app.models import Beam, BeamType, Pin
-from flask_app.tasks import beam_up, delete_beam, vacuum
+from flask_app import tasks
+from flask_app.models import Beam, BeamType, File, Issue, Pin, ScrubBucketState
+from flask_app.tasks import (
+    beam_up,
+    check_vacuum_pressure,
+    delete_beam,
+    get_pending_query,
+    mark_timeout,
+    scrub,
+    vacuum,
+    validate_checksum,
+)
+from flask_app.utils.beam_orchestrator import LaunchCancelled
 from flask_app.utils.remote_combadge import _COMBADGE_UUID_PART_LENGTH
 from flask_app.utils.remote_host import RemoteHost
 
@@ -194,6 +209,187 @@ def test_beam_up(
     assert mock_sftp_client.trash[0] == combadge
 
 
+@pytest.mark.parametrize("os_type", ["linux", "windows"])
+def test_beam_up_detached(
+    db_session,
+    now,
+    create_beam,
+    eager_celery,
+    monkeypatch,
+    mock_ssh_client,
+    mock_sftp_client,
+    mock_rsa_key,
+    uuid4,
+    os_type,
+    combadge_assets_dir,
+):
+    monkeypatch.setitem(current_app.config, "COMBADGE_DETACH", True)
+    beam = create_beam(start=now, completed=False)
+    if os_type == "windows":
+        beam.host = "mock-windows-host"
+        db_session.commit()
+    result = beam_up.delay(
+        beam_id=beam.id,
+        host=beam.host,
+        directory=beam.directory,
+        username="root",
+        auth_method="stored_key",
+        pkey="mock-pkey",
+        password=None,
+        combadge_version="v2",
+    )
+    assert result.successful(), result.traceback
+    beam = db_session.query(Beam).filter_by(id=beam.id).one()
+    assert beam.error is None
+    assert not beam.completed
+
+    uuid_part = uuid4.hex[:_COMBADGE_UUID_PART_LENGTH]
+    args = f"-b {beam.id} -p {beam.directory} -t scotty"
+    if os_type == "windows":
+        combadge = rf"C:\Users\root\AppData\Local\Temp\combadge_{uuid_part}.exe"
+        expected = f'cmd /c start "" /b cmd /s /c ""{combadge}" {args} & del "{combadge}""'
+    else:
+        combadge = f"/tmp/combadge_{uuid_part}"
+        expected = (
+            f"setsid nohup sh -c 'RUST_LOG=trace {combadge} {args}; rm -f {combadge}' "
+            "> /dev/null 2>&1 < /dev/null &"
+        )
+    assert mock_ssh_client.instances[0].commands[-1] == expected
+    # The combadge removes itself when it's done
+    assert list(mock_sftp_client.files) == [combadge]
+
+
+def test_beam_up_async(
+    db_session,
+    now,
+    create_beam,
+    eager_celery,
+    monkeypatch,
+    mock_ssh_client,
+    mock_sftp_client,
+    mock_rsa_key,
+    combadge_assets_dir,
+):
+    submitted = []
+    captured = []
+    monkeypatch.setitem(current_app.config, "BEAM_UP_ASYNC", True)
+    monkeypatch.setattr(
+        tasks,
+        "get_orchestrator",
+        lambda config: namedtuple("Orchestrator", "submit")(lambda *args: submitted.append(args)),
+    )
+    monkeypatch.setattr(
+        current_app.raven, "captureException", lambda exc_info: captured.append(exc_info[1])
+    )
+    beam = create_beam(start=now, completed=False)
+    result = beam_up.delay(
+        beam_id=beam.id,
+        host=beam.host,
+        directory=beam.directory,
+        username="root",
+        auth_method="stored_key",
+        pkey="mock-pkey",
+        password=None,
+        combadge_version="v2",
+    )
+    assert result.successful(), result.traceback
+    # Nothing is done until the orchestrator launches the combadge
+    assert mock_ssh_client.instances == []
+
+    [(host, launch, on_error)] = submitted
+    assert host == beam.host
+    with ExitStack() as stack:
+        channel = launch(stack)
+        assert channel.recv_exit_status() == 0
+        [ssh_client] = mock_ssh_client.instances
+        assert ssh_client.commands[-1].endswith(f"-b {beam.id} -p {beam.directory} -t scotty")
+    assert mock_sftp_client.files == {}
+    db_session.refresh(beam)
+    assert beam.launched_at is not None
+
+    error = RuntimeError("Combadge exited with status 1")
+    on_error(error)
+    beam = db_session.query(Beam).filter_by(id=beam.id).one()
+    assert beam.completed
+    assert beam.error.endswith(": Combadge exited with status 1")
+    assert captured == [error]
+
+
+def test_beam_up_async_completed_while_queued(
+    db_session, now, create_beam, eager_celery, monkeypatch, mock_ssh_client
+):
+    submitted = []
+    monkeypatch.setitem(current_app.config, "BEAM_UP_ASYNC", True)
+    monkeypatch.setattr(
+        tasks,
+        "get_orchestrator",
+        lambda config: namedtuple("Orchestrator", "submit")(lambda *args: submitted.append(args)),
+    )
+    beam = create_beam(start=now, completed=False)
+    beam_up.delay(
+        beam_id=beam.id,
+        host=beam.host,
+        directory=beam.directory,
+        username="root",
+        auth_method="password",
+        pkey=None,
+        password="secret",
+    )
+    [(_, launch, _)] = submitted
+
+    # The beam was failed, e.g. by mark_timeout, before the orchestrator got to it
+    beam.set_completed(True)
+    db_session.commit()
+    with ExitStack() as stack, pytest.raises(LaunchCancelled):
+        launch(stack)
+    assert mock_ssh_client.instances == []
+    db_session.refresh(beam)
+    assert beam.launched_at is None
+
+
+def test_mark_timeout(db_session, now, create_beam, eager_celery, monkeypatch):
+    monkeypatch.setitem(current_app.config, "COMBADGE_CONTACT_TIMEOUT", 60 * 60)
+    monkeypatch.setitem(current_app.config, "BEAM_UP_QUEUE_TIMEOUT", 3 * 60 * 60)
+    hours = datetime.timedelta(hours=1)
+    queued = create_beam(start=now - 2 * hours, completed=False)
+    lost = create_beam(start=now - 4 * hours, completed=False)
+    launched = create_beam(start=now - 2 * hours, completed=False)
+    launched.launched_at = now - 0.5 * hours
+    silent = create_beam(start=now - 2 * hours, completed=False)
+    silent.launched_at = now - 1.5 * hours
+    db_session.commit()
+
+    mark_timeout.delay()
+    for beam in (queued, lost, launched, silent):
+        db_session.refresh(beam)
+    assert not queued.completed
+    assert not launched.completed
+    assert lost.completed
+    assert lost.error == "Combadge wasn't launched"
+    assert silent.completed
+    assert silent.error == "Combadge didn't contact the transporter"
+
+
+def test_mark_timeout_independent_beam(client, db_session, now, eager_celery, monkeypatch):
+    monkeypatch.setitem(current_app.config, "COMBADGE_CONTACT_TIMEOUT", 60 * 60)
+    monkeypatch.setitem(current_app.config, "BEAM_UP_QUEUE_TIMEOUT", 3 * 60 * 60)
+    response = client.post(
+        "/beams",
+        json={"beam": {"auth_method": "independent", "host": "host", "directory": "/data"}},
+    )
+    assert response.status_code == 200
+    beam = db_session.query(Beam).filter_by(id=response.json["beam"]["id"]).one()
+    # The combadge is started by the user right away, so the contact timeout applies
+    assert beam.launched_at == beam.start
+    beam.start = beam.launched_at = now - datetime.timedelta(hours=2)
+    db_session.commit()
+
+    mark_timeout.delay()
+    db_session.refresh(beam)
+    assert beam.completed
+    assert beam.error == "Combadge didn't contact the transporter"
+
+
 def test_delete_beam(eager_celery, beam_with_real_file):
     beam = beam_with_real_file
     full_file_location = os.path.join(
@@ -204,3 +400,331 @@ def test_delete_beam(eager_celery, beam_with_real_file):
     delete_beam.delay(beam.id)
     assert not os.path.exists(full_file_location)
     assert beam.deleted
+
+
+def _add_stored_file(db_session, beam, name, content, checksum=None):
+    with open(os.path.join(current_app.config["STORAGE_PATH"], name), "wb") as f:
+        f.write(content)
+    file_ = File(
+        file_name=name,
+        storage_name=name,
+        status="uploaded",
+        size=len(content),
+        checksum=checksum or hashlib.sha512(content).hexdigest(),
+    )
+    beam.files.append(file_)
+    db_session.commit()
+    return file_
+
+
+def test_validate_checksum(eager_celery, db_session, create_beam, monkeypatch):
+    beam = create_beam(add_file=False)
+    valid = _add_stored_file(db_session, beam, "valid.log.gz", b"\x1f\x8bcompressed")
+    corrupt = _add_stored_file(db_session, beam, "corrupt.log", b"content", checksum="0" * 128)
+    monkeypatch.setitem(current_app.config, "CHECKSUM_VALIDATION_BYTES_PER_NIGHT", 1024)
+
+    result = validate_checksum.delay()
+    assert not result.successful()
+    assert "corrupt.log" in str(result.result)
+    db_session.refresh(valid)
+    db_session.refresh(corrupt)
+    assert valid.last_validated is not None
+    assert corrupt.last_validated is None
+
+
+def test_validate_checksum_budget(eager_celery, db_session, create_beam, monkeypatch):
+    beam = create_beam(add_file=False)
+    files = [_add_stored_file(db_session, beam, f"file{i}", b"x" * 100) for i in range(3)]
+    files[0].last_validated = datetime.datetime.utcnow()
+    db_session.commit()
+    monkeypatch.setitem(current_app.config, "CHECKSUM_VALIDATION_BYTES_PER_NIGHT", 250)
+
+    validate_checksum.delay()
+    for file_ in files:
+        db_session.refresh(file_)
+    # Never validated files come first, and the budget stops before the third one
+    assert files[1].last_validated is not None
+    assert files[2].last_validated is not None
+    assert files[0].last_validated < files[1].last_validated
+
+
+def test_vacuum_batches(eager_celery, db_session, create_beam, expired_beam_date, monkeypatch):
+    monkeypatch.setitem(current_app.config, "VACUUM_BATCH_SIZE", 2)
+    storage_path = current_app.config["STORAGE_PATH"]
+    os.mkdir(os.path.join(storage_path, "1"))
+    beams = [create_beam(start=expired_beam_date, add_file=False) for _ in range(5)]
+    for i, beam in enumerate(beams):
+        _add_stored_file(db_session, beam, f"1/{i}-a", b"a")
+        _add_stored_file(db_session, beam, f"{i}-b", b"b")
+
+    failing_path = os.path.join(storage_path, "1/3-a")
+    real_unlink = os.unlink
+
+    def _unlink(path):
+        if path == failing_path:
+            raise PermissionError(path)
+        real_unlink(path)
+
+    monkeypatch.setattr(os, "unlink", _unlink)
+    vacuum.delay()
+    assert [is_vacuumed(db_session, beam) for beam in beams] == [True, True, True, False, True]
+    assert os.listdir(os.path.join(storage_path, "1")) == ["3-a"]
+    assert db_session.query(Beam).filter_by(id=beams[3].id).one().pending_deletion
+
+    # The beam that failed is retried by the next vacuum
+    monkeypatch.setattr(os, "unlink", real_unlink)
+    vacuum.delay()
+    assert is_vacuumed(db_session, beams[3])
+    assert os.listdir(os.path.join(storage_path, "1")) == []
+
+
+_DiskUsage = namedtuple("_DiskUsage", ["total", "used", "free", "percent"])
+
+
+@pytest.fixture
+def disk_usage(monkeypatch):
+    def _set_used(used):
+        usage = _DiskUsage(1000, used, 1000 - used, used / 10)
+        monkeypatch.setattr("psutil.disk_usage", lambda _: usage)
+
+    monkeypatch.setitem(current_app.config, "VACUUM_TARGET_USED_PERCENT", 80)
+    return _set_used
+
+
+def _create_sized_beam(db_session, create_beam, start, size):
+    beam = create_beam(start=start, add_file=False)
+    # Completed beams without files are vacuumed regardless of their age
+    _add_stored_file(db_session, beam, f"sized-{beam.id}", b"")
+    beam.size = size
+    db_session.commit()
+    return beam
+
+
+def test_pressure_vacuum_frees_only_up_to_target(
+    eager_celery, db_session, create_beam, now, vacuum_threshold, disk_usage
+):
+    def days(n):
+        return now - datetime.timedelta(days=vacuum_threshold + n)
+
+    oldest = _create_sized_beam(db_session, create_beam, days(5), 100)
+    small = _create_sized_beam(db_session, create_beam, days(1), 100)
+    large = _create_sized_beam(db_session, create_beam, days(1), 200)
+
+    disk_usage(950)
+    vacuum.delay()
+    assert is_vacuumed(db_session, oldest)
+    assert is_vacuumed(db_session, large)
+    assert not is_vacuumed(db_session, small)
+    assert not db_session.query(Beam).filter_by(id=small.id).one().pending_deletion
+
+
+def test_pressure_vacuum_below_target(
+    eager_celery, db_session, create_beam, expired_beam_date, disk_usage
+):
+    beam = _create_sized_beam(db_session, create_beam, expired_beam_date, 100)
+    disk_usage(500)
+    vacuum.delay()
+    assert not is_vacuumed(db_session, beam)
+
+
+@pytest.mark.parametrize("used, vacuumed", [(950, True), (500, False)])
+def test_check_vacuum_pressure(
+    eager_celery,
+    db_session,
+    create_beam,
+    expired_beam_date,
+    disk_usage,
+    monkeypatch,
+    used,
+    vacuumed,
+):
+    monkeypatch.setitem(current_app.config, "FREE_SPACE_THRESHOLD", 90)
+    beam = _create_sized_beam(db_session, create_beam, expired_beam_date, 100)
+    disk_usage(used)
+    check_vacuum_pressure.delay()
+    assert is_vacuumed(db_session, beam) == vacuumed
+
+
+def test_pressure_vacuum_threshold_shift(
+    eager_celery, db_session, create_beam, now, vacuum_threshold, disk_usage, monkeypatch, user
+):
+    start = now - datetime.timedelta(days=vacuum_threshold - 2)
+    beam = _create_sized_beam(db_session, create_beam, start, 100)
+    pinned = _create_sized_beam(db_session, create_beam, start, 100)
+    db_session.add(Pin(user_id=user.id, beam_id=pinned.id))
+    db_session.commit()
+    disk_usage(1000)
+
+    vacuum.delay()
+    assert not is_vacuumed(db_session, beam)
+
+    monkeypatch.setitem(current_app.config, "VACUUM_PRESSURE_THRESHOLD_SHIFT", 3)
+    vacuum.delay()
+    assert is_vacuumed(db_session, beam)
+    assert not is_vacuumed(db_session, pinned)
+
+
+@pytest.mark.parametrize("threshold_shift", [0, 5])
+def test_pending_query_expiry_boundaries(
+    db_session, create_beam, now, vacuum_threshold, threshold_shift
+):
+    beam_type = BeamType(name="beam_type_1", vacuum_threshold=3)
+    db_session.add(beam_type)
+    beams = []
+    for days in range(vacuum_threshold - 7, vacuum_threshold + 2):
+        for threshold_type in [None, beam_type]:
+            beam = create_beam(start=now - datetime.timedelta(days=days), completed=False)
+            beam.files = [File(file_name="a")]
+            beam.type = threshold_type
+            beams.append(beam)
+    db_session.commit()
+
+    days_until_purge = Beam.days_until_purge_clause(vacuum_threshold)
+    expected = {
+        beam_id
+        for beam_id, in db_session.query(Beam.id).filter(days_until_purge <= threshold_shift)
+    }
+    assert {beam_id for beam_id, in get_pending_query(threshold_shift)} == expected
+    assert expected
+
+
+def test_pending_query_exclusions(
+    db_session, create_beam, expired_beam_date, now, user, issue, tracker
+):
+    def expired_beam():
+        beam = create_beam(start=expired_beam_date, completed=True)
+        beam.files = [File(file_name="a")]
+        return beam
+
+    plain = expired_beam()
+    pinned = expired_beam()
+    db_session.add(Pin(user_id=user.id, beam_id=pinned.id))
+    with_open_issue = expired_beam()
+    with_open_issue.issues.append(issue)
+    with_closed_issue = expired_beam()
+    closed_issue = Issue(tracker_id=tracker.id, id_in_tracker="mock-ticket-2", open=False)
+    with_closed_issue.issues.append(closed_issue)
+    pending = expired_beam()
+    pending.pending_deletion = True
+    completed_empty = create_beam(start=now, completed=True, add_file=False)
+    running_empty = create_beam(start=now, completed=False, add_file=False)
+    db_session.commit()
+
+    beam_ids = {
+        beam.id
+        for beam in [
+            plain,
+            pinned,
+            with_open_issue,
+            with_closed_issue,
+            pending,
+            completed_empty,
+            running_empty,
+        ]
+    }
+    pending_ids = {beam_id for beam_id, in get_pending_query()} & beam_ids
+    assert pending_ids == {plain.id, with_closed_issue.id, completed_empty.id}
+
+
+def _plan_nodes(node, join=None):
+    # Yields the nodes of a JSON query plan with the nearest join above each of them
+    yield node, join
+    if "Join Type" in node:
+        join = node
+    for child in node.get("Plans", []):
+        yield from _plan_nodes(child, join)
+
+
+def test_pending_query_plan(db_session, create_beam, now):
+    db_session.add(BeamType(name="beam_type_1", vacuum_threshold=3))
+    create_beam(start=now)
+    statement = get_pending_query().statement.compile(
+        dialect=postgresql.dialect(), compile_kwargs={"render_postcompile": True}
+    )
+    connection = db_session.connection()
+    connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    [(plan,)] = connection.exec_driver_sql(
+        "EXPLAIN (FORMAT JSON) " + str(statement), statement.params
+    )
+    nodes = list(_plan_nodes(plan[0]["Plan"]))
+
+    # Only what the query is built for is checked, so that other choices of the planner are free
+    assert any(node.get("Index Name") == "ix_beam_live_start" for node, _ in nodes)
+    file_nodes = [(node, join) for node, join in nodes if node.get("Relation Name") == "file"]
+    assert file_nodes
+    for node, join in file_nodes:
+        assert node["Node Type"] != "Seq Scan"
+        # Files are only probed for existence, never joined to the beams
+        assert node.get("Parent Relationship") == "SubPlan" or join["Join Type"] == "Anti"
+
+
+def test_scrub(eager_celery, db_session, create_beam, monkeypatch, tmpdir):
+    storage_path = str(tmpdir / "scrub-storage")
+    os.makedirs(os.path.join(storage_path, "1"))
+    os.makedirs(os.path.join(storage_path, "1-a"))
+    open(os.path.join(storage_path, ".test"), "w").close()
+    monkeypatch.setitem(current_app.config, "STORAGE_PATH", storage_path)
+
+    beam = create_beam(add_file=False)
+    ok = _add_stored_file(db_session, beam, "1/1-ok", b"ok")
+    _add_stored_file(db_session, beam, "1-a/2-ok", b"ok")
+    wrong_size = _add_stored_file(db_session, beam, "1/3-wrong-size", b"12345")
+    wrong_size.size = 2
+    missing = File(file_name="missing", storage_name="1/4-missing", status="uploaded", size=1)
+    beam.files.append(missing)
+    beam.size = 100
+    db_session.commit()
+    with open(os.path.join(storage_path, "1", "0-unexpected"), "wb") as f:
+        f.write(b"")
+
+    result = scrub.delay()
+    assert not result.successful()
+    assert "4 errors" in str(result.result)
+    db_session.refresh(wrong_size)
+    db_session.refresh(beam)
+    assert wrong_size.size == 5
+    assert beam.size == 10
+    assert ok.size == 2
+
+
+def test_scrub_skips_unchanged_buckets(eager_celery, db_session, create_beam, monkeypatch, tmpdir):
+    storage_path = str(tmpdir / "incremental-storage")
+    monkeypatch.setitem(current_app.config, "STORAGE_PATH", storage_path)
+    for bucket in ["1", "2", "3"]:
+        os.makedirs(os.path.join(storage_path, bucket))
+    beam = create_beam(add_file=False)
+    for bucket in ["1", "2", "3"]:
+        _add_stored_file(db_session, beam, f"{bucket}/{bucket}-file", b"data")
+    beam.size = 12
+    db_session.commit()
+
+    scanned = []
+    scan_directory = tasks._scan_directory
+
+    def _scan(path, relative_path):
+        scanned.append(relative_path)
+        return scan_directory(path, relative_path)
+
+    monkeypatch.setattr(tasks, "_scan_directory", _scan)
+    assert scrub.delay().successful()
+    assert sorted(scanned) == ["1/", "2/", "3/"]
+
+    # Only the bucket which was scrubbed the longest time ago is due
+    db_session.query(ScrubBucketState).filter_by(bucket="2").update(
+        {ScrubBucketState.last_scrubbed: datetime.datetime(2000, 1, 1)}
+    )
+    scanned.clear()
+    assert scrub.delay().successful()
+    assert scanned == ["2/"]
+
+    _add_stored_file(db_session, beam, "3/4-new", b"new")
+    beam.size += 3
+    db_session.commit()
+    scanned.clear()
+    assert scrub.delay().successful()
+    assert "3/" in scanned
+    assert len(scanned) == 2
+
+    scanned.clear()
+    assert scrub.delay(full=True).successful()
+    assert sorted(scanned) == ["1/", "2/", "3/"]
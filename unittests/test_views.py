@@ -1,7 +1,13 @@
+import datetime
+import json
 import os
+import urllib.parse
 
+import pytest
 from flask import current_app
 
+from flask_app.models import BeamSummary, File, Pin
+
 
 def test_delete_beam(client, eager_celery, storage_path, beam_with_real_file):
     client.delete(f"/beams/{beam_with_real_file.id}")
@@ -23,3 +29,249 @@ def test_filter_beams_by_issue(client, create_beam, issue, db_session):
     beams = response.json["beams"]
     assert len(beams) == 1
     assert beams[0]["id"] == beam.id
+
+
+def test_beams_keyset_pagination(client, create_beam):
+    beam_ids = sorted((create_beam(add_file=False).id for _ in range(5)), reverse=True)
+
+    response = client.get("/beams?per_page=2")
+    assert [b["id"] for b in response.json["beams"]] == beam_ids[:2]
+    assert response.json["meta"]["total_pages"] == 2
+
+    seen = []
+    cursor = str(beam_ids[0] + 1)
+    while cursor is not None:
+        response = client.get(f"/beams?per_page=2&before_id={cursor}")
+        seen.extend(b["id"] for b in response.json["beams"])
+        cursor = response.json["meta"]["next"]
+    assert [beam_id for beam_id in seen if beam_id in beam_ids] == beam_ids
+
+
+def test_beams_invalid_before_id(client):
+    response = client.get("/beams?before_id=blah")
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("per_page", [0, -1])
+def test_beams_invalid_per_page(client, create_beam, per_page):
+    create_beam(add_file=False)
+    response = client.get(f"/beams?per_page={per_page}")
+    assert response.status_code == 400
+
+
+def test_filter_and_sort_beams_by_purge_time(client, create_beam, db_session, now):
+    old_beam = create_beam(start=now - datetime.timedelta(days=59), add_file=False)
+    new_beam = create_beam(start=now, add_file=False)
+    for beam in (old_beam, new_beam):
+        beam.size = 100
+    db_session.commit()
+
+    response = client.get("/beams?purge_before=3")
+    assert [b["id"] for b in response.json["beams"]] == [old_beam.id]
+    assert response.json["beams"][0]["purge_time"] == 1
+
+    response = client.get("/beams?sort=purge_time")
+    assert [b["id"] for b in response.json["beams"]] == [old_beam.id, new_beam.id]
+
+    # There is no cursor for this order, pages are fetched by number
+    response = client.get("/beams?sort=purge_time&per_page=1")
+    assert response.json["meta"]["next"] is None
+    assert response.json["meta"]["total_pages"] == 2
+
+    response = client.get(f"/beams?sort=purge_time&before_id={new_beam.id}")
+    assert response.status_code == 400
+
+
+def test_filter_beams_by_tag_and_pin(client, create_beam, db_session, user):
+    tagged_beam = create_beam(add_file=False)
+    pinned_beam = create_beam(add_file=False)
+    db_session.add(Pin(user_id=user.id, beam_id=pinned_beam.id))
+    db_session.commit()
+    client.post(f"/beams/{tagged_beam.id}/tags/some-tag")
+
+    response = client.get("/beams?tag=some-tag;other-tag")
+    assert [b["id"] for b in response.json["beams"]] == [tagged_beam.id]
+    assert response.json["beams"][0]["tags"] == ["some-tag"]
+
+    response = client.get("/beams?pinned=true")
+    assert [b["id"] for b in response.json["beams"]] == [pinned_beam.id]
+
+    client.put(f"/beams/{tagged_beam.id}", json={"tags": []})
+    response = client.get("/beams?tag=some-tag")
+    assert response.json["beams"] == []
+
+
+def test_beams_without_summary_are_listed(client, create_beam, db_session):
+    beam = create_beam(add_file=False)
+    db_session.query(BeamSummary).filter_by(beam_id=beam.id).delete()
+    db_session.commit()
+
+    response = client.get("/beams?sort=purge_time")
+    [listed] = [b for b in response.json["beams"] if b["id"] == beam.id]
+    assert listed["purge_time"] is not None
+
+    response = client.get("/beams?pinned=true")
+    assert beam.id not in [b["id"] for b in response.json["beams"]]
+
+
+def test_delete_tracker_refreshes_beam_summaries(client, create_beam, db_session, issue):
+    beam = create_beam(add_file=False)
+    beam.issues.append(issue)
+    db_session.commit()
+    summary = db_session.query(BeamSummary).filter_by(beam_id=beam.id).one()
+    assert summary.has_open_issues
+
+    response = client.delete(f"/trackers/{issue.tracker_id}")
+    assert response.status_code == 200
+    db_session.refresh(summary)
+    assert summary.issues == []
+    assert not summary.has_open_issues
+
+
+@pytest.mark.parametrize(
+    "file_filter, mode, expected",
+    [
+        ("log", None, ["a.log", "b_log.txt", "bxlog.txt", "log%1"]),
+        ("%", None, ["log%1"]),
+        ("b_", "substring", ["b_log.txt"]),
+        ("log", "prefix", ["log%1"]),
+        ("*.log", "glob", ["a.log"]),
+        ("?_log*", "glob", ["b_log.txt"]),
+    ],
+)
+def test_filter_files(client, create_beam, db_session, file_filter, mode, expected):
+    beam = create_beam(add_file=False)
+    for file_name in ["a.log", "b_log.txt", "bxlog.txt", "log%1"]:
+        db_session.add(File(beam_id=beam.id, file_name=file_name))
+    db_session.commit()
+
+    url = f"/files?beam_id={beam.id}&filter={urllib.parse.quote(file_filter)}"
+    if mode is not None:
+        url += f"&filter_mode={mode}"
+    response = client.get(url)
+    assert [f["file_name"] for f in response.json["files"]] == expected
+    assert response.json["meta"] == {"total": len(expected), "total_capped": False}
+
+
+def test_filtered_files_count_is_capped(client, create_beam, db_session, monkeypatch):
+    monkeypatch.setitem(current_app.config, "FILES_MAX_FILTERED_COUNT", 2)
+    beam = create_beam(add_file=False)
+    for i in range(3):
+        db_session.add(File(beam_id=beam.id, file_name=f"file{i}"))
+    db_session.commit()
+
+    response = client.get(f"/files?beam_id={beam.id}&filter=file&offset=0&limit=10")
+    assert len(response.json["files"]) == 3
+    assert response.json["meta"] == {"total": 2, "total_capped": True}
+
+
+def test_beam_manifest(client, create_beam, db_session):
+    beam = create_beam(add_file=False)
+    for file_name in ["b", "a", "c"]:
+        db_session.add(File(beam_id=beam.id, file_name=file_name, storage_name=f"1/{file_name}"))
+    db_session.commit()
+
+    response = client.get(f"/beams/{beam.id}/manifest.ndjson")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [line["file_name"] for line in lines] == ["a", "b", "c"]
+    assert lines[0]["storage_name"] == "1/a"
+
+    assert client.get("/beams/0/manifest.ndjson").status_code == 404
+
+
+def test_register_files_batch(client, create_beam, db_session):
+    beam = create_beam(add_file=False)
+    other_beam = create_beam(add_file=False)
+    uploaded = File(beam_id=beam.id, file_name="uploaded", status="uploaded")
+    db_session.add(uploaded)
+    db_session.commit()
+
+    beam_files = [
+        {"beam_id": beam.id, "file_name": "dir/new"},
+        {"beam_id": beam.id, "file_name": "uploaded"},
+        {"beam_id": other_beam.id, "file_name": "dir/new"},
+        {"beam_id": beam.id, "file_name": "dir/new"},
+    ]
+    response = client.post("/files/batch", json={"files": beam_files})
+    assert response.status_code == 200
+    registered = response.json["files"]
+    assert [f["should_beam"] for f in registered] == [True, False, True, True]
+    assert registered[0] == registered[3]
+    assert registered[1]["file_id"] == str(uploaded.id)
+    new_file = db_session.query(File).filter_by(id=int(registered[0]["file_id"])).one()
+    assert new_file.storage_name == f"{beam.id % 1000}/{new_file.id}-dir__new"
+    assert registered[0]["storage_name"] == new_file.storage_name
+    assert os.path.isdir(os.path.join(current_app.config["STORAGE_PATH"], str(beam.id % 1000)))
+    db_session.refresh(beam)
+    assert beam.combadge_contacted
+
+    # Registering the same files again returns the same answers, without using up file ids
+    assert client.post("/files/batch", json={"files": beam_files}).json["files"] == registered
+    response = client.post("/files/batch", json={"files": [{"beam_id": beam.id, "file_name": "c"}]})
+    assert (
+        int(response.json["files"][0]["file_id"]) == max(int(f["file_id"]) for f in registered) + 1
+    )
+
+    assert client.post("/files/batch", json={"files": []}).status_code == 400
+
+
+def test_register_files_batch_unknown_beam(client):
+    response = client.post("/files/batch", json={"files": [{"beam_id": 0, "file_name": "a"}]})
+    assert response.status_code == 400
+
+
+def test_update_files_batch(client, create_beam, db_session):
+    beam = create_beam(add_file=False)
+    beam_files = [File(beam_id=beam.id, file_name=name, status="pending") for name in "abc"]
+    db_session.add_all(beam_files)
+    db_session.commit()
+
+    response = client.put(
+        "/files/batch",
+        json={
+            "files": [
+                {"file_id": beam_files[0].id, "success": True, "size": 10, "checksum": "x"},
+                {"file_id": beam_files[1].id, "success": True, "size": 20, "mtime": 0},
+                {"file_id": beam_files[2].id, "success": False, "size": None},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    for f in beam_files:
+        db_session.refresh(f)
+    assert [f.status for f in beam_files] == ["uploaded", "uploaded", "failed"]
+    assert [f.size for f in beam_files] == [10, 20, None]
+    assert beam_files[0].checksum == "x"
+    assert beam_files[1].mtime == datetime.datetime(1970, 1, 1)
+    db_session.refresh(beam)
+    assert beam.size == 30
+    summary = db_session.query(BeamSummary).filter_by(beam_id=beam.id).one()
+    assert summary.file_count == 2
+
+    response = client.put(f"/files/{beam_files[2].id}", json={"success": True, "size": 5})
+    assert response.status_code == 200
+    db_session.refresh(beam)
+    assert beam.size == 35
+
+    response = client.put("/files/batch", json={"files": [{"file_id": 0, "success": True}]})
+    assert response.status_code == 400
+    assert client.put("/files/batch", json={"files": []}).status_code == 400
+
+
+def test_register_file(client, create_beam, db_session):
+    beam = create_beam(add_file=False)
+
+    response = client.post("/files", json={"beam_id": beam.id, "file_name": "dir\\file"})
+    assert response.status_code == 200
+    file_id = response.json["file_id"]
+    assert response.json["should_beam"]
+    assert response.json["storage_name"] == f"{beam.id % 1000}/{file_id}-dir__file"
+    db_session.refresh(beam)
+    assert beam.combadge_contacted
+
+    client.put(f"/files/{file_id}", json={"success": True, "size": 1})
+    response = client.post("/files", json={"beam_id": beam.id, "file_name": "dir\\file"})
+    assert response.json["file_id"] == file_id
+    assert not response.json["should_beam"]
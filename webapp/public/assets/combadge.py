@@ -1,19 +1,36 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from contextlib import closing
-import gzip
+import argparse
+import itertools
 import logging
 import os
 import sys
 import socket
 import struct
+import threading
 import traceback
+import zlib
 from time import sleep
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 logger = logging.getLogger("combadge")
 _CHUNK_SIZE = 10 * 1024 * 1024
 _SLEEP_TIME = 10
 _NUM_OF_RETRIES = (60 // _SLEEP_TIME) * 15
+_TRANSPORTER_PORT = 9000
+# Number of chunks each pipeline stage may run ahead of the next one
+_PIPELINE_DEPTH = 2
+_DONE = object()
+_DEFAULT_COMPRESSION_LEVEL = 9
+# The start of each file is compressed at the fastest level to estimate how well it compresses
+_SAMPLE_SIZE = 1024 * 1024
+_MIN_COMPRESSION_SAVING = 0.1
+_COMPRESSED_EXTENSIONS = ['.gz', '.bz2', '.xz', '.zst', '.tgz', '.tbz2', '.txz', '.ioym', '.br', '.png', '.jpg',
+                          '.mp3', '.mkv', '.mp4', '.jpeg', '.zip', '.pcap']
 
 
 class ClientMessages(object):
@@ -39,52 +56,144 @@ def chunk_iterator(f, chunk_size):
         yield data
 
 
-class FileWriter(object):
-    def __init__(self, transporter):
-        self._transporter = transporter
-
-    def write(self, data):
-        self._transporter.sendall(struct.pack('!BL', ClientMessages.FileChunk, len(data)))
-        self._transporter.sendall(data)
+class _Pipeline(object):
+    # Runs each stage in its own thread, joined to the next one by a bounded queue, so reading,
+    # compressing and sending a file overlap
+
+    def __init__(self, source):
+        self._abort = threading.Event()
+        self._errors = []
+        self._threads = []
+        self._output = self._start(source)
+
+    def add_stage(self, transform):
+        self._output = self._start(transform(self._iter_queue(self._output)))
+
+    def _start(self, items):
+        output = queue.Queue(_PIPELINE_DEPTH)
+
+        def run():
+            try:
+                for item in items:
+                    if not self._put(output, item):
+                        return
+                self._put(output, _DONE)
+            except Exception:
+                self._errors.append(sys.exc_info()[1])
+                self._abort.set()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return output
+
+    def _put(self, output, item):
+        while not self._abort.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _iter_queue(self, input_queue):
+        while True:
+            try:
+                item = input_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._abort.is_set():
+                    return
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def __iter__(self):
+        for item in self._iter_queue(self._output):
+            yield item
+        self.close()
+        if self._errors:
+            raise self._errors[0]
 
     def close(self):
-        pass
+        self._abort.set()
+        for thread in self._threads:
+            thread.join()
 
 
-def _beam_file(transporter, base_path, path):
-    file_size = os.stat(path).st_size
-    logger.info("Uploading {0} ({1} bytes)".format(path, file_size))
+def _gzip_chunks(chunks, compression_level=_DEFAULT_COMPRESSION_LEVEL):
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
-    transporter.sendall(struct.pack('!B', ClientMessages.StartBeamingFile))
 
-    should_compress = os.path.splitext(path)[1] not in ['.gz', '.bz2', '.xz', '.zst', '.tgz', '.tbz2', '.txz',
-                                                        '.ioym', '.br', '.png', '.jpg', '.mp3', '.mkv', '.mp4',
-                                                        '.jpeg', '.zip', '.pcap']
-    store_path = path.replace(base_path, ".", 1) if base_path else path
-    if should_compress:
-        store_path += ".gz"
-        logger.info("Compressing {0}".format(path))
-    transporter.sendall(struct.pack('!H{0}s'.format(len(store_path)), len(store_path), store_path.encode('UTF-8')))
+def _send_chunk(transporter, data):
+    transporter.sendall(struct.pack('!BL', ClientMessages.FileChunk, len(data)))
+    transporter.sendall(data)
 
-    answer = struct.unpack('!B', transporter.recv(1))[0]
-    if answer == ServerMessages.SkipFile:
-        logger.info("Server asks us to skip this file")
-        return
-    elif answer == ServerMessages.BeamFile:
-        logger.info("Server asks us to beam this file")
-    else:
-        raise Exception("Unexpected server response: {0}".format(answer))
 
-    stat = os.stat(path)
-    transporter.sendall(struct.pack('!Q', int(stat.st_mtime)))
+def _should_compress(path, sample, compression_level):
+    if compression_level == 0 or os.path.splitext(path)[1] in _COMPRESSED_EXTENSIONS:
+        return False
+    if not sample:
+        return True
+    saving = 1 - len(zlib.compress(sample, 1)) / float(len(sample))
+    if saving < _MIN_COMPRESSION_SAVING:
+        logger.info("{0} does not compress well ({1:.0%} saved), not compressing".format(path, saving))
+        return False
+    return True
+
+
+def _beam_file(transporter, base_path, path, compression_level=_DEFAULT_COMPRESSION_LEVEL):
+    file_size = os.stat(path).st_size
+    logger.info("Uploading {0} ({1} bytes)".format(path, file_size))
 
     with open(path, 'rb') as f:
-        file_writer = FileWriter(transporter)
+        # The decision whether to compress is part of the stored name, which is sent first
+        sample = f.read(_SAMPLE_SIZE)
+        should_compress = _should_compress(path, sample, compression_level)
+
+        transporter.sendall(struct.pack('!B', ClientMessages.StartBeamingFile))
+
+        store_path = path.replace(base_path, ".", 1) if base_path else path
         if should_compress:
-            file_writer = gzip.GzipFile(mode="wb", fileobj=file_writer)
-        with closing(file_writer):
-            for chunk in chunk_iterator(f, _CHUNK_SIZE):
-                file_writer.write(chunk)
+            store_path += ".gz"
+            logger.info("Compressing {0}".format(path))
+        transporter.sendall(struct.pack('!H{0}s'.format(len(store_path)), len(store_path), store_path.encode('UTF-8')))
+
+        answer = struct.unpack('!B', transporter.recv(1))[0]
+        if answer == ServerMessages.SkipFile:
+            logger.info("Server asks us to skip this file")
+            return
+        elif answer == ServerMessages.BeamFile:
+            logger.info("Server asks us to beam this file")
+        else:
+            raise Exception("Unexpected server response: {0}".format(answer))
+
+        stat = os.stat(path)
+        transporter.sendall(struct.pack('!Q', int(stat.st_mtime)))
+
+        if len(sample) < _SAMPLE_SIZE:
+            # The whole file was read as the sample, so there is nothing to overlap and it is sent
+            # without starting the pipeline's threads
+            chunks = [sample] if sample else []
+            if should_compress:
+                chunks = _gzip_chunks(chunks, compression_level)
+            for data in chunks:
+                _send_chunk(transporter, data)
+        else:
+            pipeline = _Pipeline(itertools.chain([sample], chunk_iterator(f, _CHUNK_SIZE)))
+            if should_compress:
+                pipeline.add_stage(lambda chunks: _gzip_chunks(chunks, compression_level))
+            try:
+                for data in pipeline:
+                    _send_chunk(transporter, data)
+            finally:
+                pipeline.close()
 
     transporter.sendall(struct.pack('!B', ClientMessages.FileDone))
     answer = struct.unpack('!B', transporter.recv(1))[0]
@@ -95,36 +204,95 @@ def _beam_file(transporter, base_path, path):
         raise Exception("Unexpected server response: {0}".format(answer))
 
 
-def _beam_up(beam_id, path, transporter_addr):
-    logger.info("Contacting transporter %s", transporter_addr)
-    with closing(socket.socket()) as transporter:
-        transporter.connect((transporter_addr, 9000))
-
-        beam_id = int(beam_id)
-        transporter.sendall(struct.pack('!Q', beam_id))
-
+def _connect(beam_id, transporter_addr):
+    transporter = socket.socket()
+    try:
+        transporter.connect((transporter_addr, _TRANSPORTER_PORT))
+        transporter.sendall(struct.pack('!Q', int(beam_id)))
         transporter.sendall(struct.pack('!BH', ClientMessages.ProtocolVersion, 2))
+    except Exception:
+        transporter.close()
+        raise
+    return transporter
+
+
+def _iter_files(path):
+    if os.path.isfile(path):
+        yield os.path.dirname(path), path
+    elif os.path.isdir(path):
+        logger.info("Entering {0}".format(path))
+        for (dirpath, _, filenames) in os.walk(path):
+            for filename in filenames:
+                rel_path = os.path.join(dirpath, filename)
+                if os.path.isfile(rel_path):
+                    yield path, rel_path
+                else:
+                    logger.info("Skipping non-file {0}".format(rel_path))
+
+
+class _StreamWorker(threading.Thread):
+    def __init__(self, transporter, files, files_lock, abort, compression_level):
+        super(_StreamWorker, self).__init__()
+        self.daemon = True
+        self.error = None
+        self._transporter = transporter
+        self._files = files
+        self._files_lock = files_lock
+        self._abort = abort
+        self._compression_level = compression_level
+
+    def run(self):
+        try:
+            while not self._abort.is_set():
+                with self._files_lock:
+                    item = next(self._files, None)
+                if item is None:
+                    return
+                _beam_file(self._transporter, *item, compression_level=self._compression_level)
+        except Exception:
+            self.error = sys.exc_info()
+            self._abort.set()
 
-        if os.path.isfile(path):
-            _beam_file(transporter, os.path.dirname(path), path)
-        elif os.path.isdir(path):
-            logger.info("Entering {0}".format(path))
-            for (dirpath, _, filenames) in os.walk(path):
-                for filename in filenames:
-                    rel_path = os.path.join(dirpath, filename)
-                    if os.path.isfile(rel_path):
-                        _beam_file(transporter, path, rel_path)
-                    else:
-                        logger.info("Skipping non-file {0}".format(rel_path))
 
-        transporter.sendall(struct.pack('!B', ClientMessages.BeamComplete))
+def _beam_up(beam_id, path, transporter_addr, streams=1, compression_level=_DEFAULT_COMPRESSION_LEVEL):
+    logger.info("Contacting transporter %s with %d stream(s)", transporter_addr, streams)
+    transporters = []
+    try:
+        for _ in range(streams):
+            transporters.append(_connect(beam_id, transporter_addr))
+
+        # Every stream beams files of the same beam, taken from a shared walk of the directory.
+        # A failing stream stops the others, and the whole beam is retried.
+        files = _iter_files(path)
+        files_lock = threading.Lock()
+        abort = threading.Event()
+        workers = [_StreamWorker(transporter, files, files_lock, abort, compression_level)
+                   for transporter in transporters]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for worker in workers:
+            if worker.error is not None:
+                logger.error("Stream failed: %s", "".join(traceback.format_exception(*worker.error)))
+        for worker in workers:
+            if worker.error is not None:
+                raise worker.error[1]
+
+        # The transporter completes the beam when any of the connections reports completion, so
+        # it is only sent after all the files were beamed
+        for transporter in transporters:
+            transporter.sendall(struct.pack('!B', ClientMessages.BeamComplete))
+    finally:
+        for transporter in transporters:
+            transporter.close()
 
 
-def beam_up(beam_id, path, transporter_addr):
+def beam_up(beam_id, path, transporter_addr, streams=1, compression_level=_DEFAULT_COMPRESSION_LEVEL):
     attempt = 1
     while True:
         try:
-            _beam_up(beam_id, path, transporter_addr)
+            _beam_up(beam_id, path, transporter_addr, streams, compression_level)
         except Exception:
             should_retry = attempt < _NUM_OF_RETRIES
             logger.error(
@@ -142,12 +310,24 @@ def beam_up(beam_id, path, transporter_addr):
             break
 
 
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="combadge")
+    parser.add_argument("beam_id", type=int)
+    parser.add_argument("path")
+    parser.add_argument("transporter_addr", metavar="transporter hostname")
+    parser.add_argument("--streams", type=int, default=1,
+                        help="Number of connections to the transporter which upload files in parallel")
+    parser.add_argument("--compression-level", type=int, default=_DEFAULT_COMPRESSION_LEVEL, choices=range(10),
+                        help="gzip compression level, 0 disables compression")
+    args = parser.parse_args()
+    if args.streams < 1:
+        parser.error("--streams must be at least 1")
+    return args
+
+
 def main():
-    try:
-        _, beam_id, path, transporter_addr = sys.argv
-    except ValueError:
-        print("Usage: combadge [beam id] [path] [transporter hostname]")
-        return 1
+    args = _parse_args()
+    beam_id = args.beam_id
 
     try:
         pid = os.fork()
@@ -190,7 +370,7 @@ def main():
     logger.setLevel("DEBUG")
     logger.info("Combadge forked")
 
-    beam_up(beam_id, path, transporter_addr)
+    beam_up(beam_id, args.path, args.transporter_addr, args.streams, args.compression_level)
 
 
 if __name__ == '__main__':